@@ -9,7 +9,6 @@ def iter_action(dbarriergnn, o_b, a, threshold=-1.1e-2, max_iter=30):
     # size of a: (num_agents, n_candidates, action_dim)
     
     a = a.reshape((a.shape[0], -1, a.shape[-1]))
-    n_candidate = a.shape[1]
     
     dbarriergnn.eval()
     
@@ -18,7 +17,6 @@ def iter_action(dbarriergnn, o_b, a, threshold=-1.1e-2, max_iter=30):
     
     input_ = {k: v.to(device) for k, v in o_b.items()}
     vec = dbarriergnn.get_vec(**(input_)).detach()
-    vec = vec.unsqueeze(1).repeat((1, n_candidate, 1))
     
     aoptimizer = torch.optim.Adam([tensor_a], lr=2)
 
@@ -47,7 +45,6 @@ def iter_action_combine(dlgnn, dbgnn, o_l, o_b, a, threshold=-1.1e-2, max_iter=3
     # size of a: (num_agents, n_candidates, action_dim)
     
     a = a.reshape((a.shape[0], -1, a.shape[-1]))
-    n_candidate = a.shape[1]
     
     dlgnn.eval()
     dbgnn.eval()
@@ -57,11 +54,9 @@ def iter_action_combine(dlgnn, dbgnn, o_l, o_b, a, threshold=-1.1e-2, max_iter=3
     
     input_ = {k: v.to(device) for k, v in o_l.items()}
     vec_l = dlgnn.get_vec(**(input_)).detach()
-    vec_l = vec_l.unsqueeze(1).repeat((1, n_candidate, 1))    
     
     input_ = {k: v.to(device) for k, v in o_b.items()}
     vec_b = dbgnn.get_vec(**(input_)).detach()
-    vec_b = vec_b.unsqueeze(1).repeat((1, n_candidate, 1))
     
     aoptimizer = torch.optim.Adam([tensor_a], lr=2)
 
@@ -89,11 +84,8 @@ def iter_action_combine(dlgnn, dbgnn, o_l, o_b, a, threshold=-1.1e-2, max_iter=3
 
 
 def calculate_dl_value(dlyapunovgnn, o_l, a):
-    n_candidate = a.shape[1]
-    
     input_ = {k: v.to(device) for k, v in o_l.items()}
     vec_l = dlyapunovgnn.get_vec(**(input_)).detach()
-    vec_l = vec_l.unsqueeze(1).repeat((1, n_candidate, 1))
     
     tensor_a = torch.FloatTensor(a).to(device)
     
@@ -139,6 +131,40 @@ def choose_action_combine(a_refine, dlvalue, dbvalue, threshold=-1.1e-2):
     return a, a_value
 
 
+class CandidateBank:
+    """
+    Fixed low-discrepancy candidate actions in [-1, 1]^action_dim ('sobol' or 'halton', scrambled
+    with seed), kept on device as a (1, n_candidates, action_dim) tensor shared by all agents,
+    so get_field encodes and projects every candidate once per call instead of once per agent.
+    
+    With shift, every draw moves the whole set by one random offset, wrapped around [-1, 1)
+    (Cranley-Patterson rotation): the candidates change between steps and keep their coverage.
+    Without shift the draws are identical and get_field reuses the cached encoding and projection.
+    """
+    
+    def __init__(self, n_candidates, action_dim, method='sobol', shift=True, seed=0):
+        from scipy.stats import qmc
+        assert method in ('sobol', 'halton')
+        if method == 'sobol':
+            sampler = qmc.Sobol(d=action_dim, scramble=True, seed=seed)
+            points = sampler.random_base2(m=int(np.ceil(np.log2(n_candidates))))[:n_candidates]
+        else:
+            sampler = qmc.Halton(d=action_dim, scramble=True, seed=seed)
+            points = sampler.random(n_candidates)
+        self.points = torch.FloatTensor(points).unsqueeze(0).to(device)  # in [0, 1)
+        self.shift = shift
+        self.actions = 2*self.points-1
+        
+    def __len__(self):
+        return self.points.shape[1]
+        
+    def draw(self):
+        if self.shift:
+            offset = torch.rand(1, 1, self.points.shape[-1], device=self.points.device)
+            self.actions = 2*torch.remainder(self.points+offset, 1)-1
+        return self.actions
+
+
 def generate_default_model_name(Env):
     return {
         'b': 'model_gnn/bgnn_{0}.pt'.format(Env.__name__),
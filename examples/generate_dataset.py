@@ -27,6 +27,7 @@ from time import time
 from environment.gym_dubins_car import DubinsCarEnv, STEER
 from environment.gym_drone import DroneEnv
 from environment.gym_dynamic_dubins_multi import MultiDynamicDubinsEnv, STEER
+from environment.scenarios import ScenarioStore
 
 from configs.multi_dynamic_dubins.v0 import *
 
@@ -86,10 +87,7 @@ for density in [0, 5, 10, 15, 20]:
         valid_dataset.append((env.world.obstacles.copy(), env.world.agent_goals.copy(), env.world.agents.copy()))
         num_obstacles.append(len(env.world.obstacles))
         
-    import pickle as pkl
-
-    with open(f'dataset/{project_name}_static_{density}.pkl', 'wb') as f:
-        pkl.dump(valid_dataset, f)
+    ScenarioStore.write(f'dataset/{project_name}_static_{density}', valid_dataset)
         
     print(density, np.mean(num_obstacles))
 
@@ -113,10 +111,7 @@ for num_agents in [1,3]+list(2**np.arange(3, 9)):
         num_obstacles.append(len(env.world.obstacles))
         
     num_obstacles.append(len(env.world.obstacles))
-    import pickle as pkl
-
-    with open(f'dataset/{project_name}_dynamic_{num_agents}.pkl', 'wb') as f:
-        pkl.dump(valid_dataset, f)
+    ScenarioStore.write(f'dataset/{project_name}_dynamic_{num_agents}', valid_dataset)
     print(num_agents, np.mean(num_obstacles), size**2)
         
         
@@ -140,9 +135,6 @@ for num_agents in [1,3]+list(2**np.arange(3, 10)):
         valid_dataset.append((env.world.obstacles.copy(), env.world.agent_goals.copy(), env.world.agents.copy()))
         num_obstacles.append(len(env.world.obstacles))
     
-    import pickle as pkl
-
-    with open(f'dataset/{project_name}_mixed_{num_agents}.pkl', 'wb') as f:
-        pkl.dump(valid_dataset, f)    
+    ScenarioStore.write(f'dataset/{project_name}_mixed_{num_agents}', valid_dataset)
 
     print(num_agents, np.mean(num_obstacles))        
\ No newline at end of file
@@ -8,6 +8,7 @@ import math
 from models import *   
 from v109 import *
 from core import generate_default_model_name
+from environment.scenarios import ScenarioStore
 import pickle as pkl
 import os
 os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
@@ -18,8 +19,12 @@ VERBOSE = True
 
 for NUM_AGENTS in [1,2,4]:#,8,16,32,64,128,256,512,1024,2048]:
 
-    with open(f'dataset/{project_name}_{NUM_AGENTS}.pkl', 'rb') as f:
-        valid_dataset = pkl.load(f)
+    # columnar stores are memory-mapped and read scenario by scenario, old datasets are pickled lists
+    if os.path.isdir(f'dataset/{project_name}_{NUM_AGENTS}'):
+        valid_dataset = ScenarioStore(f'dataset/{project_name}_{NUM_AGENTS}')
+    else:
+        with open(f'dataset/{project_name}_{NUM_AGENTS}.pkl', 'rb') as f:
+            valid_dataset = pkl.load(f)
 
     bnn = create_network()
     print(bnn.load_state_dict(torch.load(BMODEL_PATH, map_location=device)))
@@ -37,8 +42,7 @@ for NUM_AGENTS in [1,2,4]:#,8,16,32,64,128,256,512,1024,2048]:
     path = f'gifs/0512/{project_name}_{version_name}/{NUM_AGENTS}'
     os.makedirs(path, exist_ok=True)
 
-    for v_idx in tqdm(range(len(valid_dataset))):
-        data = valid_dataset[v_idx]
+    for v_idx, data in enumerate(tqdm(valid_dataset)):
         env = create_env(num_agents=NUM_AGENTS, size=max(int((NUM_AGENTS*2)**0.5), 4), max_dist=1, density=0)
         env.world.obstacles, env.world.agent_goals, env.world.agents = deepcopy(data)
         if SAVE_GIF:
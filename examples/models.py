@@ -3,6 +3,8 @@ import math
 import numpy as np
 from torch.nn import Sequential as Seq, Linear as Lin, ReLU
 from torch.nn import LazyLinear
+from torch.nn.parameter import UninitializedParameter
+import torch.nn.functional as F
 from torch_geometric.nn.pool import knn
 from torch_geometric.utils import add_self_loops, remove_self_loops, softmax
 from torch_geometric.nn.conv import MessagePassing
@@ -24,6 +26,69 @@ def numpy2tensor(arr):
     return tensor
 
 
+def candidate_field(mlp, vec, action):
+    """
+    mlp(torch.cat((vec, action), dim=-1)), where vec (num_agents, hidden) may leave out the candidate
+    dim of action (num_agents, n_candidates, action_dim). The first Linear of mlp is then split into
+    a per-agent term, computed once per agent, and a per-candidate action term, added by broadcasting,
+    so vec is never repeated n_candidates times.
+    """
+    if vec.dim() == action.dim():
+        return mlp(torch.cat((vec, action), dim=-1))
+    first = mlp[0]
+    if isinstance(first.weight, UninitializedParameter):
+        # the input size of a LazyLinear is only known after the first full forward
+        vec = vec.unsqueeze(-2)
+        shape = torch.broadcast_shapes(vec.shape[:-1], action.shape[:-1])
+        return mlp(torch.cat((vec.expand(shape+vec.shape[-1:]), action.expand(shape+action.shape[-1:])), dim=-1))
+    hidden = vec.shape[-1]
+    feature = F.linear(vec, first.weight[:, :hidden], first.bias).unsqueeze(-2) + action_projection(first, hidden, action)
+    return mlp[1:](feature)
+
+
+def action_projection(first, hidden, action):
+    """
+    The action part of the first Linear of candidate_field. For candidates shared by all agents
+    (action of shape (1, n_candidates, action_dim), e.g. a CandidateBank) the last projection is
+    kept on the layer and reused while the candidates and the weights are unchanged. The weights
+    are compared with a copy, not by version: polyak updates and .data assignments leave no trace.
+    """
+    weight = first.weight[:, hidden:]
+    if not is_shared_candidates(action):
+        return F.linear(action, weight)
+    cache = getattr(first, '_action_cache', None)
+    if (cache is None) or (not same_tensor(cache[0], weight)) or (not same_tensor(cache[1], action)):
+        cache = (weight.clone(), action.clone(), F.linear(action, weight))
+        first._action_cache = cache
+    return cache[2]
+
+
+def positional_encoding(module, action):
+    """
+    sin/cos encoding of action (..., action_dim) with the frequencies module.div_term. The encoding of
+    candidates shared by all agents is kept on the module and reused while they are unchanged.
+    """
+    encode = lambda: torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*module.div_term),
+                                              torch.cos(action.unsqueeze(-1)*module.div_term)), dim=-1), start_dim=-2)
+    if not is_shared_candidates(action):
+        return encode()
+    cache = getattr(module, '_encoding_cache', None)
+    if (cache is None) or (not same_tensor(cache[0], module.div_term)) or (not same_tensor(cache[1], action)):
+        cache = (module.div_term.clone(), action.clone(), encode())
+        module._encoding_cache = cache
+    return cache[2]
+
+
+def is_shared_candidates(action):
+    # only candidates shared by all agents are cached, and never under autograd
+    return (not torch.is_grad_enabled()) and action.dim() == 3 and action.shape[0] == 1
+
+
+def same_tensor(cached, tensor):
+    return (cached.shape == tensor.shape) and (cached.device == tensor.device) and (cached.dtype == tensor.dtype) \
+        and torch.equal(cached, tensor)
+
+
 class MPNN(MessagePassing):
     def __init__(self, embed_size, aggr: str = 'max', **kwargs):
         super(MPNN, self).__init__(aggr=aggr, **kwargs)
@@ -110,7 +175,7 @@ class DBarrierGNN(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action, **kwargs):
-        return self.headpi(torch.cat((vec, action), dim=-1)).squeeze(dim=-1)  
+        return candidate_field(self.headpi, vec, action).squeeze(dim=-1)  
 
     
 class LyapunovGNN(torch.nn.Module):
@@ -157,7 +222,7 @@ class DLyapunovGNN(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action, **kwargs):
-        return self.headpi(torch.cat((vec, action), dim=-1)).squeeze(dim=-1)
+        return candidate_field(self.headpi, vec, action).squeeze(dim=-1)
 
 
 class MLP(torch.nn.Module):
@@ -215,7 +280,7 @@ class DMLP(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action, **kwargs):
-        field = self.field(torch.cat((vec, action), dim=-1))
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -298,7 +363,7 @@ class OldHeteroGNN(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action):
-        field = self.field(torch.cat((vec, action), dim=-1))
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -399,7 +464,7 @@ class HeteroGNN(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action):
-        field = self.field(torch.cat((vec, action), dim=-1))
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -491,7 +556,7 @@ class OriginGNN(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action):
-        field = self.field(torch.cat((vec, action), dim=-1))
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -562,7 +627,7 @@ class OriginGNNv2(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action):
-        field = self.field(torch.cat((vec, action), dim=-1))
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -637,7 +702,7 @@ class OriginGNNv3(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action):
-        field = self.field(torch.cat((vec, action), dim=-1))
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -711,7 +776,7 @@ class OriginGNNv4(torch.nn.Module):
         return vec
     
     def get_field(self, vec, action):
-        field = self.field(torch.cat((vec, action), dim=-1))
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -790,9 +855,8 @@ class OriginGNNv5(torch.nn.Module):
     
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -876,9 +940,8 @@ class OriginGNNv6(torch.nn.Module):
     
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -983,9 +1046,8 @@ class OriginGNNv7(torch.nn.Module):
 
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -1110,9 +1172,8 @@ class OriginGNNv8(torch.nn.Module):
 
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -1190,9 +1251,8 @@ class OriginGNNv9(torch.nn.Module):
     
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -1275,9 +1335,8 @@ class OriginGNNv10(torch.nn.Module):
     
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -1357,9 +1416,8 @@ class OriginGNNv11(torch.nn.Module):
     
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -1417,9 +1475,8 @@ class OriginGNNv12(torch.nn.Module):
     
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
-        field = self.field(torch.cat((vec, action), dim=-1))
+            action = positional_encoding(self, action)
+        field = candidate_field(self.field, vec, action)
         if self.mode=='sum':
             field = (field**2).sum(dim=-1)
         else:
@@ -1512,15 +1569,14 @@ class RLNet(torch.nn.Module):
     
     def get_field(self, vec, action):
         if self.pos_encode is not None:
-            action = torch.flatten(torch.cat((torch.sin(action.unsqueeze(-1)*self.div_term), 
-                                torch.cos(action.unsqueeze(-1)*self.div_term)), dim=-1), start_dim=-2)
+            action = positional_encoding(self, action)
         if self.use_global:
-            feature = self.action_net(torch.cat((vec, action), dim=-1))
+            feature = candidate_field(self.action_net, vec, action)
             max_pool, _ = torch.max(feature, dim=0, keepdim=True)
             feature = self.global_net(torch.cat((feature, max_pool.repeat(len(feature), 1)), dim=-1))
+            field = self.field(feature)
         else:
-            feature = torch.cat((vec, action), dim=-1)
-        field = self.field(feature)
+            field = candidate_field(self.field, vec, action)
         field = field.squeeze(dim=-1)
         return field
     
@@ -1559,6 +1615,8 @@ class UR5Net(torch.nn.Module):
         return new_vec
     
     def get_field(self, vec, action):
+        if vec.dim() < action.dim():
+            vec = vec.unsqueeze(-2)
         feature = vec + self.action_embed(action)
         field = self.field(feature).squeeze(dim=-1)
         return field
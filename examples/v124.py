@@ -1,15 +1,18 @@
 from tqdm import tqdm
 import gc
-from copy import deepcopy
+import os
+from copy import copy, deepcopy
 from environment.gym_dubins_car import DubinsCarEnv, STEER
 from environment.gym_drone import DroneEnv
+from environment.scenarios import ScenarioPool
+from pyg_multiagent.buffers import GraphReplayBuffer
 
 import torch
 import numpy as np
 from torch import nn
 import math
 from models import *
-from core import generate_default_model_name
+from core import generate_default_model_name, CandidateBank
 import wandb
 
 import scipy
@@ -41,6 +44,9 @@ BMODEL_PATH = name_dict['db'].replace('.pt', '_'+version_name+'.pt')
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# pre-generated worlds that create_env draws from instead of sampling a new one
+SCENARIO_POOL = None
+
 def create_network():
     if ENV_CONFIG['PROB'][1] == 0:
         bnn = eval(MODEL)(HIDDEN_SIZE, keys=['agent'], pos_encode=PE_DIM)
@@ -70,6 +76,8 @@ def create_env(num_agents=None, size=None, density=None, simple=None, min_dist=2
             env_config['PROB'] = (density, density)
         if simple is not None:
             env_config['simple'] = simple
+        if (SCENARIO_POOL is not None) and (env_config == ENV_CONFIG) and ('scenario' not in kwargs):
+            kwargs['scenario'] = SCENARIO_POOL.sample()
         env = Env(**env_config, **kwargs)
             # if (np.linalg.norm(env.world.agents[:,:env.space_dim] - env.world.agent_goals[:,:env.space_dim], axis=-1).min() >= min_dist):
             #     break
@@ -103,7 +111,7 @@ def train_barrier(bnn, swa_bnn, optimizer, buf_traj, buf_free, buf_danger, buf_a
         return dloss
 
     for i in range(n_iter):
-        if len(buf_traj.dataset):
+        if len(buf_traj):
             data, next_data = buf_traj.next_data()
             optimizer.zero_grad()
             data = data.to(device)
@@ -249,130 +257,524 @@ class GlobalReplayBuffer:
             return next(self.iter)        
     
     
-class MyDataset(Dataset):
-    def __init__(self, data, next_data):
-        self.data = data
-        self.next_data = next_data
-        
-    def __getitem__(self, index):
-        xA = self.data[index]
-        xB = self.next_data[index]
-        return xA, xB
-    
-    def __len__(self):
-        return len(self.data)            
-
-
-def collate(data_list):
-    batchA = Batch.from_data_list([data[0] for data in data_list])
-    batchB = Batch.from_data_list([data[1] for data in data_list])
-    return batchA, batchB    
-
-
 class TrajectoryReplayBuffer:
+    """
+    (data, next_data) pairs of consecutive timesteps, every timestep is stored once in frames
+    keeps the capacity most recent pairs
+
+    The pairs are a queue of frame numbers (counted over all frames ever stored): pairs[start:end]
+    are the first frames of the stored pairs, dropping pairs moves start and the head of frames.
+    """
     
-    def __init__(self, batch=64):
-        self.dataset = MyDataset([], [])
+    def __init__(self, batch=64, capacity=None):
+        self.frames = GraphReplayBuffer(batch)
+        self.pairs = np.zeros(64, dtype=np.int64)
+        self.start, self.end = 0, 0
+        self.n_frames_seen = 0  # frames ever stored
+        self.n_frames_dropped = 0
+        self.n_pairs_dropped = 0
         self.batch = batch
-        self.loader = None
+        self.capacity = capacity
+        self.order = None  # pair numbers, counted over all pairs ever stored
+        self.cursor = 0
         
     def append(self, buffer, collided):
         if np.all(collided) and (not ALL_LIE):
             return
         
-        new_buff = GlobalReplayBuffer()
-        for idx, obs in enumerate(buffer.obs_buf):
-            clone_obs = obs.clone()
-            clone_obs['next_free'] = (1-torch.FloatTensor(collided))*clone_obs['next_free']
-            new_buff.obs_buf.append(clone_obs)
-            if idx > 0:
-                self.dataset.data.append(new_buff.obs_buf[-2])
-                self.dataset.next_data.append(new_buff.obs_buf[-1]) 
+        for obs in buffer.obs_buf:
+            clone_obs = copy(obs)
+            clone_obs['next_free'] = (1-torch.FloatTensor(collided))*obs['next_free']
+            self.frames.store(clone_obs)
+        self._push(self.n_frames_seen + np.arange(len(buffer.obs_buf)-1))
+        self.n_frames_seen += len(buffer.obs_buf)
+        if self.capacity is not None:
+            self.drop_oldest(len(self) - self.capacity)
+    
+    def _push(self, first_frames):
+        if self.end + len(first_frames) > len(self.pairs):
+            # the dropped pairs are reclaimed before the queue grows
+            pairs = self.pairs[self.start:self.end]
+            if len(pairs) + len(first_frames) > len(self.pairs) // 2:
+                self.pairs = np.zeros(2*(len(pairs) + len(first_frames)), dtype=np.int64)
+            self.pairs[:len(pairs)] = pairs
+            self.start, self.end = 0, len(pairs)
+        self.pairs[self.end:self.end+len(first_frames)] = first_frames
+        self.end += len(first_frames)
+    
+    def __len__(self):
+        return self.end - self.start
+    
+    def drop_oldest(self, k):
+        k = min(k, len(self))
+        if k <= 0:
+            return
+        self.start += k
+        self.n_pairs_dropped += k
+        if len(self):
+            n_frames = self.pairs[self.start] - self.n_frames_dropped
+        else:
+            n_frames = len(self.frames)
+        self.frames.drop_oldest(n_frames)
+        self.n_frames_dropped += n_frames
+    
+    def next_indices(self):
+        """
+        Pairs of the next batch, iterating over shuffled epochs, the pairs dropped since the epoch started are skipped.
+        """
+        assert len(self) > 0, 'the buffer is empty'
+        pairs = []
+        n_found = 0
+        while n_found < self.batch:
+            if (self.order is None) or (self.cursor >= len(self.order)):
+                if n_found:
+                    break
+                self.order = self.n_pairs_dropped + np.random.permutation(len(self))
+                self.cursor = 0
+            order = self.order[self.cursor:self.cursor+self.batch-n_found]
+            self.cursor += len(order)
+            order = order[order >= self.n_pairs_dropped]
+            pairs.append(order - self.n_pairs_dropped)
+            n_found += len(order)
+        return np.concatenate(pairs)
                 
     def next_data(self):
-        if self.loader is None:
-            self.loader = DataLoader(self.dataset, shuffle=True, batch_size=self.batch, collate_fn=collate)
-            self.loader.sampler.replacement = False
-            self.iter = iter(self.loader)
-        
-        try:
-            return next(self.iter)
-        except StopIteration:
-            self.iter = iter(self.loader)
-            return next(self.iter)
+        frames = self.pairs[self.start + self.next_indices()] - self.n_frames_dropped
+        return self.frames.get_batch(frames), self.frames.get_batch(frames+1)
 
 
-class GatherReplayBuffer(Dataset):
+class GatherReplayBuffer(GraphReplayBuffer):
 
-    def __init__(self, bnn, dynamic_relabel=False, batch=64):
-        self.dataset = []
+    def __init__(self, bnn, dynamic_relabel=False, batch=64, capacity=None, bank=None):
+        # relabel reads the next timestep at idx+1, so only the oldest samples may be evicted
+        super().__init__(batch, capacity=capacity, eviction='fifo')
         self.bnn = bnn
         self.dynamic_relabel = dynamic_relabel
-        self.batch = batch
-        self.loader = None
+        self.bank = bank
         
     def append(self, buffer):
         for o in buffer.obs_buf:
-            self.dataset.append(o)
-        
-    def __getitem__(self, index):
-        return self.dataset[index]
+            self.store(o)
     
-    def __len__(self):
-        return len(self.dataset)
-    
-    def next_data(self):
-        if self.loader is None:
-            self.loader = GeoDataLoader(self.dataset, shuffle=True, batch_size=self.batch)
-            self.loader.sampler.replacement = False
-            self.iter = iter(self.loader)        
-        
-        try:
-            return next(self.iter)
-        except StopIteration:
-            if self.dynamic_relabel:
-                for index in np.arange(len(self.dataset))[::-1]:
-                    self.relabel(index, self.bnn)
-
-            self.iter = iter(self.loader)
-            return next(self.iter)
+    def new_epoch(self):
+        if self.dynamic_relabel and (self._order is not None):
+            for index in np.arange(len(self))[::-1]:
+                self.relabel(index, self.bnn)
+        super().new_epoch()
      
     @torch.no_grad()
     def relabel(self, idx, bnn):
-        if self.dataset[idx]['finished']:
-            return self.dataset[idx]
+        if self[idx]['finished']:
+            return self[idx]
         else:
-            data = self.dataset[idx]
-            next_data = self.dataset[idx+1]
+            data = self[idx]
+            next_data = self[idx+1]
             next_danger = next_data['next_danger']
             with torch.no_grad():
-                tensor_a = torch.zeros(size=(len(next_data['agent'].x), n_candidates, next_data['action'].shape[-1]), device=device).uniform_(-1, 1)
+                if self.bank is not None:
+                    tensor_a = self.bank.draw()
+                else:
+                    tensor_a = torch.zeros(size=(len(next_data['agent'].x), n_candidates, next_data['action'].shape[-1]), device=device).uniform_(-1, 1)
                 vec = bnn.get_vec(next_data.clone().to(device))
-                vec = vec.unsqueeze(1).repeat((1, n_candidates, 1))
                 next_bvalue = bnn.get_field(vec, tensor_a)   
             suspicous = (next_bvalue<THRESHOLD).all(dim=-1).cpu().float()
-            data['next_danger'] = ((suspicous*next_danger + data['meet_agent'] + data['meet_obstacle'])>=1).float()
-            data['next_free'] = 1-data['next_danger']
+            next_danger = ((suspicous*next_danger + data['meet_agent'] + data['meet_obstacle'])>=1).float()
+            self.set_label(idx, 'next_danger', next_danger)
+            self.set_label(idx, 'next_free', 1-next_danger)
 
 
 @torch.no_grad()    
 def eval_action(bnn, o, a):
-    # size of a: (num_agents, n_action, action_dim)
-    n_action = a.shape[1]
+    # size of a: (num_agents, n_action, action_dim), or a (1, n_action, action_dim) tensor shared by all agents
 
     input_ = o.clone().to(device)
-    tensor_a = torch.FloatTensor(a).to(device)
+    tensor_a = a if torch.is_tensor(a) else torch.FloatTensor(a).to(device)
 
     input_['action'] = tensor_a
     vec = bnn.get_vec(input_)
-    vec = vec.unsqueeze(1).repeat((1, n_action, 1))
     bvalue = bnn.get_field(vec, tensor_a)
     return tensor_a.data.cpu().numpy(), bvalue.data.cpu().numpy()
 
 
-def choose_action(bnn, env, explore_eps, nominal_eps, spatial_prop, thresholds, n_action=None, decompose=None):
+@torch.no_grad()
+def eval_action_chunks(bnn, o, n_action, action_dim, chunk_size):
+    # yields (a, bvalue) for chunks of at most chunk_size random candidates per agent, vec is computed once
+    input_ = o.clone().to(device)
+    vec = bnn.get_vec(input_)
+    for start in range(0, n_action, chunk_size):
+        a = np.random.uniform(-1, 1, size=(len(vec), min(chunk_size, n_action-start), action_dim))
+        bvalue = bnn.get_field(vec, torch.FloatTensor(a).to(device))
+        yield a, bvalue.data.cpu().numpy()
+
+
+class CandidateStats:
+    """
+    Running per-agent reductions over chunks of candidate actions, what choose_action needs
+    to select an action without keeping the (num_agents, n_action) scores:
+        best_a, best_v: candidate with the highest bvalue
+        nominal_a: candidate with the lowest potential
+        feasible_a, feasible_v: candidate with the lowest potential among bvalue > threshold
+        n_feasible: number of candidates with bvalue > threshold
+        danger_feasible: some candidate has bvalue > DANGER_THRESHOLD
+        safe_a: uniform sample among the candidates with bvalue > threshold (reservoir)
+        random_a: candidate random_idx, uniform among all candidates
+    """
+    
+    def __init__(self, num_agents, action_dim, thresholds, n_action):
+        self.thresholds = np.asarray(thresholds, dtype=float)
+        self.seen = np.zeros(num_agents, dtype=int)  # candidates scored per agent
+        self.best_v = np.full(num_agents, -np.inf)
+        self.best_idx = np.zeros(num_agents, dtype=int)
+        self.best_a = np.zeros((num_agents, action_dim))
+        self.nominal_dist = np.full(num_agents, np.inf)
+        self.nominal_a = np.zeros((num_agents, action_dim))
+        self.feasible_dist = np.full(num_agents, np.inf)
+        self.feasible_v = np.zeros(num_agents)
+        self.feasible_a = np.zeros((num_agents, action_dim))
+        self.n_feasible = np.zeros(num_agents, dtype=int)
+        self.danger_feasible = np.zeros(num_agents, dtype=bool)
+        self.safe_a = np.zeros((num_agents, action_dim))
+        self.random_idx = np.random.randint(n_action, size=num_agents)  # n_action: scalar or per agent
+        self.random_a = np.zeros((num_agents, action_dim))
+        
+    def update(self, a, bvalue, dist, agent_ids=None, feasible=None):
+        # size of a: (n_agents, n_chunk, action_dim), bvalue and dist: (n_agents, n_chunk)
+        # the rows are the agents agent_ids, all agents by default
+        # feasible: (n_agents, n_chunk) mask replacing bvalue > threshold, for candidates that are not scored
+        if agent_ids is None:
+            agent_ids = np.arange(len(self.best_v))
+        rows = np.arange(len(a))
+        n_chunk = bvalue.shape[1]
+        seen = self.seen[agent_ids]
+        
+        idx = bvalue.argmax(axis=-1)
+        better = bvalue[rows, idx] > self.best_v[agent_ids]
+        self.best_v[agent_ids[better]] = bvalue[rows, idx][better]
+        self.best_idx[agent_ids[better]] = (seen + idx)[better]
+        self.best_a[agent_ids[better]] = a[rows, idx][better]
+        
+        idx = dist.argmin(axis=-1)
+        better = dist[rows, idx] < self.nominal_dist[agent_ids]
+        self.nominal_dist[agent_ids[better]] = dist[rows, idx][better]
+        self.nominal_a[agent_ids[better]] = a[rows, idx][better]
+        
+        if feasible is None:
+            feasible = bvalue > self.thresholds[agent_ids, None]
+        feasible_dist = np.where(feasible, dist, np.inf)
+        idx = feasible_dist.argmin(axis=-1)
+        better = feasible_dist[rows, idx] < self.feasible_dist[agent_ids]
+        self.feasible_dist[agent_ids[better]] = feasible_dist[rows, idx][better]
+        self.feasible_v[agent_ids[better]] = bvalue[rows, idx][better]
+        self.feasible_a[agent_ids[better]] = a[rows, idx][better]
+        
+        # the sample moves into this chunk with probability (feasible in the chunk) / (feasible so far)
+        n_chunk_feasible = feasible.sum(axis=-1)
+        self.n_feasible[agent_ids] += n_chunk_feasible
+        replace = np.random.rand(len(a))*self.n_feasible[agent_ids] < n_chunk_feasible
+        idx = np.where(feasible, np.random.rand(*feasible.shape), -1).argmax(axis=-1)
+        self.safe_a[agent_ids[replace]] = a[rows, idx][replace]
+        
+        self.danger_feasible[agent_ids] |= (bvalue > DANGER_THRESHOLD).any(axis=-1)
+        
+        random_idx = self.random_idx[agent_ids]
+        in_chunk = (random_idx >= seen) & (random_idx < seen+n_chunk)
+        self.random_a[agent_ids[in_chunk]] = a[rows[in_chunk], (random_idx-seen)[in_chunk]]
+        self.seen[agent_ids] += n_chunk
+
+
+@torch.no_grad()
+def eval_action_adaptive(bnn, env, o, stats, n_action, potential, n_coarse=250, n_refine=250, top_k=8, sigma=0.1, min_feasible=10):
+    """
+    Coarse-to-fine candidates: n_coarse uniform candidates for every agent, then rounds of n_refine
+    candidates, up to n_action per agent, only for the agents still active. An agent stops once it has
+    min_feasible feasible candidates, the lowest-potential one is then expected among the best
+    1/(min_feasible+1) of its feasible actions. Agents without a feasible candidate sample around their
+    top_k highest-bvalue candidates (gaussian, std sigma), the others draw more uniform candidates.
+    
+    potential(a) gives the potential of (num_agents, n, action_dim) candidates, the reductions go to stats.
+    """
+    vec = bnn.get_vec(o.clone().to(device))
+    agents = np.arange(env.num_agents)
+    
+    a = np.random.uniform(-1, 1, size=(env.num_agents, n_coarse, env.action_dim))
+    bvalue = bnn.get_field(vec, torch.FloatTensor(a).to(device)).data.cpu().numpy()
+    dist = potential(a)
+    stats.update(a, bvalue, dist)
+    top = np.argsort(-bvalue, axis=-1)[:, :top_k]
+    top_a, top_v = a[agents[:, None], top], bvalue[agents[:, None], top]
+    done = stats.n_feasible >= min_feasible
+    
+    while (not done.all()) and (stats.seen[~done].max() < n_action):
+        ids = np.where(~done)[0]
+        n_chunk = min(n_refine, n_action - stats.seen[ids].max())
+        centers = top_a[ids[:, None], np.random.randint(top_a.shape[1], size=(len(ids), n_chunk))]
+        local = np.clip(centers + sigma*np.random.randn(*centers.shape), -1, 1)
+        uniform = np.random.uniform(-1, 1, size=centers.shape)
+        a = np.where((stats.n_feasible[ids] == 0)[:, None, None], local, uniform)
+        
+        # the agents that are done keep their current choice in the potential of the others
+        a_all = np.repeat(np.where((stats.n_feasible > 0)[:, None], stats.feasible_a, stats.best_a)[:, None], n_chunk, axis=1)
+        a_all[ids] = a
+        dist = potential(a_all)[ids]
+        bvalue = bnn.get_field(vec[ids], torch.FloatTensor(a).to(device)).data.cpu().numpy()
+        stats.update(a, bvalue, dist, agent_ids=ids)
+        
+        pool_a, pool_v = np.concatenate((top_a[ids], a), axis=1), np.concatenate((top_v[ids], bvalue), axis=1)
+        top = np.argsort(-pool_v, axis=-1)[:, :top_k]
+        rows = np.arange(len(ids))[:, None]
+        top_a[ids], top_v[ids] = pool_a[rows, top], pool_v[rows, top]
+        done[ids] = stats.n_feasible[ids] >= min_feasible
+
+
+class Anytime:
+    """
+    Wall-clock budget of the action selection, deadline seconds per choose_action call.
+    The candidates are scored in chunks of chunk_size in priority order: the chunk_size lowest-potential
+    of n_nominal uniform candidates, the warm-started ones, then uniform chunks until n_action candidates
+    or until the next chunk would miss the deadline. The first chunk is always scored.
+    used keeps the fraction of the deadline every call took.
+    spatial_prop has no bounded latency: infer turns it off when an Anytime is given.
+    """
+    
+    def __init__(self, deadline, chunk_size=250, n_nominal=1000):
+        self.deadline = deadline
+        self.chunk_size = chunk_size
+        self.n_nominal = n_nominal
+        self.used = []
+
+
+@torch.no_grad()
+def eval_action_anytime(bnn, env, o, stats, n_action, potential, anytime, warm_start=None):
+    start = time()
+    vec = bnn.get_vec(o.clone().to(device))
+    agents = np.arange(env.num_agents)[:, None]
+    chunks = []
+    
+    def score(a):
+        bvalue = bnn.get_field(vec, torch.FloatTensor(a).to(device)).data.cpu().numpy()
+        dist = potential(a)
+        stats.update(a, bvalue, dist)
+        chunks.append((a, bvalue, dist))
+    
+    a = np.random.uniform(-1, 1, size=(env.num_agents, max(anytime.n_nominal, anytime.chunk_size), env.action_dim))
+    score(a[agents, np.argsort(potential(a), axis=-1)[:, :anytime.chunk_size]])
+    chunk_time = time()-start
+    if (warm_start is not None) and (warm_start.actions is not None) and (2*chunk_time < anytime.deadline):
+        score(warm_start.candidates(env.num_agents, warm_start.actions.shape[1]*(1+warm_start.n_perturb), env.action_dim))
+    
+    while stats.seen.max() < n_action:
+        if time()-start+chunk_time > anytime.deadline:
+            break
+        chunk_start = time()
+        score(np.random.uniform(-1, 1, size=(env.num_agents, min(anytime.chunk_size, n_action-stats.seen.max()), env.action_dim)))
+        chunk_time = time()-chunk_start
+        
+    if warm_start is not None:
+        warm_start.update(*[np.concatenate(x, axis=1) for x in zip(*chunks)], stats.thresholds)
+    anytime.used.append((time()-start)/anytime.deadline)
+
+
+def isolated_agents(o, num_agents):
+    # agents without any agent or obstacle neighbour in the observation graph
+    isolated = np.ones(num_agents, dtype=bool)
+    for edge_type in ['a_near_a', 'o_near_a']:
+        isolated[o[edge_type].edge_index[1].cpu().numpy()] = False
+    return isolated
+
+
+def candidate_budget(isolated, n_action, n_isolated=32, max_factor=4):
+    """
+    Candidates per agent: n_isolated for the isolated agents, the rest of the num_agents*n_action
+    budget is shared by the others, at most max_factor*n_action each.
+    """
+    counts = np.full(len(isolated), n_isolated)
+    n_busy = (~isolated).sum()
+    if n_busy:
+        spare = len(isolated)*n_action - isolated.sum()*n_isolated
+        counts[~isolated] = min(max_factor*n_action, spare // n_busy)
+    return counts
+
+
+@torch.no_grad()
+def eval_action_budget(bnn, env, o, stats, counts, isolated, potential, n_represent=32):
+    """
+    Scores counts[i] uniform candidates for every crowded agent i, the agents with the same count together.
+    The isolated agents are not scored, they take the potential field action of their candidates, which all
+    count as feasible with a value at the agent's threshold. The potential is only computed for the candidates
+    of the agents at hand, its agent term sees n_represent fixed candidate next positions of every agent.
+    """
+    others = env.lookahead(np.random.uniform(-1, 1, size=(env.num_agents, n_represent, env.action_dim)))
+    others = others[..., :env.space_dim].copy()
+    if not isolated.all():
+        vec = bnn.get_vec(o.clone().to(device))
+    for count in np.unique(counts):
+        for agent_isolated in [False, True]:
+            ids = np.where((counts==count) & (isolated==agent_isolated))[0]
+            if len(ids) == 0:
+                continue
+            a = np.random.uniform(-1, 1, size=(len(ids), count, env.action_dim))
+            dist = potential(a, agent_ids=ids, others=others)
+            if agent_isolated:
+                bvalue = np.repeat(stats.thresholds[ids, None], count, axis=1)
+                stats.update(a, bvalue, dist, agent_ids=ids, feasible=np.ones(bvalue.shape, dtype=bool))
+            else:
+                bvalue = bnn.get_field(vec[ids], torch.FloatTensor(a).to(device)).data.cpu().numpy()
+                stats.update(a, bvalue, dist, agent_ids=ids)
+
+
+def select_action(stats, explore_eps, nominal_eps):
+    """
+    Per-agent selection of choose_action from the candidate reductions, in order:
+        nominal (prob nominal_eps): lowest potential
+        ALL_EXPLORE (prob explore_eps): random candidate
+        SAFE_EXPLORE (prob explore_eps, if feasible): random feasible candidate
+        feasible: lowest potential among bvalue > threshold
+        DANGER_EXPLORE (prob explore_eps): random candidate
+        otherwise: highest bvalue
+    Returns a, v, feasibles and the mask of the agents without a feasible candidate that did not explore.
+    """
+    num_agents = len(stats.best_v)
+    feasible_current = stats.n_feasible > 0
+    random_is_best = stats.random_idx == stats.best_idx
+    
+    nominal = np.random.rand(num_agents) < nominal_eps
+    undecided = ~nominal
+    all_explore = undecided & ALL_EXPLORE & (np.random.rand(num_agents)<explore_eps)
+    undecided = undecided & ~all_explore
+    safe_explore = undecided & (SAFE_EXPLORE & feasible_current) & (np.random.rand(num_agents)<explore_eps)
+    undecided = undecided & ~safe_explore
+    feasible = undecided & feasible_current
+    undecided = undecided & ~feasible
+    danger_explore = undecided & DANGER_EXPLORE & (np.random.rand(num_agents)<explore_eps)
+    greedy = undecided & ~danger_explore
+    
+    a = np.select([nominal[:, None], (all_explore | danger_explore)[:, None], safe_explore[:, None], feasible[:, None]],
+                  [stats.nominal_a, stats.random_a, stats.safe_a, stats.feasible_a], default=stats.best_a)
+    v = np.where(feasible, stats.feasible_v, 0.) + np.where(greedy, stats.best_v, 0.)
+    feasibles = stats.danger_feasible.astype(float)
+    feasibles[nominal | safe_explore | feasible] = 1
+    feasibles[all_explore & (feasible_current | ~random_is_best)] = 1  # mask the random action
+    feasibles[danger_explore & ~random_is_best] = 1  # mask the random action
+    return a, v, feasibles, undecided
+
+
+class WarmStart:
+    """
+    Carries the top_k candidates of every agent to its next choose_action call: the admissible ones
+    (bvalue > threshold) with the lowest potential first, then the highest bvalue. The next candidates
+    are these, n_perturb gaussian perturbations (std sigma) of each, and uniform ones for the rest.
+    One WarmStart per episode, agents move little between consecutive steps.
+    """
+    
+    def __init__(self, top_k=16, n_perturb=3, sigma=0.05):
+        self.top_k = top_k
+        self.n_perturb = n_perturb
+        self.sigma = sigma
+        self.actions = None
+        
+    def candidates(self, num_agents, n_action, action_dim):
+        a = np.random.uniform(-1, 1, size=(num_agents, n_action, action_dim))
+        if (self.actions is not None) and (len(self.actions) == num_agents):
+            perturbed = [np.clip(self.actions + self.sigma*np.random.randn(*self.actions.shape), -1, 1) for _ in range(self.n_perturb)]
+            carried = np.concatenate([self.actions]+perturbed, axis=1)[:, :n_action]
+            a[:, :carried.shape[1]] = carried
+        return a
+    
+    def update(self, a, bvalue, dist, thresholds):
+        top_k = min(self.top_k, bvalue.shape[1])
+        rows = np.arange(len(a))[:, None]
+        feasible = bvalue > np.asarray(thresholds, dtype=float)[:, None]
+        by_potential = np.argsort(np.where(feasible, dist, np.inf), axis=-1)[:, :top_k]
+        by_value = np.argsort(np.where(feasible, np.inf, -bvalue), axis=-1)[:, :top_k]
+        n_feasible = feasible.sum(axis=-1, keepdims=True)
+        slots = np.arange(top_k)[None, :]
+        idx = np.where(slots < n_feasible, by_potential, by_value[rows, np.clip(slots-n_feasible, 0, top_k-1)])
+        self.actions = a[rows, idx]
+
+
+def draw_candidates(num_agents, n_action, action_dim, bank=None):
+    # uniform (num_agents, n_action, action_dim) candidates, or the shared candidates of the bank
+    if bank is None:
+        return np.random.uniform(-1, 1, size=(num_agents, n_action, action_dim))
+    return bank.draw()
+
+
+@torch.no_grad()
+def find_evil_agents(bnn, o, a_all, agent_ids, thresholds):
+    """
+    For every agent of agent_ids, removes its incoming a_near_a edges one after another (in edge order)
+    until one of its candidates a_all is above its threshold, the sources of the removed edges are evil.
+    All the removal prefixes of all the agents are scored in one forward of a batch of copies of o,
+    only the agent the copy is about is scored on the candidates.
+    """
+    o = o.clone().to('cpu')
+    edges = o['a_near_a'].edge_index
+    num_agents = o['agent'].num_nodes
+    variant_agent, variant_k, in_edges = [], [], {}
+    for agent_id in agent_ids:
+        in_edges[agent_id] = torch.where(edges[1]==agent_id)[0]
+        variant_agent.append(np.full(len(in_edges[agent_id]), agent_id))
+        variant_k.append(np.arange(1, len(in_edges[agent_id])+1))
+    if sum(len(k) for k in variant_k)==0:
+        return set()
+    variant_agent, variant_k = np.concatenate(variant_agent), np.concatenate(variant_k)
+    n_variants, n_edges = len(variant_agent), edges.shape[1]
+
+    # copy b drops the first variant_k[b] incoming edges of variant_agent[b]
+    removed = torch.zeros(n_variants, n_edges, dtype=torch.bool)
+    start = 0
+    for agent_id in agent_ids:
+        degree = len(in_edges[agent_id])
+        removed[start:start+degree, in_edges[agent_id]] = torch.ones(degree, degree, dtype=torch.bool).tril()
+        start += degree
+    batch = Batch.from_data_list([o]*n_variants)
+    keep = ~removed.reshape(-1)
+    batch['a_near_a'].edge_index = batch['a_near_a'].edge_index[:, keep]
+    batch['a_near_a'].edge_attr = batch['a_near_a'].edge_attr[keep]
+
+    tensor_a = a_all if torch.is_tensor(a_all) else torch.FloatTensor(a_all)
+    tensor_a = tensor_a.to(device)
+    if len(tensor_a) > 1:
+        tensor_a = tensor_a[torch.from_numpy(variant_agent).to(device)]
+    batch = batch.to(device)
+    batch['action'] = tensor_a
+    vec = bnn.get_vec(batch)
+    rows = torch.from_numpy(np.arange(n_variants)*num_agents + variant_agent).to(device)
+    bvalues = bnn.get_field(vec[rows], tensor_a).data.cpu().numpy()  # n_variants x n_action
+
+    # the shortest feasible prefix of every agent
+    feasible = np.any(bvalues > np.asarray(thresholds)[variant_agent, None], axis=-1)
+    evil_agents = set()
+    for agent_id in np.unique(variant_agent[feasible]):
+        k = variant_k[feasible & (variant_agent==agent_id)].min()
+        evil_agents |= set(edges[0, in_edges[agent_id][:k]].tolist())
+    return evil_agents
+
+
+def check_candidate_options(spatial_prop, decompose, chunk_size, adaptive, budget, bank, warm_start, anytime):
+    """
+    choose_action scores the candidates either all at once (optionally decomposed, with spatial_prop) or with
+    one of the samplers chunk_size / adaptive / budget / anytime, which only score the full observation graph.
+    warm_start is only used by the undecomposed full path and by anytime. A bank replaces the uniform candidates
+    of the scoring all at once, it is shared by all agents and cannot carry the per-agent warm_start candidates.
+    """
+    samplers = [name for name, option in [('chunk_size', chunk_size), ('adaptive', adaptive), ('budget', budget),
+                                          ('anytime', anytime)] if option is not None]
+    assert len(samplers) <= 1, 'at most one of chunk_size, adaptive, budget and anytime can be set, got {}'.format(samplers)
+    assert not (samplers and (spatial_prop or (decompose is not None))), \
+        '{} cannot be combined with spatial_prop or decompose'.format(samplers)
+    assert (warm_start is None) or (samplers in ([], ['anytime']) and (decompose is None)), \
+        'warm_start is only used with all the candidates scored at once or with anytime, got {}, decompose={}'.format(samplers, decompose)
+    assert (bank is None) or (not samplers), 'a bank is only used with all the candidates scored at once, got {}'.format(samplers)
+    assert (bank is None) or (warm_start is None), 'a bank and warm_start cannot be combined'
+
+
+def choose_action(bnn, env, explore_eps, nominal_eps, spatial_prop, thresholds, n_action=None, decompose=None, chunk_size=None,
+                  adaptive=None, budget=None, bank=None, warm_start=None, anytime=None):
+    check_candidate_options(spatial_prop, decompose, chunk_size, adaptive, budget, bank, warm_start, anytime)
     if n_action is None:
-        n_action = n_candidates
+        n_action = n_candidates if bank is None else len(bank)
+    assert (bank is None) or (n_action == len(bank)), 'n_action {} but the bank has {} candidates'.format(n_action, len(bank))
     
     
     if nominal_eps > 0:
@@ -381,119 +783,86 @@ def choose_action(bnn, env, explore_eps, nominal_eps, spatial_prop, thresholds,
     else:
         K1 = 0.
         K2 = -3e-2
-    
-    if decompose is None:
+        
+    potential = lambda a, **kwargs: env.potential_field(a, K1=K1, K2=K2, ignore_agent=(nominal_eps <= 0), **kwargs)
+    if anytime is not None:
+        # the random candidates of the explorations are drawn in the first chunk
+        stats = CandidateStats(env.num_agents, env.action_dim, thresholds, anytime.chunk_size)
+        o = env._get_obs(**OBS_CONFIG)
+        eval_action_anytime(bnn, env, o, stats, n_action, potential, anytime, warm_start)
+    elif adaptive is not None:
+        # the random candidates of the explorations are drawn among the uniform coarse candidates
+        stats = CandidateStats(env.num_agents, env.action_dim, thresholds, adaptive.get('n_coarse', 250))
         o = env._get_obs(**OBS_CONFIG)
-        a_all = np.random.uniform(-1, 1, size=(env.num_agents, n_action, env.action_dim))
-        a_refines, bvalues = eval_action(bnn, o, a_all)
+        eval_action_adaptive(bnn, env, o, stats, n_action, potential, **adaptive)
+    elif budget is not None:
+        # isolated agents only need a goal-seeking action, their candidates go to the crowded ones
+        o = env._get_obs(**OBS_CONFIG)
+        isolated = isolated_agents(o, env.num_agents)
+        counts = candidate_budget(isolated, n_action, **budget)
+        stats = CandidateStats(env.num_agents, env.action_dim, thresholds, counts)
+        eval_action_budget(bnn, env, o, stats, counts, isolated, potential, n_represent=budget.get('n_isolated', 32))
+    elif chunk_size is not None:
+        stats = CandidateStats(env.num_agents, env.action_dim, thresholds, n_action)
+        # with nominal_eps > 0 the agent term of the potential only sees the other agents' candidates of the same chunk
+        o = env._get_obs(**OBS_CONFIG)
+        for a_chunk, bvalue in eval_action_chunks(bnn, o, n_action, env.action_dim, chunk_size):
+            stats.update(a_chunk, bvalue, potential(a_chunk))
     else:
-        a_all = np.random.uniform(-1, 1, size=(env.num_agents, n_action, env.action_dim))
-        bvalues = np.ones(shape=(env.num_agents, n_action))
-        decompose_way, decompose_iter = decompose
-        if decompose_way == 'random_k':
-            for _ in range(decompose_iter):
-                o = eval('env._get_obs_'+decompose_way)()
-                a_refines, bvalues_current = eval_action(bnn, o, a_all)  
-                bvalues = np.minimum(bvalues, bvalues_current)
-        
-        elif decompose_way == 'group_k':
-            r_graph = env._get_obs(rgraph_a=True, rgraph_o=False)
-            prefer_center = set(np.random.permutation(env.num_agents))
-            r_edge_index = r_graph['a_near_a'].edge_index
-            edge_mask = torch.zeros_like(r_graph['a_near_a'].edge_index[0,:]).bool()
-            while len(prefer_center):
-                result = env._get_obs_group_k(np.random.permutation(list(prefer_center)), loop=False, clip=True)
-                edge_mask = edge_mask | result[3]
-                prefer_center = (prefer_center - result[2]) & set(r_edge_index[:,~edge_mask].unique().data.numpy())
-                o = result[0]
-                a_refines, bvalues_current = eval_action(bnn, o, a_all)  
-                bvalues[np.array(list(result[1])),:] = np.minimum(bvalues[np.array(list(result[1])),:], 
-                                                                  bvalues_current[np.array(list(result[1])),:])
-
+        stats = CandidateStats(env.num_agents, env.action_dim, thresholds, n_action)
+        if decompose is None:
+            o = env._get_obs(**OBS_CONFIG)
+            if warm_start is not None:
+                a_all = warm_start.candidates(env.num_agents, n_action, env.action_dim)
+            else:
+                a_all = draw_candidates(env.num_agents, n_action, env.action_dim, bank)
+            a_refines, bvalues = eval_action(bnn, o, a_all)
         else:
-            assert False       
-        
+            a_all = draw_candidates(env.num_agents, n_action, env.action_dim, bank)
+            bvalues = np.ones(shape=(env.num_agents, n_action))
+            decompose_way, decompose_iter = decompose
+            if decompose_way == 'random_k':
+                # all the subgraphs of all the iterations are scored in one forward
+                o = env._get_obs_random_k_batch(iteration=decompose_iter)
+                a_nodes = a_all[o['agent'].n_id.numpy()] if len(a_all) > 1 else a_all
+                a_refines, bvalues_current = eval_action(bnn, o, a_nodes)
+                a_refines = a_refines[:env.num_agents]
+                bvalues = np.minimum(bvalues, bvalues_current.reshape(-1, env.num_agents, n_action).min(axis=0))
         
+            elif decompose_way == 'group_k':
+                r_graph = env._get_obs(rgraph_a=True, rgraph_o=False)
+                prefer_center = set(np.random.permutation(env.num_agents))
+                r_edge_index = r_graph['a_near_a'].edge_index
+                edge_mask = torch.zeros_like(r_graph['a_near_a'].edge_index[0,:]).bool()
+                while len(prefer_center):
+                    result = env._get_obs_group_k(np.random.permutation(list(prefer_center)), loop=False, clip=True)
+                    edge_mask = edge_mask | result[3]
+                    prefer_center = (prefer_center - result[2]) & set(r_edge_index[:,~edge_mask].unique().data.numpy())
+                    o = result[0]
+                    a_refines, bvalues_current = eval_action(bnn, o, a_all)  
+                    bvalues[np.array(list(result[1])),:] = np.minimum(bvalues[np.array(list(result[1])),:], 
+                                                                      bvalues_current[np.array(list(result[1])),:])
 
-    dists = env.potential_field(a_refines, K1=K1, K2=K2, ignore_agent=(nominal_eps <= 0))
-    v = np.zeros(env.num_agents)
-    a = np.zeros((env.num_agents, env.action_dim))
-    feasibles = np.zeros(env.num_agents)
-    evil_agents = set()
-    for agent_id, a_refine, bvalue, dist, threshold in zip(np.arange(env.num_agents), a_refines, bvalues, dists, thresholds):
+            else:
+                assert False       
 
-        feasibles[agent_id] = float(np.any(bvalue>DANGER_THRESHOLD))
+        a_refines = np.broadcast_to(a_refines, (env.num_agents,)+a_refines.shape[1:])
+        dists = potential(a_refines)
+        stats.update(a_refines, bvalues, dists)
+        if warm_start is not None:
+            warm_start.update(a_refines, bvalues, dists, thresholds)
         
-        if np.random.rand() < nominal_eps:
-            a[agent_id] = a_refine[np.argsort(dist)[0]]
-            feasibles[agent_id] = 1
-            continue
-            
-        feasible_current = False
-        if np.any(bvalue>threshold):
-            feasible_current = True
-        else:
-            feasible_current = False            
-            
-        if ALL_EXPLORE and (np.random.rand()<explore_eps):
-            a_idx = np.random.randint(n_candidates)
-            a[agent_id] = a_refine[a_idx]
-            if feasible_current or (a_idx != np.argmax(bvalue)):
-                feasibles[agent_id] = 1  # mask the random action            
-            continue
-            
-        if (SAFE_EXPLORE and feasible_current) and (np.random.rand()<explore_eps):
-            a_idx = np.random.choice(np.where(bvalue>threshold)[0])
-            a[agent_id] = a_refine[a_idx]
-            feasibles[agent_id] = 1  # mask the random action            
-            continue            
-            
-        if feasible_current:
-            feasibles[agent_id] = 1
-            for a_idx in np.argsort(dist):
-                if bvalue[a_idx] > threshold:
-                    a[agent_id] = a_refine[a_idx]
-                    v[agent_id] = bvalue[a_idx]
-                    break
-            continue
-
-        if spatial_prop:
-            local_evils = set()
-            # find evil_agent
-            local_o = o.clone()
-            while True:
-                local_o.to('cpu')
-                edges = local_o['a_near_a'].edge_index
-                neighbor_edges = edges[1]==agent_id
-                if neighbor_edges.sum()==0:
-                    break
-
-                first_edge = torch.where(neighbor_edges)[0][0]
-                mask = (torch.arange(edges.shape[1])==first_edge)
-                local_evils.add(int(edges[0, first_edge]))
-                local_o['a_near_a'].edge_index = edges[:,~mask]
-                local_o['a_near_a'].edge_attr = local_o['a_near_a'].edge_attr[~mask,:]
-
-                local_a_refines, local_bvalues = eval_action(bnn, local_o, a_all)
-
-                if np.any(local_bvalues[agent_id]>threshold):
-                    evil_agents = evil_agents | local_evils
-                    break
-                    
-        if DANGER_EXPLORE and (np.random.rand()<explore_eps):
-            a_idx = np.random.randint(n_action)
-            a[agent_id] = a_refine[a_idx]
-            if a_idx != np.argmax(bvalue):
-                feasibles[agent_id] = 1  # mask the random action            
-            continue
-        else:
-            a[agent_id] = a_refine[np.argmax(bvalue)]
-            v[agent_id] = bvalue[np.argmax(bvalue)]
-
+    a, v, feasibles, undecided = select_action(stats, explore_eps, nominal_eps)
+    evil_agents = set()
+    if spatial_prop:
+        # agents without a feasible action look for the neighbours that make them infeasible,
+        # in the full observation graph: o of a decomposition holds subgraphs (random_k: all of them batched)
+        if decompose is not None:
+            o = env._get_obs(**OBS_CONFIG)
+        evil_agents = find_evil_agents(bnn, o, a_all, np.where(undecided)[0], thresholds)
     for evil_agent in evil_agents:
-        a_refine, bvalue = a_refines[evil_agent], bvalues[evil_agent]
-        a[evil_agent] = a_refine[np.argmax(bvalue)]
-        v[evil_agent] = bvalue[np.argmax(bvalue)]
+        a[evil_agent] = stats.best_a[evil_agent]
+        v[evil_agent] = stats.best_v[evil_agent]
         
     return a, v, feasibles, evil_agents
 
@@ -511,13 +880,17 @@ def save_gif(gifs, name="play.gif"):
 def infer(env, bnn, threshold=None, max_episode_length=256, 
           n_action=None,
           verbose=False, seed=0, stop_at_collision=False, 
-          spatial_prop=None, need_gif=None, decompose=None, lie_derive_safe=None):
+          spatial_prop=None, need_gif=None, decompose=None, lie_derive_safe=None, chunk_size=None, adaptive=None,
+          budget=None, bank=None, warm_start=None, anytime=None):
     
     if spatial_prop is None:
         spatial_prop = SPATIAL_PROP
+    if anytime is not None:
+        # no unbounded evil agent search under a deadline
+        spatial_prop = False
         
     if n_action is None:
-        n_action = n_candidates
+        n_action = n_candidates if bank is None else len(bank)
         
     if lie_derive_safe is None:
         lie_derive_safe = LIE_DERIVE_SAFE
@@ -536,6 +909,11 @@ def infer(env, bnn, threshold=None, max_episode_length=256,
     else:
         paths = [None]
     total_trans=0; n_danger=0; no_feasible=0; collided=np.zeros(env.num_agents).astype(bool); thresholds=np.array([threshold]*env.num_agents)
+    if warm_start is not None:
+        # top-k candidates of the previous step, only with all candidates scored at once or under a deadline
+        warm_start = WarmStart(**warm_start)
+    if anytime is not None:
+        anytime = Anytime(**anytime)
 
     while True:
         a, v, feasibles, evil_agents = choose_action(bnn=bnn, env=env, explore_eps=0, 
@@ -543,7 +921,13 @@ def infer(env, bnn, threshold=None, max_episode_length=256,
                                                      spatial_prop=spatial_prop, 
                                                      thresholds=thresholds,
                                                      n_action=n_action,
-                                                     decompose=decompose)
+                                                     decompose=decompose,
+                                                     chunk_size=chunk_size,
+                                                     adaptive=adaptive,
+                                                     budget=budget,
+                                                     bank=bank,
+                                                     warm_start=warm_start,
+                                                     anytime=anytime)
         next_o, rw, done, info = env.step(a, obs_config=OBS_CONFIG)
         
         prev_danger = info['prev_danger'].data.cpu().numpy().astype(bool)
@@ -570,6 +954,8 @@ def infer(env, bnn, threshold=None, max_episode_length=256,
             
     if need_gif is not None:
         env.save_fig(paths, env.world.agent_goals, env.world.obstacles, need_gif[:-4]+'_'+str(np.any(collided))+'_'+str(done)+need_gif[-4:])
+    if verbose and (anytime is not None):
+        print('deadline used: mean {:.2f} max {:.2f}'.format(np.mean(anytime.used), np.max(anytime.used)))
 
     return collided, done, paths
 
@@ -617,6 +1003,7 @@ if __name__ == '__main__':
             "clip_norm": CLIP_NORM,
             "dynamic_relabel": DYNAMIC_RELABEL,
             "cbuf": N_CBUF,
+            "buffer_eviction": BUFFER_EVICTION,
             "update_freq": UPDATE_FREQ,
             "min_lr": MIN_LR,
             "danger_threshold": DANGER_THRESHOLD,
@@ -642,11 +1029,24 @@ if __name__ == '__main__':
         env = create_env()
         valid_dataset.append((env.world.obstacles.copy(), env.world.agent_goals.copy(), env.world.agents.copy()))
 
+    # training worlds are drawn from the pool, the datasets above are sampled independently
+    if N_SCENARIO_POOL > 0:
+        if (SCENARIO_POOL_PATH is not None) and os.path.exists(SCENARIO_POOL_PATH):
+            SCENARIO_POOL = ScenarioPool.load(SCENARIO_POOL_PATH)
+        else:
+            SCENARIO_POOL = ScenarioPool.generate(create_env(), N_SCENARIO_POOL)
+            if SCENARIO_POOL_PATH is not None:
+                SCENARIO_POOL.save(SCENARIO_POOL_PATH)
+
 
     Env = Env
     env = create_env()
     bnn = create_network()
     swa_bnn = None
+    if CANDIDATE_BANK is not None:
+        candidate_bank = CandidateBank(n_candidates, env.action_dim, **CANDIDATE_BANK)
+    else:
+        candidate_bank = None
 
     name_dict = generate_default_model_name(Env)
     # bnn.load_state_dict(torch.load(name_dict['b'].replace('.pt', '_1model.pt'), map_location=device))
@@ -672,12 +1072,12 @@ if __name__ == '__main__':
 
     trajs = defaultdict(list)
     # open(TXT_NAME, 'w+').close()
-    cbuf_obstacle = GlobalReplayBuffer(BATCH)
-    cbuf_agent = GlobalReplayBuffer(BATCH)
-    cbuf_dynamic_danger = GlobalReplayBuffer(BATCH)
-    cbuf_dynamic_free = GlobalReplayBuffer(BATCH)
-    bbuf_traj = TrajectoryReplayBuffer(BATCH)
-    bbuf_gather = GatherReplayBuffer(bnn=swa_bnn, dynamic_relabel=DYNAMIC_RELABEL, batch=BATCH)
+    cbuf_obstacle = GraphReplayBuffer(BATCH, capacity=N_CBUF, eviction=BUFFER_EVICTION)
+    cbuf_agent = GraphReplayBuffer(BATCH, capacity=N_CBUF, eviction=BUFFER_EVICTION)
+    cbuf_dynamic_danger = GraphReplayBuffer(BATCH, capacity=N_DYNAMIC_BUFFER, eviction=BUFFER_EVICTION)
+    cbuf_dynamic_free = GraphReplayBuffer(BATCH, capacity=N_DYNAMIC_BUFFER, eviction=BUFFER_EVICTION)
+    bbuf_traj = TrajectoryReplayBuffer(BATCH, capacity=N_TRAJ_BUFFER)
+    bbuf_gather = GatherReplayBuffer(bnn=swa_bnn, dynamic_relabel=DYNAMIC_RELABEL, batch=BATCH, capacity=N_BUFFER, bank=candidate_bank)
 
     for epoch_i in range(N_TRAJ):
 
@@ -733,7 +1133,11 @@ if __name__ == '__main__':
                                             nominal_eps=max(nominal_eps, int(epoch_i<N_WARMUP)), 
                                             spatial_prop=SPATIAL_PROP,
                                             n_action=n_candidates,
-                                            thresholds=thresholds)
+                                            thresholds=thresholds,
+                                            chunk_size=CANDIDATE_CHUNK,
+                                            adaptive=ADAPTIVE_CANDIDATES,
+                                            budget=CANDIDATE_BUDGET,
+                                            bank=candidate_bank)
             n_evils.append(len(evil_agents))
             no_feasible += (env.num_agents - np.sum(feasibles))
             next_o, rw, done, info = env.step(a, obs_config=OBS_CONFIG)
@@ -814,24 +1218,6 @@ if __name__ == '__main__':
         
         wandb.log({'time/data_collection': time()-t0})
 
-        while len(bbuf_gather.dataset) > N_BUFFER:
-            bbuf_gather.dataset.pop(0)
-            
-        while len(bbuf_traj.dataset) > N_TRAJ_BUFFER:
-            bbuf_traj.dataset.data.pop(0)
-            bbuf_traj.dataset.next_data.pop(0)
-        
-        while len(cbuf_agent.obs_buf) > N_CBUF:
-            cbuf_agent.obs_buf.pop(0)
-            
-        while len(cbuf_obstacle.obs_buf) > N_CBUF:
-            cbuf_obstacle.obs_buf.pop(0) 
-            
-        while len(cbuf_dynamic_free.obs_buf) > N_DYNAMIC_BUFFER:
-            cbuf_dynamic_free.obs_buf.pop(0)
-            
-        while len(cbuf_dynamic_danger.obs_buf) > N_DYNAMIC_BUFFER:
-            cbuf_dynamic_danger.obs_buf.pop(0)            
 
         if (epoch_i > N_WARMUP) and (epoch_i % (N_VALID) == (N_VALID-1)):
 
@@ -843,7 +1229,9 @@ if __name__ == '__main__':
             for v_idx, data in enumerate(valid_dataset):
                 env = create_env()
                 env.world.obstacles, env.world.agent_goals, env.world.agents = deepcopy(data)
-                collided, done, gifs = infer(env, bnn, need_gif=None)
+                collided, done, gifs = infer(env, bnn, need_gif=None, chunk_size=CANDIDATE_CHUNK, adaptive=ADAPTIVE_CANDIDATES,
+                                             budget=CANDIDATE_BUDGET, bank=candidate_bank, warm_start=WARM_START,
+                                             anytime=ANYTIME)
                 valid_loss += np.mean(collided)
                 valid_success += (done and (not np.any(collided)))
                 valid_length += len(gifs)
@@ -899,7 +1287,7 @@ if __name__ == '__main__':
                    "size/cbuf_agent": len(cbuf_agent),
                    "size/dybuf_free": len(cbuf_dynamic_free),
                    "size/dybuf_danger": len(cbuf_dynamic_danger),
-                   "size/liebuf": len(bbuf_traj.dataset),
-                   "size/gather": len(bbuf_gather.dataset),
+                   "size/liebuf": len(bbuf_traj),
+                   "size/gather": len(bbuf_gather),
                    "size/epoch_i": epoch_i})
         
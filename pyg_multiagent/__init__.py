@@ -1,5 +1,6 @@
 from . import baselines
+from . import buffers
 from . import environments
 # TODO: add version information here
 
-__all__ = ['baselines', 'environments']
\ No newline at end of file
+__all__ = ['baselines', 'buffers', 'environments']
\ No newline at end of file
@@ -29,6 +29,7 @@ from collections import defaultdict
 from torch_geometric.data import Data
 from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader as GeoDataLoader
+from pyg_multiagent.buffers import GraphReplayBuffer
 from time import time
 from baselines.gpg_config import *
 
@@ -218,56 +219,34 @@ class GlobalReplayBuffer:
                 return next(self.iter)        
     
     
-class MyDataset(Dataset):
-    def __init__(self, data, next_data):
-        self.data = data
-        
-    def __getitem__(self, index):
-        xA = self.data[index]
-        xB = self.data[(index+1) if ((index+1) <len(self.data)) else 0]
-        return xA, xB
-    
-    def __len__(self):
-        return len(self.data)            
-
-
-def collate(data_list):
-    batchA = Batch.from_data_list([data[0] for data in data_list])
-    batchB = Batch.from_data_list([data[1] for data in data_list])
-    return batchA, batchB    
-
-
 class TrajectoryReplayBuffer:
+    """
+    (data, next_data) pairs of consecutive stored timesteps (the last one is paired with the first),
+    every timestep is stored once in frames
+    """
     
     def __init__(self, batch=64):
-        self.dataset = MyDataset([], [])
+        self.frames = GraphReplayBuffer(batch)
         self.batch = batch
-        self.loader = None
         
     def append(self, buffer):
-        
-        new_buff = GlobalReplayBuffer()
-        for idx, obs in enumerate(buffer.obs_buf):
-            clone_obs = obs.clone()
-            self.dataset.data.append(clone_obs)
+        for obs in buffer.obs_buf:
+            self.frames.store(obs)
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    def drop_oldest(self, k):
+        self.frames.drop_oldest(k)
                 
     def next_data(self):
         if SHARE_SAMPLE_ACROSS_UPDATE:
-            return collate([self.dataset[idx] for idx in np.random.choice(len(self.dataset), min(self.batch, len(self.dataset)),
-                              replace=False)])
-        else:        
-            if self.loader is None:
-                self.loader = DataLoader(self.dataset, shuffle=True, batch_size=self.batch, collate_fn=collate)
-                self.loader.sampler.replacement = False
-                self.iter = iter(self.loader)
-
-            try:
-                return next(self.iter)
-            except StopIteration:
-                self.iter = iter(self.loader)
-                return next(self.iter)
-            
+            indices = np.random.choice(len(self), min(self.batch, len(self)), replace=False)
+        else:
+            indices = self.frames.next_indices()
+        return self.frames.get_batch(indices), self.frames.get_batch((indices+1) % len(self))
             
+
 @torch.no_grad()
 def choose_action_greedy(actor, env):
     action_dim = env.action_dim
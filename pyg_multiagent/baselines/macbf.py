@@ -32,6 +32,7 @@ from collections import defaultdict
 from torch_geometric.data import Data
 from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader as GeoDataLoader
+from pyg_multiagent.buffers import GraphReplayBuffer
 from time import time
 
 if __name__ == '__main__':
@@ -129,9 +130,12 @@ def train_barrier(critic, actor, optimizer, buf_f, buf_d, env, n_iter):
     for _ in range(n_iter):
         for buf in [buf_f, buf_d]:
             
-            if len(buf.obs_buf)==0:
+            if len(buf)==0:
                 continue
-            data = buf.next_data().clone()
+            if SHARE_SAMPLE_ACROSS_UPDATE:
+                data = buf.get_batch(np.random.choice(len(buf), min(buf.batch, len(buf)), replace=False))
+            else:
+                data = buf.next_data()
             data = data.to(device)  
             optimizer.zero_grad()
             loss_a = compute_loss_a(data)
@@ -232,56 +236,34 @@ class GlobalReplayBuffer:
                 return next(self.iter)        
     
     
-class MyDataset(Dataset):
-    def __init__(self, data, next_data):
-        self.data = data
-        
-    def __getitem__(self, index):
-        xA = self.data[index]
-        xB = self.data[(index+1) if ((index+1) <len(self.data)) else 0]
-        return xA, xB
-    
-    def __len__(self):
-        return len(self.data)            
-
-
-def collate(data_list):
-    batchA = Batch.from_data_list([data[0] for data in data_list])
-    batchB = Batch.from_data_list([data[1] for data in data_list])
-    return batchA, batchB    
-
-
 class TrajectoryReplayBuffer:
+    """
+    (data, next_data) pairs of consecutive stored timesteps (the last one is paired with the first),
+    every timestep is stored once in frames
+    """
     
     def __init__(self, batch=64):
-        self.dataset = MyDataset([], [])
+        self.frames = GraphReplayBuffer(batch)
         self.batch = batch
-        self.loader = None
         
     def append(self, buffer):
-        
-        new_buff = GlobalReplayBuffer()
-        for idx, obs in enumerate(buffer.obs_buf):
-            clone_obs = obs.clone()
-            self.dataset.data.append(clone_obs)
+        for obs in buffer.obs_buf:
+            self.frames.store(obs)
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    def drop_oldest(self, k):
+        self.frames.drop_oldest(k)
                 
     def next_data(self):
         if SHARE_SAMPLE_ACROSS_UPDATE:
-            return collate([self.dataset[idx] for idx in np.random.choice(len(self.dataset), min(self.batch, len(self.dataset)),
-                              replace=False)])
-        else:        
-            if self.loader is None:
-                self.loader = DataLoader(self.dataset, shuffle=True, batch_size=self.batch, collate_fn=collate)
-                self.loader.sampler.replacement = False
-                self.iter = iter(self.loader)
-
-            try:
-                return next(self.iter)
-            except StopIteration:
-                self.iter = iter(self.loader)
-                return next(self.iter)
-            
+            indices = np.random.choice(len(self), min(self.batch, len(self)), replace=False)
+        else:
+            indices = self.frames.next_indices()
+        return self.frames.get_batch(indices), self.frames.get_batch((indices+1) % len(self))
             
+
 @torch.no_grad()
 def choose_action(actor, env, action_noise=0):
     action = actor(env._get_obs(**OBS_CONFIG).to(device)).data.cpu().numpy()
@@ -447,8 +429,8 @@ if __name__ == '__main__':
 
     trajs = defaultdict(list)
     bbuf_traj = TrajectoryReplayBuffer(BATCH)
-    bbuf_free = GlobalReplayBuffer(BATCH)
-    bbuf_danger = GlobalReplayBuffer(BATCH)
+    bbuf_free = GraphReplayBuffer(BATCH)
+    bbuf_danger = GraphReplayBuffer(BATCH)
 
     for epoch_i in range(N_TRAJ):
 
@@ -518,9 +500,9 @@ if __name__ == '__main__':
 
         for obs in bbuf.obs_buf:
             if obs['prev_danger'].bool().any():
-                bbuf_danger.store(obs.clone())
+                bbuf_danger.store(obs)
             else:
-                bbuf_free.store(obs.clone())
+                bbuf_free.store(obs)
             
                 
         unsafe_rates.append(collided.mean())
@@ -568,10 +550,8 @@ if __name__ == '__main__':
             torch.save(actor.state_dict(), ACTOR_PATH)  
             
         t0 = time()
-        while len(bbuf_free.obs_buf) > N_BUFFER:
-            bbuf_free.obs_buf.pop(0)
-        while len(bbuf_danger.obs_buf) > N_BUFFER:
-            bbuf_danger.obs_buf.pop(0)            
+        bbuf_free.drop_oldest(len(bbuf_free) - N_BUFFER)
+        bbuf_danger.drop_oldest(len(bbuf_danger) - N_BUFFER)
         critic.train()
         actor.train()
         pioptimizer.zero_grad()
@@ -598,7 +578,7 @@ if __name__ == '__main__':
                    "relabel_prob": relabel_eps,
                    "n_trans": total_trans,
                    "size/epoch_i": epoch_i,
-                   "size/buffer_free": len(bbuf_free.obs_buf),
-                   "size/buffer_danger": len(bbuf_danger.obs_buf),
+                   "size/buffer_free": len(bbuf_free),
+                   "size/buffer_danger": len(bbuf_danger),
                    "rewards": np.mean(np.sum(rewards, axis=0))})
         
@@ -28,6 +28,7 @@ from collections import defaultdict
 from torch_geometric.data import Data
 from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader as GeoDataLoader
+from pyg_multiagent.buffers import GraphReplayBuffer
 from time import time
 from baselines.ppo_config import *
 from torch.distributions.normal import Normal
@@ -122,8 +123,9 @@ def train_ppo(critic, actor, optimizer, buf, n_iter):
         return loss_pi, pi_info
 
     for _ in range(n_iter):  
-        for data in buf.next_data():
-            data = data.clone().to(device)  
+        buf.new_epoch()
+        for _ in range(0, len(buf), buf.batch):
+            data = buf.next_data().to(device)  
             optimizer.zero_grad()
             loss_v = compute_loss_v(data)
             loss_pi, info = compute_loss_pi(data)
@@ -240,54 +242,32 @@ class GlobalReplayBuffer:
             return self.loader
 
 
-class MyDataset(Dataset):
-    def __init__(self, data, next_data):
-        self.data = data
-        
-    def __getitem__(self, index):
-        xA = self.data[index]
-        xB = self.data[(index+1) if ((index+1) <len(self.data)) else 0]
-        return xA, xB
-    
-    def __len__(self):
-        return len(self.data)            
-
-
-def collate(data_list):
-    batchA = Batch.from_data_list([data[0] for data in data_list])
-    batchB = Batch.from_data_list([data[1] for data in data_list])
-    return batchA, batchB    
-
-
 class TrajectoryReplayBuffer:
+    """
+    (data, next_data) pairs of consecutive stored timesteps (the last one is paired with the first),
+    every timestep is stored once in frames
+    """
     
     def __init__(self, batch=64):
-        self.dataset = MyDataset([], [])
+        self.frames = GraphReplayBuffer(batch)
         self.batch = batch
-        self.loader = None
         
     def append(self, buffer):
-        
-        new_buff = GlobalReplayBuffer()
-        for idx, obs in enumerate(buffer.obs_buf):
-            clone_obs = obs.clone()
-            self.dataset.data.append(clone_obs)
+        for obs in buffer.obs_buf:
+            self.frames.store(obs)
+    
+    def __len__(self):
+        return len(self.frames)
+    
+    def drop_oldest(self, k):
+        self.frames.drop_oldest(k)
                 
     def next_data(self):
         if SHARE_SAMPLE_ACROSS_UPDATE:
-            return collate([self.dataset[idx] for idx in np.random.choice(len(self.dataset), min(self.batch, len(self.dataset)),
-                              replace=False)])
-        else:        
-            if self.loader is None:
-                self.loader = DataLoader(self.dataset, shuffle=True, batch_size=self.batch, collate_fn=collate)
-                self.loader.sampler.replacement = False
-                self.iter = iter(self.loader)
-
-            try:
-                return next(self.iter)
-            except StopIteration:
-                self.iter = iter(self.loader)
-                return next(self.iter)
+            indices = np.random.choice(len(self), min(self.batch, len(self)), replace=False)
+        else:
+            indices = self.frames.next_indices()
+        return self.frames.get_batch(indices), self.frames.get_batch((indices+1) % len(self))
             
 
 def choose_action(actor, data):
@@ -470,7 +450,7 @@ if __name__ == '__main__':
     pointer = 0
 
     trajs = defaultdict(list)
-    bbuf_all = GlobalReplayBuffer(BATCH)
+    bbuf_all = GraphReplayBuffer(BATCH)
 
     for epoch_i in range(N_TRAJ):
 
@@ -557,8 +537,9 @@ if __name__ == '__main__':
                 bbuf.obs_buf[-1]['finished'] = torch.tensor([False for _ in range(env.num_agents)])
 
         bbuf.relabel(v)
-        for o in bbuf.obs_buf:
-            bbuf_all.store(o.clone())
+        # the training buffer keeps the first N_BUFFER timesteps
+        for o in bbuf.obs_buf[:max(N_BUFFER-len(bbuf_all), 0)]:
+            bbuf_all.store(o)
         
         
         unsafe_rates.append(collided.mean())
@@ -602,9 +583,8 @@ if __name__ == '__main__':
                 best_unsafe_rate = running_unsafe_rate
                 torch.save(actor.state_dict(), ACTOR_PATH)  
 
-        if (len(bbuf_all.obs_buf) >= N_BUFFER):
+        if (len(bbuf_all) >= N_BUFFER):
             
-            bbuf_all.obs_buf = bbuf_all.obs_buf[:N_BUFFER]
             t0 = time()
             critic.train()
             actor.train()
@@ -612,7 +592,7 @@ if __name__ == '__main__':
             pointer = 0
             wandb.log({'time/training': time()-t0})
             
-            bbuf_all = GlobalReplayBuffer()
+            bbuf_all = GraphReplayBuffer()
             
             torch.save(actor.state_dict(), ACTOR_PATH.replace('.pt', '_current.pt'))
             
@@ -629,7 +609,7 @@ if __name__ == '__main__':
                    "nominal_eps": nominal_eps,
                    "relabel_prob": relabel_eps,
                    "n_trans": total_trans,
-                   "size/bbuf": len(bbuf_all.obs_buf),
+                   "size/bbuf": len(bbuf_all),
                    "size/epoch_i": epoch_i,
                    "rewards": np.mean(np.sum(rewards, axis=0))})
         
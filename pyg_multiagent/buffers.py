@@ -0,0 +1,370 @@
+import heapq
+import numpy as np
+import torch
+from torch_geometric.data import Batch, HeteroData
+
+
+# number of samples the columns are allocated for before they first grow
+INITIAL_SAMPLES = 64
+# which sample a full GraphReplayBuffer removes when a new one is stored
+EVICTIONS = ('fifo', 'reservoir', 'priority')
+
+
+class Column:
+    """
+    One attribute of all samples of a GraphReplayBuffer, stored in slots: the value of the
+    sample in slot s is the rows starts[s]:starts[s]+lengths[s] of one preallocated tensor.
+
+    A slot keeps its rows (sizes[s] of them) when its sample is replaced, so a new value is
+    written over the old one in place unless it is longer, then it gets new rows after the
+    used ones. The rows left behind are reclaimed by a compaction once they are half of the
+    used rows, so storing is amortized constant time and the storage stays bounded.
+    """
+
+    def __init__(self, value, n_slots):
+        self.data = value.new_empty((max(len(value), 1)*INITIAL_SAMPLES,)+tuple(value.shape[1:]))
+        self.starts = np.zeros(n_slots, dtype=np.int64)
+        self.lengths = np.zeros(n_slots, dtype=np.int64)
+        self.sizes = np.zeros(n_slots, dtype=np.int64)
+        self.end = 0  # rows in use, the holes included
+        self.allocated = 0  # rows owned by the slots
+
+    def write(self, slot, value):
+        n = len(value)
+        if n > self.sizes[slot]:
+            if self.end + n > len(self.data):
+                self._reserve(n)
+            self.allocated += n - self.sizes[slot]
+            self.starts[slot], self.sizes[slot] = self.end, n
+            self.end += n
+        self.data[self.starts[slot]:self.starts[slot]+n] = value
+        self.lengths[slot] = n
+
+    def _reserve(self, n):
+        """
+        Makes room for n rows after the used ones.
+        """
+        if 2*(self.end - self.allocated) >= self.end:
+            # only the rows of the stored values are kept, the empty slots lose theirs
+            rows, lengths = self.rows(np.arange(len(self.lengths)))
+            used = int(lengths.sum())
+            data = self.data.new_empty((max(len(self.data), 2*(used+n)),)+tuple(self.data.shape[1:]))
+            data[:used] = self.data[rows]
+            self.starts, self.sizes = np.cumsum(lengths) - lengths, lengths.copy()
+            self.data, self.end, self.allocated = data, used, used
+        if self.end + n > len(self.data):
+            data = self.data.new_empty((max(2*len(self.data), self.end+n),)+tuple(self.data.shape[1:]))
+            data[:self.end] = self.data[:self.end]
+            self.data = data
+
+    def rows(self, slots):
+        """
+        Returns the rows of the given slots, concatenated, and the number of rows of every slot.
+        """
+        starts = self.starts[slots]
+        lengths = self.lengths[slots]
+        # start of the slot repeated for each of its rows, plus the position of the row in the slot
+        rows = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        return torch.from_numpy(rows), lengths
+
+    def gather(self, slots):
+        rows, lengths = self.rows(slots)
+        return self.data[rows], lengths
+
+    def set(self, slot, value):
+        assert len(value) == self.lengths[slot]
+        self.data[self.starts[slot]:self.starts[slot]+len(value)] = value
+
+    def release(self, slots):
+        self.lengths[slots] = 0
+
+    def reorder(self, order, n_slots):
+        """
+        Moves slot order[i] to slot i and extends the slots to n_slots, the rows do not move.
+        """
+        for name in ('starts', 'lengths', 'sizes'):
+            array = np.zeros(n_slots, dtype=np.int64)
+            array[:len(order)] = getattr(self, name)[order]
+            setattr(self, name, array)
+
+
+class ObjectColumn:
+    """
+    A per-sample attribute that is not a tensor (e.g. 'finished'), batched like Batch does:
+    numbers (bool, int, float) into a tensor, anything else into a list.
+    """
+
+    def __init__(self, value, n_slots):
+        self.data = [None]*n_slots
+
+    def write(self, slot, value):
+        self.data[slot] = value
+
+    def gather(self, slots):
+        values = [self.data[slot] for slot in slots]
+        if len(values) and isinstance(values[0], (int, float)):
+            return torch.tensor(values), None
+        return values, None
+
+    def set(self, slot, value):
+        self.data[slot] = value
+
+    def release(self, slots):
+        for slot in np.atleast_1d(slots):
+            self.data[slot] = None
+
+    def reorder(self, order, n_slots):
+        self.data = [self.data[slot] for slot in order] + [None]*(n_slots-len(order))
+
+
+class GraphReplayBuffer:
+    """
+    Struct-of-arrays replay buffer of HeteroData observations.
+
+    Every attribute (node features, edge indices, edge attributes, per-agent labels such as
+    'prev_free', 'next_danger' or 'action') of all stored samples lives in one Column, batches
+    are assembled by slicing the columns instead of collating HeteroData objects. Edge indices
+    are stored per sample and shifted by the node counts when batched, as in Batch.from_data_list.
+
+    All samples should have the same attributes.
+
+    The samples are kept in a ring of slots: sample i (0 is the oldest) is in slot (head+i) % n_slots.
+    With a capacity the ring has capacity slots from the start, and storing into a full buffer
+    overwrites the slot of one sample in place, chosen by eviction:
+        'fifo': the oldest sample, the head moves by one
+        'reservoir': a uniformly random one among all samples ever stored (the new one included,
+                     then nothing is stored), so the buffer stays a uniform sample of the whole history
+        'priority': the oldest sample with the smallest priority, the sum of its priority_attr
+                    (e.g. the number of agents labelled next_danger), so boundary samples are kept;
+                    the candidates are kept in a heap
+    so a store costs the same however full the buffer is. With reservoir and priority the new sample
+    takes the index of the evicted one, the indices are no longer in storing order.
+    The shuffled iteration of next_data carries on across evictions, removed samples are skipped.
+    """
+
+    def __init__(self, batch=64, capacity=None, eviction='fifo', priority_attr='next_danger'):
+        assert eviction in EVICTIONS, 'unknown eviction: {}'.format(eviction)
+        self.batch = batch
+        self.capacity = capacity
+        self.eviction = eviction
+        self.priority_attr = priority_attr
+        self.columns = None
+        self.n_slots = capacity if capacity is not None else INITIAL_SAMPLES
+        self.head = 0
+        self.n = 0
+        self.n_seen = 0
+        self.stamps = np.full(self.n_slots, -1, dtype=np.int64)  # when the sample of every slot was stored, -1 if empty
+        self.priorities = np.zeros(self.n_slots)
+        self._heap = []  # (priority, stamp, slot), entries of replaced samples or changed priorities are stale
+        self._order = None  # (slot, stamp) of the samples of the current epoch
+        self._cursor = 0
+
+    @staticmethod
+    def _items(data):
+        for store in data.stores:
+            for attr, value in store.items():
+                if attr == 'edge_index':
+                    value = value.t()
+                yield (store._key, attr), value
+
+    def store(self, data):
+        """
+        Append one observation to the buffer.
+        expected keys: 'prev_free', 'next_free', 'prev_danger', 'next_danger', 'action', ...
+        """
+        items = dict(self._items(data))
+        if self.columns is None:
+            self.columns = {key: (Column(value, self.n_slots) if torch.is_tensor(value) else ObjectColumn(value, self.n_slots))
+                            for key, value in items.items()}
+        assert items.keys() == self.columns.keys(), 'all samples should have the same attributes'
+        priority = self._priority(items.get((None, self.priority_attr)))
+        self.n_seen += 1
+
+        if self.n_slots == 0:
+            return
+        if (self.capacity is None) or (self.n < self.capacity):
+            if self.n == self.n_slots:
+                self._grow()
+            slot = (self.head + self.n) % self.n_slots
+            self.n += 1
+        else:
+            slot = self._evict(priority)
+            if slot is None:
+                return
+
+        for key, value in items.items():
+            self.columns[key].write(slot, value)
+        self.stamps[slot] = self.n_seen
+        self._set_priority(slot, priority)
+
+    @staticmethod
+    def _priority(value):
+        if not torch.is_tensor(value):
+            return 0.
+        return float(value.sum())
+
+    def _set_priority(self, slot, priority):
+        self.priorities[slot] = priority
+        if self.eviction != 'priority':
+            return
+        heapq.heappush(self._heap, (priority, self.stamps[slot], slot))
+        if len(self._heap) > 2*self.n_slots:
+            live = np.flatnonzero(self.stamps >= 0)
+            self._heap = list(zip(self.priorities[live], self.stamps[live], live))
+            heapq.heapify(self._heap)
+
+    def _evict(self, priority):
+        """
+        Slot of the sample a full buffer replaces by a new one of the given priority,
+        None if the new sample is the one evicted.
+        """
+        if self.eviction == 'fifo':
+            slot = self.head
+            self.head = (self.head + 1) % self.n_slots
+            return slot
+        if self.eviction == 'reservoir':
+            # the new sample takes a random slot with probability capacity/n_seen
+            index = np.random.randint(self.n_seen)
+            if index >= self.capacity:
+                return None
+            return (self.head + index) % self.n_slots
+        while True:
+            oldest_priority, stamp, slot = self._heap[0]
+            if (self.stamps[slot] == stamp) and (self.priorities[slot] == oldest_priority):
+                break
+            heapq.heappop(self._heap)
+        # the new sample is the newest, it is evicted only if its priority is strictly the smallest
+        if priority < oldest_priority:
+            return None
+        heapq.heappop(self._heap)
+        return slot
+
+    def _grow(self):
+        """
+        Doubles the slots of a full buffer without capacity, the ring is unrolled so that the head is slot 0.
+        """
+        order = (self.head + np.arange(self.n_slots)) % self.n_slots
+        n_slots = 2*self.n_slots
+        for column in self.columns.values():
+            column.reorder(order, n_slots)
+        self.stamps = np.concatenate((self.stamps[order], np.full(n_slots-self.n_slots, -1, dtype=np.int64)))
+        self.priorities = np.concatenate((self.priorities[order], np.zeros(n_slots-self.n_slots)))
+        if self._order is not None:
+            self._order[:, 0] = (self._order[:, 0] - self.head) % self.n_slots
+        if self._heap:
+            self._heap = [(priority, stamp, (slot - self.head) % self.n_slots) for priority, stamp, slot in self._heap]
+            heapq.heapify(self._heap)
+        self.head, self.n_slots = 0, n_slots
+
+    def _slots(self, indices):
+        return (self.head + np.asarray(indices, dtype=np.int64)) % self.n_slots
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.n
+        if not (0 <= index < self.n):
+            raise IndexError(index)
+        return self.get_batch([index], batch_vectors=False)
+
+    def get_batch(self, indices, batch_vectors=True):
+        """
+        Returns the given samples as the Batch that Batch.from_data_list would build from them:
+        node stores carry 'batch' and 'ptr' vectors, non-tensor attributes are collated by
+        ObjectColumn, and to_data_list / get_example work.
+        Without batch_vectors, a single sample is returned as a plain HeteroData.
+        """
+        slots = self._slots(indices)
+        out = Batch(_base_cls=HeteroData) if batch_vectors else HeteroData()
+        slices, increments = {}, {}
+        node_counts = {}
+        for (key, attr), column in self.columns.items():
+            if attr == 'x':
+                node_counts[key] = column.lengths[slots]
+
+        for (key, attr), column in self.columns.items():
+            value, lengths = column.gather(slots)
+            if lengths is None:
+                lengths = np.ones(len(slots), dtype=np.int64)
+            increment = torch.zeros(len(slots), dtype=torch.long)
+            if attr == 'edge_index':
+                src, _, dst = key
+                increment = torch.from_numpy(np.stack((np.cumsum(node_counts[src]) - node_counts[src],
+                                                       np.cumsum(node_counts[dst]) - node_counts[dst]), axis=-1))
+                value = value.t() + increment.repeat_interleave(torch.from_numpy(lengths), dim=0).t()
+                increment = increment.unsqueeze(-1)
+            elif isinstance(column, ObjectColumn):
+                if not batch_vectors:
+                    value = column.data[slots[0]]
+                elif not torch.is_tensor(value):
+                    increment = None
+            if key is None:
+                out[attr] = value
+                slices[attr] = torch.from_numpy(np.concatenate(([0], np.cumsum(lengths))))
+                increments[attr] = increment
+            else:
+                out[key][attr] = value
+                slices.setdefault(key, {})[attr] = torch.from_numpy(np.concatenate(([0], np.cumsum(lengths))))
+                increments.setdefault(key, {})[attr] = increment
+
+        if batch_vectors:
+            for key, counts in node_counts.items():
+                out[key].batch = torch.arange(len(slots)).repeat_interleave(torch.from_numpy(counts))
+                out[key].ptr = torch.from_numpy(np.concatenate(([0], np.cumsum(counts))))
+            out._num_graphs = len(slots)
+            out._slice_dict = slices
+            out._inc_dict = increments
+        return out
+
+    def set_label(self, index, attr, value):
+        """
+        Overwrites the per-sample attribute attr (e.g. 'next_danger') of the sample index.
+        """
+        slot = self._slots(index)
+        self.columns[(None, attr)].set(slot, value)
+        if attr == self.priority_attr:
+            self._set_priority(slot, self._priority(value))
+
+    def drop_oldest(self, k):
+        """
+        Removes the k oldest samples (the k first indices), the head of the ring moves by k.
+        """
+        k = min(k, self.n)
+        if k <= 0:
+            return
+        slots = self._slots(np.arange(k))
+        for column in self.columns.values():
+            column.release(slots)
+        self.stamps[slots] = -1
+        self.head = (self.head + k) % self.n_slots
+        self.n -= k
+
+    def new_epoch(self):
+        slots = self._slots(np.random.permutation(self.n))
+        self._order = np.stack((slots, self.stamps[slots]), axis=-1)
+        self._cursor = 0
+
+    def next_indices(self):
+        """
+        Indices of the next batch, iterating over shuffled epochs without replacement.
+        The samples removed since the epoch started are skipped, the ones stored since wait for the next epoch.
+        """
+        assert self.n > 0, 'the buffer is empty'
+        slots = []
+        n_found = 0
+        while n_found < self.batch:
+            if (self._order is None) or (self._cursor >= len(self._order)):
+                if n_found:
+                    break
+                self.new_epoch()
+            order = self._order[self._cursor:self._cursor+self.batch-n_found]
+            self._cursor += len(order)
+            order = order[self.stamps[order[:, 0]] == order[:, 1]]
+            slots.append(order[:, 0])
+            n_found += len(order)
+        return (np.concatenate(slots) - self.head) % self.n_slots
+
+    def next_data(self):
+        return self.get_batch(self.next_indices())
@@ -36,11 +36,19 @@ THRESHOLD = 1e-1
 LIE_DERIVE_SAFE = True
 SPATIAL_PROP = False
 n_candidates = 2000
+CANDIDATE_CHUNK = None  # score the candidates in chunks of this size, None: all at once
+ADAPTIVE_CANDIDATES = None  # e.g. dict(n_coarse=250, n_refine=250, top_k=8, sigma=0.1, min_feasible=10), None: n_candidates uniform candidates
+CANDIDATE_BUDGET = None  # e.g. dict(n_isolated=32, max_factor=4): few candidates for agents without neighbours, the rest for the others
+CANDIDATE_BANK = None  # e.g. dict(method='sobol', shift=True): n_candidates low-discrepancy candidates shared by all agents
+WARM_START = None  # e.g. dict(top_k=16, n_perturb=3, sigma=0.05): infer reuses the best candidates of the previous step
+ANYTIME = None  # e.g. dict(deadline=0.05, chunk_size=250): infer scores candidates until the deadline (seconds per step), SPATIAL_PROP is then off
 
 # dataset
 TRAIN_ON_HARD = False
 N_DATASET = 10
 N_VALID_DATASET = 50
+N_SCENARIO_POOL = 0  # > 0: create_env draws from this many pre-generated worlds
+SCENARIO_POOL_PATH = None  # .npz file the pool is loaded from, or saved to after generating it
 MAX_VISIT_TIME = 1000
 
 # relabel
@@ -58,6 +66,7 @@ N_BUFFER = 0
 N_DYNAMIC_BUFFER = 3000
 N_TRAJ_BUFFER = 60000
 N_CBUF = 10000
+BUFFER_EVICTION = 'fifo'  # 'fifo', 'reservoir' or 'priority' (keeps the samples with the most next_danger agents)
 
 # training speed & validation
 N_EVALUATE = 400
@@ -75,6 +84,7 @@ ENV_CONFIG = {
     'SIZE': (3,3),
     'agent_top_k': 2,
     'obstacle_top_k': 2,
+    'max_degree': 32,  # neighbours per agent and edge type in the radius graphs (rgraph_a / rgraph_o)
     'PROB': (0.,30),
     'angle_embed': True,
     'simple': False,
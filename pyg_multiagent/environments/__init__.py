@@ -4,4 +4,6 @@ from .gym_dubins_car import DubinsCarEnv
 from .gym_dynamic_dubins import DynamicDubinsEnv
 from .gym_dynamic_dubins_multi import MultiDynamicDubinsEnv
 from .gym_point import PointEnv
-from .gym_ur5 import UR5Env
\ No newline at end of file
+from .gym_ur5 import UR5Env
+from .gym_batched import BatchedEnv
+from .scenarios import Scenario, ScenarioPool, ScenarioStore
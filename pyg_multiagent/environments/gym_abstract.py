@@ -7,14 +7,14 @@ import copy
 import numpy as np
 from scipy.spatial.distance import cdist
 import torch
-from torch_cluster import radius, radius_graph, knn_graph, knn
 from torch_geometric.loader import NeighborLoader
 from torch_geometric.data import Data, HeteroData
-from scipy.linalg import block_diag
 from torch_sparse import SparseTensor
 # from torch_geometric.utils import index_to_mask
 from functools import reduce
-from .utils import less_or_equal
+from .utils import less_or_equal_mask
+from .neighbors import NeighborIndex, nearest_per_target, nearest_other_group, radius_knn_graph
+from .sampling import sample_grids, add_obstacle_cells, sample_edge_subsets
 
 neighbor_sample = torch.ops.torch_sparse.neighbor_sample
 
@@ -23,15 +23,59 @@ AGENT_TOP_K = 6
 OBSTACLE_TOP_K = 2
 AGENT_OBS_RADIUS = 2.0
 OBSTACLE_OBS_RADIUS = 2.0
+# at most this many neighbours of each type per agent in the radius graphs, the nearest ones
+MAX_DEGREE = 32
 AGENT_DISTANCE_THRESHOLD = 0.3
 OBSTACLE_DISTANCE_THRESHOLD = 0.3
 GOAL_THRESHOLD = 0.45
+# column of the edge type one-hot of the share_weight edge features
+EDGE_TYPE_COLUMN = {'a_near_a': 0, 'o_near_a': 1, 'toward': 2}
+
+
+STATUS_DTYPE = np.dtype([('danger_agent', bool), ('danger_obstacle', bool), ('safe', bool), 
+                         ('done', bool), ('free', bool), 
+                         ('nearest_agent', float), ('nearest_obstacle', float)])
+
+
+def status_from_distances(distance_nearest_agent, distance_nearest_obs, dist2goal, 
+                          obstacle_threshold, agent_threshold, goal_threshold):
+    """
+    Computes the status record of every agent from its distance to the nearest 
+    agent, the nearest obstacle and its goal. Works for any leading shape.
+    """
+    status = np.zeros(np.shape(dist2goal), dtype=STATUS_DTYPE)
+    status['nearest_agent'] = distance_nearest_agent
+    status['nearest_obstacle'] = distance_nearest_obs
+    status['danger_obstacle'] = less_or_equal_mask(distance_nearest_obs, obstacle_threshold)
+    status['danger_agent'] = less_or_equal_mask(distance_nearest_agent, agent_threshold)
+    status['safe'] = (less_or_equal_mask(0.1+obstacle_threshold, distance_nearest_obs) 
+                      & less_or_equal_mask(0.1+agent_threshold, distance_nearest_agent))
+    status['done'] = less_or_equal_mask(dist2goal, goal_threshold)
+    status['free'] = ~(status['danger_obstacle'] | status['danger_agent'])
+    return status
+
+
+def status_to_strings(status):
+    # legacy per-agent status strings, e.g. 'danger_obstacledanger_agent' or 'safedonefree'
+    strings = ['' for _ in range(len(status))]
+    for key in ['danger_obstacle', 'danger_agent', 'safe', 'done', 'free']:
+        strings = [s+key if flag else s for s, flag in zip(strings, status[key])]
+    return strings
+
+
+def is_status_masks(status):
+    return isinstance(status, np.ndarray) and (status.dtype.names is not None)
 
 
 class AbstractState(ABC):
     def __init__(self, world0, goals, space_dim, state_dim, 
                  obstacle_threshold, agent_threshold, goal_threshold,
-                 num_agents=1, prob=0.,keep_sample_obs=False):
+                 num_agents=1, prob=0.,keep_sample_obs=False, neighbor_backend='auto', scenario=None):
+        """
+        Args:
+            neighbor_backend: 'dense', 'kdtree' or 'auto', see NeighborIndex
+            scenario: Scenario whose obstacles, agents and goals are used instead of scanForAgents
+        """
         assert(len(world0.shape) == 2 and world0.shape==goals.shape)
         self.state = world0.copy()
         self.goals = goals.copy()
@@ -41,40 +85,78 @@ class AbstractState(ABC):
         self.state_dim = state_dim
         self.obstacle_threshold, self.agent_threshold, self.goal_threshold = obstacle_threshold, agent_threshold, goal_threshold
         self.keep_sample_obs = keep_sample_obs
-        self.obstacles, self.agents, self.agent_goals = self.scanForAgents()
+        self.neighbor_backend = neighbor_backend
+        if scenario is None:
+            self.obstacles, self.agents, self.agent_goals = self.scanForAgents()
+        else:
+            self.obstacles, self.agents, self.agent_goals = scenario.obstacles, scenario.agents, scenario.agent_goals
         self.obstacles = np.array(self.obstacles).astype(float)
         self.agent_goals = np.array(self.agent_goals).astype(float)
         self.agents = np.array(self.agents).astype(float)
         assert(self.agents.shape == (num_agents, state_dim))
 
+    @property
+    def obstacles(self):
+        return self._obstacles
+
+    @obstacles.setter
+    def obstacles(self, obstacles):
+        # obstacles never move, the cached tensor and index are only dropped when they are replaced
+        self._obstacles = obstacles
+        self._obstacle_tensor = None
+        self._obstacle_index = None
+
+    def _obstacle_array(self):
+        if len(self.obstacles) == 0:
+            return np.zeros((0, 2))
+        return np.asarray(self.obstacles, dtype=float)
+
+    @property
+    def obstacle_tensor(self):
+        """
+        The obstacles as a FloatTensor, converted once per world.
+        """
+        if self._obstacle_tensor is None:
+            self._obstacle_tensor = torch.FloatTensor(self._obstacle_array())
+        return self._obstacle_tensor
+
+    @property
+    def obstacle_index(self):
+        """
+        NeighborIndex over the obstacle positions, built once per world.
+        """
+        if self._obstacle_index is None:
+            self._obstacle_index = NeighborIndex(self._obstacle_array()[:, :2], self.neighbor_backend)
+        return self._obstacle_index
+
     @abstractmethod
     def scanForAgents(self):
         pass
     
-    def get_status(self):
-        status = []
-        agents = np.array(self.agents)
+    def get_status_masks(self):
+        """
+        Returns a structured array of shape (num_agents,) with dtype STATUS_DTYPE:
+        boolean masks 'danger_agent', 'danger_obstacle', 'safe', 'done', 'free' and
+        the distances 'nearest_agent', 'nearest_obstacle'.
+        """
+        agents = np.asarray(self.agents)
         obstacles = self.obstacles
         if len(agents) > 1:
-            distance = cdist(agents[:, :self.space_dim], agents[:, :self.space_dim])
-            distance_nearest_agent = np.sort(distance, axis=-1)[:, 1]    
+            # the nearest entry is the agent itself
+            distance_nearest_agent = NeighborIndex(agents[:, :self.space_dim], self.neighbor_backend).nearest(agents[:, :self.space_dim], k=2)
         else:
             distance_nearest_agent = 100*np.ones((len(self.agents),))
         if len(obstacles) > 0:
-            distance_obs = cdist(agents[:, :2], np.array(obstacles)[:, :2])
-            distance_nearest_obs = np.min(distance_obs, axis=-1)
+            distance_nearest_obs = self.obstacle_index.nearest(agents[:, :2])
         else:
             distance_nearest_obs = 100*np.ones((len(self.agents),))
-        dist2goal = np.linalg.norm(np.array(self.agents[:, :self.space_dim])-np.array(self.agent_goals[:, :self.space_dim]), axis=-1)
+        dist2goal = np.linalg.norm(self.agents[:, :self.space_dim]-self.agent_goals[:, :self.space_dim], axis=-1)
 
-        status = ['' for _ in range(self.num_agents)]
-        status = [s+'danger_obstacle' if less_or_equal(d, self.obstacle_threshold) else s for s, d in zip(status, distance_nearest_obs)]
-        status = [s+'danger_agent' if less_or_equal(d, self.agent_threshold) else s for s, d in zip(status, distance_nearest_agent)]
-        status = [s+'safe' if (less_or_equal(0.1+self.obstacle_threshold, d1) and less_or_equal(0.1+self.agent_threshold, d2)) else s for s, d1, d2 in zip(status, distance_nearest_obs, distance_nearest_agent)]
-        status = [s+'done' if less_or_equal(d, self.goal_threshold) else s for s, d in zip(status, dist2goal)]
-        status = [s+'free' if ('danger' not in s) else s for s in status]
-        
-        return status
+        return status_from_distances(distance_nearest_agent, distance_nearest_obs, dist2goal,
+                                     self.obstacle_threshold, self.agent_threshold, self.goal_threshold)
+    
+    def get_status(self):
+        return status_to_strings(self.get_status_masks())
 
     @abstractmethod
     def sample_agents(self, n_agents, prob=0.1):
@@ -82,7 +164,9 @@ class AbstractState(ABC):
 
     def done(self, status=None):
         if status is None:
-            status = self.get_status()
+            status = self.get_status_masks()
+        if is_status_masks(status):
+            return bool(status['done'].all())
         return np.sum(['done' in s for s in status])==len(self.agents)
 
 
@@ -94,13 +178,22 @@ class AbstractEnv(ABC):
                  SIZE=(10,40), PROB=(0,.5), simple=False,
                  agent_top_k=None,obstacle_top_k=None, angle_embed=False,
                  obstacle_threshold=None, agent_threshold=None, 
-                 goal_threshold=None, agent_obs_radius=None, obstacle_obs_radius=None,
+                 goal_threshold=None, agent_obs_radius=None, obstacle_obs_radius=None, max_degree=None,
                  min_dist=None, max_dist=None, hetero=True,
-                 keep_sample_obs=False,):
+                 keep_sample_obs=False, neighbor_backend='auto',
+                 incremental_obs=False, verlet_skin=0.5, scenario=None,):
         """
         Args:
             SIZE: size of a side of the square grid
             PROB: range of probabilities that a given block is an obstacle
+            max_degree: number of nearest agents / obstacles within the radius an agent is connected 
+                to in the radius graphs (rgraph_a / rgraph_o), np.inf for all of them
+            neighbor_backend: nearest-neighbour backend of the status and the potential field
+                ('dense', 'kdtree' or 'auto', see NeighborIndex)
+            incremental_obs: reuse the last next_o of step as the next prev_o and keep
+                Verlet neighbour lists for the observation edges
+            verlet_skin: margin added to the observation radii of the Verlet lists
+            scenario: pre-generated world to start from (see ScenarioPool), sampled if None
         """
         # Initialize member variables
         if agent_top_k is None:
@@ -117,6 +210,8 @@ class AbstractEnv(ABC):
             agent_obs_radius = AGENT_OBS_RADIUS
         if obstacle_obs_radius is None:
             obstacle_obs_radius = OBSTACLE_OBS_RADIUS
+        if max_degree is None:
+            max_degree = MAX_DEGREE
         
         self.agent_top_k = agent_top_k
         self.obstacle_top_k = obstacle_top_k
@@ -137,8 +232,16 @@ class AbstractEnv(ABC):
         self.goal_threshold = goal_threshold
         self.agent_obs_radius = agent_obs_radius
         self.obstacle_obs_radius = obstacle_obs_radius
+        self.max_degree = max_degree
         self.hetero = hetero
         self.keep_sample_obs = keep_sample_obs
+        self.neighbor_backend = neighbor_backend
+        self.incremental_obs = incremental_obs
+        self.verlet_skin = verlet_skin
+        self._obs_cache = None
+        self._verlet_cache = None
+        self._lookahead_out = None
+        self._edge_layouts = {}
         
         if min_dist is None:
             self.min_dist = float('-inf')
@@ -150,7 +253,7 @@ class AbstractEnv(ABC):
             self.max_dist = max_dist
         
         # Initialize data structures
-        self._setWorld()
+        self._setWorld(scenario)
 
     def isConnected(self,world0):
         sys.setrecursionlimit(10000)
@@ -182,7 +285,11 @@ class AbstractEnv(ABC):
     def getObstacleMap(self):
         return (self.world.state==-1).astype(int)
     
-    def _setWorld(self):
+    def _setWorld(self, scenario=None):
+        if scenario is not None:
+            self._setState(scenario.world, scenario.goals, scenario.prob, scenario=scenario)
+            return
+        
         def getConnectedRegion(world,regions_dict,x,y):
             sys.setrecursionlimit(1000000)
             '''returns a list of tuples of connected squares to the given tile
@@ -209,71 +316,50 @@ class AbstractEnv(ABC):
             regions_dict[(x,y)]=visited
             return visited
 
-        #RANDOMIZE THE POSITIONS OF AGENTS
-        x = np.random.rand(10, 10)
-        positions = np.where(x<0.5)
-        idx = np.random.choice(len(positions[0]), size=(10,), replace=False)
-        x[np.vstack(positions)[:,idx][0], np.vstack(positions)[:,idx][1]] = 0        
-        
         size=np.random.choice(np.arange(self.SIZE[0], self.SIZE[1]+1))
+        try:
+            prob=np.random.uniform(self.PROB[0],self.PROB[1])
+        except:
+            prob=self.PROB[0]        
+        
+        if not self.connected:
+            #RANDOMIZE THE POSITIONS OF AGENTS, THEIR GOALS AND THE STATIC OBSTACLES
+            world, goals = sample_grids(1, int(size), self.num_agents, prob=prob, simple=self.simple,
+                                        min_dist=self.min_dist, max_dist=self.max_dist)
+            self._setState(world[0], goals[0], prob)
+            return
+        
+        #RANDOMIZE THE POSITIONS OF AGENTS
         world = np.zeros(shape=(int(size),int(size))).astype(int)
         
         positions = np.where(world==0)
         idx = np.random.choice(len(positions[0]), size=(self.num_agents,), replace=False)
         world[np.vstack(positions)[:,idx][0], np.vstack(positions)[:,idx][1]] = np.arange(1,1+self.num_agents)
+        agent_locations = np.vstack(positions)[:,idx].T
         
         #RANDOMIZE THE GOALS OF AGENTS
         goals = np.zeros(world.shape).astype(int)
-        if self.connected:
-            goal_counter = 1
-            agent_regions=dict()     
-            while goal_counter<=self.num_agents:
-                agent_pos=agent_locations[goal_counter-1]
-                valid_tiles=getConnectedRegion(world,agent_regions,agent_pos[0],agent_pos[1])
-                x,y  = random.choice(list(valid_tiles))
-                if(goals[x,y]==0 and world[x,y]!=-1):
-                    goals[x,y]    = goal_counter
-                    goal_counter += 1
-        else:  
-            for agent_id in range(1,self.num_agents+1):
-                
-                positions = np.where((world!=-1) & (goals==0))
-                agent_pos=np.vstack(np.where(world==agent_id)).reshape(-1,1)
-                valid_tiles = np.vstack(positions)
-                dist2s = np.linalg.norm(valid_tiles-agent_pos, axis=0)
-                good_tiles = (dist2s <= self.max_dist) & (dist2s >= self.min_dist)
-                if good_tiles.sum() > 0:
-                    x, y = random.choice(list(valid_tiles[:,good_tiles].T))
-                    goals[x,y] = agent_id
-                else:
-                    # choose the nearest goal
-                    idx = np.argsort(dist2s)[0]
-                    x, y = valid_tiles[:,idx]
-                    goals[x,y] = agent_id
-
-            
-            # idx = np.random.choice(len(positions[0]), size=(self.num_agents,), replace=False)
-            # goals[np.vstack(positions)[:,idx][0], np.vstack(positions)[:,idx][1]] = np.arange(1,1+self.num_agents)
-          
-        try:
-            prob=np.random.uniform(self.PROB[0],self.PROB[1])
-        except:
-            prob=self.PROB[0]        
+        goal_counter = 1
+        agent_regions=dict()     
+        while goal_counter<=self.num_agents:
+            agent_pos=agent_locations[goal_counter-1]
+            valid_tiles=getConnectedRegion(world,agent_regions,agent_pos[0],agent_pos[1])
+            x,y  = random.choice(list(valid_tiles))
+            if(goals[x,y]==0 and world[x,y]!=-1):
+                goals[x,y]    = goal_counter
+                goal_counter += 1
         
         #RANDOMIZE THE STATIC OBSTACLES
-        obs_world = -(np.random.rand(int(size),int(size))<prob).astype(int)
-        if self.simple:
-            obs_world[np.meshgrid(np.arange(start=0,stop=int(size),step=2),np.arange(start=1,stop=int(size),step=2))] = 0
-            obs_world[np.meshgrid(np.arange(start=1,stop=int(size),step=2),np.arange(start=0,stop=int(size),step=2))] = 0
-        obs_world[world!=0] = 0
-        obs_world[goals!=0] = 0
-        world = world + obs_world              
-            
+        world = add_obstacle_cells(world[None], goals[None], prob, self.simple)[0]
+        self._setState(world, goals, prob)
+    
+    def _setState(self, world, goals, prob, scenario=None):
         self.initial_world = world
         self.initial_goals = goals
         self.world = self.absState(world,goals,self.space_dim,self.state_dim,
                                    self.obstacle_threshold,self.agent_threshold,self.goal_threshold,
-                                   prob=prob,num_agents=self.num_agents,keep_sample_obs=self.keep_sample_obs)
+                                   prob=prob,num_agents=self.num_agents,keep_sample_obs=self.keep_sample_obs,
+                                   neighbor_backend=self.neighbor_backend, scenario=scenario)
 
         
     def _get_obs_lidar(self):
@@ -288,107 +374,134 @@ class AbstractEnv(ABC):
         if lidar:
             return self._get_obs_lidar()
         
-        a2a_index, a2a_attr, o2a_index, o2a_attr, g2a_index, g2a_attr = None, None, None, None, None, None
-        agent_pos = torch.FloatTensor(self.world.agents)
-        agent_origin_pos = torch.FloatTensor(self.world.agents)
+        a2a_index, o2a_index = None, None
+        if self.incremental_obs:
+            a2a_index, o2a_index = self._get_verlet_edges(loop=loop, rgraph_a=rgraph_a, rgraph_o=rgraph_o)
+        elif len(self.world.obstacles) != 0:
+            o2a_index = self._get_obstacle_edges(self.max_degree if rgraph_o else self.obstacle_top_k)
         
-        if self.angle_embed:
-            agent_angle = agent_pos[:,-self.angle_dim:]
-            if self.angle_dim ==0:
-                pass
-            elif self.angle_dim==1:
-                agent_pos = torch.cat((agent_pos[:,:-self.angle_dim], torch.sin(agent_angle), torch.cos(agent_angle)), dim=-1)
-            elif self.angle_dim==3:
-                alpha = agent_angle[:,[0]]
-                beta = agent_angle[:,[1]]
-                gamma = agent_angle[:,[2]]
-                agent_pos = torch.cat((agent_pos[:,:-self.angle_dim], 
-                                       torch.sin(alpha), torch.cos(alpha), torch.sin(beta), torch.cos(beta)), dim=-1)
-                                       
-                                               # torch.cos(beta)*torch.cos(gamma),
-                                               # torch.cos(beta)*torch.sin(gamma),
-                                               # -torch.sin(beta),
-                                               # torch.sin(alpha)*torch.sin(beta)*torch.cos(gamma)-torch.cos(alpha)*torch.sin(gamma),
-                                               # torch.sin(alpha)*torch.sin(beta)*torch.sin(gamma)+torch.cos(alpha)*torch.cos(gamma),
-                                               # torch.sin(alpha)*torch.cos(beta)), dim=-1)
-            else:
-                assert False
-                
-        feature_len_max = 3 + self.space_dim + (agent_pos.shape[1]-self.space_dim)*2        
+        return self._build_obs(self.world.agents, self.world.agent_goals, self.world.obstacle_tensor,
+                               loop=loop, clip=clip, has_goal=has_goal, share_weight=share_weight,
+                               rgraph_a=rgraph_a, rgraph_o=rgraph_o, 
+                               a2a_index=a2a_index, o2a_index=o2a_index)
+    
+    def _get_verlet_edges(self, loop=False, rgraph_a=False, rgraph_o=False):
+        """
+        Verlet neighbour lists of the observation graph. The candidate pairs within 
+        obs_radius + verlet_skin are kept across steps and only rebuilt once an agent 
+        moved more than verlet_skin/2 since, so every pair that is within obs_radius 
+        now is a candidate. Returns the same a2a and o2a edges as _build_obs.
+        """
+        agents = np.asarray(self.world.agents)[:, :self.space_dim]
+        obstacles = self.world.obstacles
+        agent_pos = torch.FloatTensor(agents)
+        key = (loop, len(agents), self.agent_obs_radius, self.obstacle_obs_radius, self.verlet_skin)
+        
+        cache = self._verlet_cache
+        if (cache is None) or (cache['key'] != key) or (cache['obstacles'] is not obstacles) or \
+           (np.linalg.norm(agents-cache['agents'], axis=-1).max(initial=0) > self.verlet_skin/2):
+            a_candidates = radius_knn_graph(agents, agents, self.agent_obs_radius+self.verlet_skin, 
+                                            loop=loop, backend=self.neighbor_backend)
+            o_candidates = self._get_obstacle_edges(None, r=self.obstacle_obs_radius+self.verlet_skin)
+            cache = {'key': key, 'obstacles': obstacles, 'agents': agents.copy(), 
+                     'a2a': a_candidates, 'o2a': o_candidates}
+            self._verlet_cache = cache
+        
+        a2a_index = cache['a2a']
+        distance = (agent_pos[a2a_index[0]] - agent_pos[a2a_index[1]]).norm(dim=-1)
+        within = distance<=self.agent_obs_radius
+        a2a_index = nearest_per_target(a2a_index[:, within], distance[within], len(agents), 
+                                       self.max_degree if rgraph_a else self.agent_top_k)
+        
+        o2a_index = None
+        if len(obstacles) != 0:
+            o2a_index = cache['o2a']
+            obstacle_pos = self.world.obstacle_tensor[:,:2]
+            distance = (obstacle_pos[o2a_index[0]] - agent_pos[o2a_index[1],:2]).norm(dim=-1)
+            within = distance<=self.obstacle_obs_radius
+            o2a_index = nearest_per_target(o2a_index[:, within], distance[within], len(agents), 
+                                           self.max_degree if rgraph_o else self.obstacle_top_k)
+        
+        return a2a_index, o2a_index
+    
+    def _get_obstacle_edges(self, k, r=None):
+        """
+        o2a edges queried from the static obstacle index of the world: the k nearest 
+        obstacles within r of every agent, nearest first (all of them if k is None).
+        """
+        if r is None:
+            r = self.obstacle_obs_radius
+        agents = np.asarray(self.world.agents)[:, :2]
+        agent_ids, obstacle_ids, _ = self.world.obstacle_index.query_nearest(agents, r, k)
+        return torch.from_numpy(np.stack([obstacle_ids, agent_ids])).long()
+    
+    def _pop_cached_obs(self, obs_config):
+        """
+        Returns a copy of the last next_o of step if the world has not changed since, else None.
+        """
+        cache, self._obs_cache = self._obs_cache, None
+        if cache is None:
+            return None
+        if (cache['obs_config'] != obs_config) or (cache['obstacles'] is not self.world.obstacles) or \
+           (not np.array_equal(cache['agents'], self.world.agents)) or \
+           (not np.array_equal(cache['agent_goals'], self.world.agent_goals)):
+            return None
+        return copy.copy(cache['data'])
+    
+    def _build_obs(self, agents, agent_goals, obstacles, agent_batch=None, obstacle_batch=None,
+                   loop=False, clip=True, has_goal=False, share_weight=False, 
+                   rgraph_a=False, rgraph_o=False, a2a_index=None, o2a_index=None):
+        """
+        Builds the observation graph from raw arrays.
         
-        if rgraph_a:
-            a2a_index = radius_graph(agent_pos[:,:self.space_dim], r=self.agent_obs_radius, loop=loop)
+        Args:
+            agents: (n_agents, state_dim) agent states
+            agent_goals: (n_agents, goal_dim) goal of each agent
+            obstacles: (n_obstacles, 2) obstacle positions, array or FloatTensor
+            agent_batch, obstacle_batch: optional world index of every agent / obstacle, 
+                edges are only built inside the same world (used by BatchedEnv)
+            a2a_index, o2a_index: optional precomputed edges (see _get_verlet_edges)
+        
+        Every agent is connected to its nearest agents (obstacles) within the observation radius, 
+        at most max_degree of them with rgraph_a (rgraph_o), else agent_top_k (obstacle_top_k).
+        """
+        
+        num_agents = len(agents)
+        agent_origin_pos = torch.FloatTensor(agents)
+        agent_pos = self._embed_angles(agent_origin_pos)
+        
+        if a2a_index is not None:
+            pass
         else:
-            a2a_index = knn_graph(agent_pos[:,:self.space_dim], self.agent_top_k, loop=loop)
-            pairs = torch.FloatTensor(self.world.agents[:,:self.space_dim])[a2a_index]
-            distance = (pairs[0] - pairs[1]).norm(dim=-1)
-            a2a_index = a2a_index[:, distance<=self.agent_obs_radius]
-        a2a_attr = (agent_pos[a2a_index[0,:]]-agent_pos[a2a_index[1,:]])[:,:self.space_dim]
-        a2a_attr = torch.cat((agent_pos[a2a_index[0,:]][:,self.space_dim:], agent_pos[a2a_index[1,:]][:,self.space_dim:], a2a_attr), dim=-1)
-
-        if share_weight:
-            one_hot = np.array([[1,0,0]]*len(a2a_attr))
-            a2a_attr = torch.cat((torch.FloatTensor(one_hot), a2a_attr), dim=-1)
+            a2a_index = radius_knn_graph(agents[:,:self.space_dim], agents[:,:self.space_dim], self.agent_obs_radius, 
+                                         self.max_degree if rgraph_a else self.agent_top_k, 
+                                         agent_batch, agent_batch, loop=loop, backend=self.neighbor_backend)
 
-        if len(self.world.obstacles) != 0:
-            obstacle_pos = torch.FloatTensor(self.world.obstacles)
-            if rgraph_o:
-                indexes = radius(agent_pos[:,:2], obstacle_pos[:,:2], r=self.obstacle_obs_radius)
-            else:
-                indexes = knn(obstacle_pos[:,:2], agent_pos[:,:2], self.obstacle_top_k).flip(0)
-                distance = (obstacle_pos[indexes[0],:2] - agent_pos[indexes[1],:2]).norm(dim=-1)
-                indexes = indexes[:, distance<=self.obstacle_obs_radius]
-            o2a_index = indexes
-            o2a_attr = obstacle_pos[o2a_index[0,:]][:,:2]-agent_pos[o2a_index[1,:]][:,:2]
-            if self.space_dim > 2:
-                o2a_attr = torch.cat((o2a_attr, torch.zeros(len(agent_pos[o2a_index[1,:]]), self.space_dim-2),
-                                      agent_pos[o2a_index[1,:]][:,self.space_dim:]), dim=-1)
+        if len(obstacles) != 0:
+            obstacle_pos = obstacles if torch.is_tensor(obstacles) else torch.FloatTensor(obstacles)
+            if o2a_index is not None:
+                pass
             else:
-                o2a_attr = torch.cat((agent_pos[o2a_index[1,:]][:,self.space_dim:], 
-                                  o2a_attr), dim=-1)
-            
-            if share_weight:
-                one_hot = np.array([[0,1,0]]*len(o2a_attr))
-                o2a_attr = torch.cat((torch.FloatTensor(one_hot), o2a_attr), dim=-1)
-
+                o2a_index = radius_knn_graph(obstacle_pos[:,:2], agents[:,:2], self.obstacle_obs_radius, 
+                                             self.max_degree if rgraph_o else self.obstacle_top_k, 
+                                             obstacle_batch, agent_batch, backend=self.neighbor_backend)
         else:
             obstacle_pos = torch.zeros(0,2)
             o2a_index = torch.zeros(2,0).long()
-            o2a_attr = torch.zeros(0,3+2+(agent_pos.shape[1]-self.space_dim))
-            
         
-        goals = self.world.agent_goals.copy()
+        goals = agent_goals.copy()
         if clip:
-            goals[:,:self.space_dim] = (goals[:,:self.space_dim]-self.world.agents[:,:self.space_dim]).clip(-6, 6)+self.world.agents[:,:self.space_dim]
+            goals[:,:self.space_dim] = (goals[:,:self.space_dim]-agents[:,:self.space_dim]).clip(-6, 6)+agents[:,:self.space_dim]
         
         goal_pos = torch.FloatTensor(goals)
-        g2a_index = torch.arange(self.num_agents).unsqueeze(0).repeat(2, 1).long()
-        g2a_attr = goal_pos[g2a_index[0,:]][:,:self.space_dim]-agent_pos[g2a_index[1,:]][:,:self.space_dim]
-        g2a_attr = torch.cat((agent_pos[g2a_index[1,:]][:,self.space_dim:], g2a_attr), dim=-1)
-
-        if share_weight:
-            one_hot = np.array([[0,0,1]]*self.num_agents)
-            g2a_attr = torch.cat((torch.FloatTensor(one_hot), g2a_attr), dim=-1)
-        
-        if share_weight:
-            # padding zero
-            for attr_str in ['a2a_attr', 'o2a_attr', 'g2a_attr']:
-                attr = eval(attr_str)
-                if (attr is not None) and (attr.shape[1] < feature_len_max):
-                    out = torch.cat((attr, torch.zeros(len(attr), feature_len_max-attr.shape[1])), dim=-1)
-                    if attr_str=='a2a_attr':
-                        a2a_attr = out
-                    elif attr_str=='o2a_attr':
-                        o2a_attr = out
-                    elif attr_str=='g2a_attr':
-                        g2a_attr = out
+        g2a_index = torch.arange(num_agents).unsqueeze(0).repeat(2, 1).long()
         
         # assign label to agents
-        agent_x = torch.zeros(self.num_agents, 3)
+        agent_x = torch.zeros(num_agents, 3)
         agent_x[:, 0] = 1
-        obstacle_x = torch.zeros(len(self.world.obstacles), 3)
+        obstacle_x = torch.zeros(len(obstacles), 3)
         obstacle_x[:, 1] = 1
-        goal_x = torch.zeros(self.num_agents, 3)
+        goal_x = torch.zeros(num_agents, 3)
         goal_x[:, 2] = 1
         
         if self.hetero:
@@ -396,109 +509,129 @@ class AbstractEnv(ABC):
             data['agent'].x, data['goal'].x = agent_x, goal_x
             data['agent'].pos, data['goal'].pos = agent_origin_pos, goal_pos
             data['agent', 'a_near_a', 'agent'].edge_index = a2a_index
-            data['agent', 'a_near_a', 'agent'].edge_attr = a2a_attr
+            data['agent', 'a_near_a', 'agent'].edge_attr = self._edge_features('a_near_a', agent_pos, a2a_index, 
+                                                                               share_weight=share_weight)
             data['goal', 'toward', 'agent'].edge_index = g2a_index
-            data['goal', 'toward', 'agent'].edge_attr = g2a_attr              
+            data['goal', 'toward', 'agent'].edge_attr = self._edge_features('toward', agent_pos, g2a_index, 
+                                                                            goal_pos, share_weight)
             
             data['obstacle'].x = obstacle_x
             data['obstacle'].pos = obstacle_pos
             data['obstacle', 'o_near_a', 'agent'].edge_index = o2a_index
-            data['obstacle', 'o_near_a', 'agent'].edge_attr = o2a_attr          
+            data['obstacle', 'o_near_a', 'agent'].edge_attr = self._edge_features('o_near_a', agent_pos, o2a_index, 
+                                                                                  obstacle_pos, share_weight)
         else:
+            # the edges of all the types are packed in one edge_attr, written type after type
             data = Data()
+            edges = [('a_near_a', a2a_index, None, 0), ('o_near_a', o2a_index, obstacle_pos, len(agent_x))]
+            data.x = torch.cat((agent_x, obstacle_x), dim=0)
             if has_goal:
+                edges.append(('toward', g2a_index, goal_pos, len(agent_x) + len(obstacle_x)))
                 data.x = torch.cat((agent_x, obstacle_x, goal_x), dim=0)
-                o2a_index[0, :] = o2a_index[0, :] + len(agent_x)
-                g2a_index[0, :] = g2a_index[0, :] + len(agent_x) + len(obstacle_x)
-                data.edge_index = torch.cat((a2a_index, o2a_index, g2a_index), dim=1)
-                data.edge_attr = torch.cat((a2a_attr, o2a_attr, g2a_attr), dim=0)
-            else:
-                data.x = torch.cat((agent_x, obstacle_x), dim=0)
-                o2a_index[0, :] = o2a_index[0, :] + len(agent_x)
-                data.edge_index = torch.cat((a2a_index, o2a_index), dim=1)
-                data.edge_attr = torch.cat((a2a_attr, o2a_attr), dim=0)
+            layout = self._edge_layout(agent_pos.shape[1]-self.space_dim, share_weight)
+            widths = {layout[name][0] for name, _, _, _ in edges}
+            assert len(widths) == 1, 'the edge types of a Data observation need the same width (share_weight)'
+            
+            data.edge_index = torch.cat([index + torch.LongTensor([[shift], [0]]) for _, index, _, shift in edges], dim=1)
+            data.edge_attr = agent_pos.new_zeros((data.edge_index.shape[1], widths.pop()))
+            start = 0
+            for name, index, source_pos, _ in edges:
+                self._edge_features(name, agent_pos, index, source_pos, share_weight, 
+                                    out=data.edge_attr[start:start+index.shape[1]])
+                start += index.shape[1]
         
         return data
     
 
-    def obs_from_pos(self, data, agent_pos, loop=False, clip=True, has_goal=False, share_weight=False, rgraph_a=False, rgraph_o=False):
-        
-        assert self.hetero
-        a2a_index, a2a_attr, o2a_index, o2a_attr, g2a_index, g2a_attr = None, None, None, None, None, None
-        
-        data = data.to('cpu')
-        agent_pos = agent_pos.to('cpu')
-        agent_origin_pos = agent_pos.clone()
-        if self.angle_embed:
-            agent_angle = agent_pos[:,-self.angle_dim:]
-            if self.angle_dim ==0:
-                pass
-            elif self.angle_dim==1:
-                agent_pos = torch.cat((agent_pos[:,:-self.angle_dim], torch.sin(agent_angle), torch.cos(agent_angle)), dim=-1)
-            elif self.angle_dim==3:
-                alpha = agent_angle[:,[0]]
-                beta = agent_angle[:,[1]]
-                gamma = agent_angle[:,[2]]
-                agent_pos = torch.cat((agent_pos[:,:-self.angle_dim], 
-                                       torch.sin(alpha), torch.cos(alpha), torch.sin(beta), torch.cos(beta)), dim=-1)
-            else:
-                assert False
-                
-        feature_len_max = 3 + self.space_dim + (agent_pos.shape[1]-self.space_dim)*2        
-                
-        a2a_index = data['agent', 'a_near_a', 'agent'].edge_index
-        a2a_attr = (agent_pos[a2a_index[0,:]]-agent_pos[a2a_index[1,:]])[:,:self.space_dim]
-        a2a_attr = torch.cat((agent_pos[a2a_index[0,:]][:,self.space_dim:], agent_pos[a2a_index[1,:]][:,self.space_dim:], a2a_attr), dim=-1)
-        if share_weight:
-            one_hot = np.array([[1,0,0]]*len(a2a_attr))
-            a2a_attr = torch.cat((torch.FloatTensor(one_hot), a2a_attr), dim=-1)
+    def _embed_angles(self, agent_pos):
+        """
+        Replaces the angles of the agent states by their sin / cos if angle_embed (torch, differentiable).
+        """
+        if (not self.angle_embed) or (self.angle_dim == 0):
+            return agent_pos
+        agent_angle = agent_pos[:,-self.angle_dim:]
+        if self.angle_dim==1:
+            return torch.cat((agent_pos[:,:-self.angle_dim], torch.sin(agent_angle), torch.cos(agent_angle)), dim=-1)
+        elif self.angle_dim==3:
+            alpha = agent_angle[:,[0]]
+            beta = agent_angle[:,[1]]
+            return torch.cat((agent_pos[:,:-self.angle_dim], 
+                              torch.sin(alpha), torch.cos(alpha), torch.sin(beta), torch.cos(beta)), dim=-1)
+        else:
+            assert False
 
-        if 'edge_index' in data['o_near_a']:
-            o2a_index = data['obstacle', 'o_near_a', 'agent'].edge_index
-            obstacle_pos = data['obstacle'].pos
-            o2a_attr = obstacle_pos[o2a_index[0,:]][:,:2]-agent_pos[o2a_index[1,:]][:,:2]
-            if self.space_dim > 2:
-                o2a_attr = torch.cat((o2a_attr, torch.zeros(len(agent_pos[o2a_index[1,:]]), self.space_dim-2),
-                                      agent_pos[o2a_index[1,:]][:,self.space_dim:]), dim=-1)
+    def _edge_layout(self, extra_dim, share_weight):
+        """
+        Width and column slices of the edge features of every edge type, computed once per env.
+        extra_dim is the number of (angle embedded) agent features after the position.
+            'a_near_a': source features, target features, source - target position
+            'o_near_a': target features, obstacle - target position, or with space_dim > 2
+                        obstacle - target position, zeros up to space_dim, target features
+            'toward':   target features, goal - target position
+        With share_weight the columns come after the one-hot of the edge type and all the
+        edge types are zero padded to the same width.
+        """
+        key = (extra_dim, share_weight)
+        if key not in self._edge_layouts:
+            offset = 3 if share_weight else 0
+            e, s = extra_dim, self.space_dim
+            layout = {'a_near_a': (offset+2*e+s, {'src': slice(offset, offset+e), 'dst': slice(offset+e, offset+2*e), 
+                                                  'rel': slice(offset+2*e, offset+2*e+s)})}
+            if s > 2:
+                layout['o_near_a'] = (offset+s+e, {'rel': slice(offset, offset+2), 'dst': slice(offset+s, offset+s+e)})
             else:
-                o2a_attr = torch.cat((agent_pos[o2a_index[1,:]][:,self.space_dim:], 
-                                  o2a_attr), dim=-1)
+                layout['o_near_a'] = (offset+e+2, {'dst': slice(offset, offset+e), 'rel': slice(offset+e, offset+e+2)})
+            layout['toward'] = (offset+e+s, {'dst': slice(offset, offset+e), 'rel': slice(offset+e, offset+e+s)})
             if share_weight:
-                one_hot = np.array([[0,1,0]]*len(o2a_attr))
-                o2a_attr = torch.cat((torch.FloatTensor(one_hot), o2a_attr), dim=-1)
-        
-        goal_pos = data['goal'].pos
-        g2a_index = data['goal', 'toward', 'agent'].edge_index
-        g2a_attr = goal_pos[g2a_index[0,:]][:,:self.space_dim]-agent_pos[g2a_index[1,:]][:,:self.space_dim]
-        g2a_attr = torch.cat((agent_pos[g2a_index[1,:]][:,self.space_dim:], g2a_attr), dim=-1)
-        if share_weight:
-            one_hot = np.array([[0,0,1]]*len(g2a_attr))
-            g2a_attr = torch.cat((torch.FloatTensor(one_hot), g2a_attr), dim=-1)
-        
+                feature_len_max = 3 + s + 2*e
+                layout = {name: (feature_len_max, parts) for name, (_, parts) in layout.items()}
+            self._edge_layouts[key] = layout
+        return self._edge_layouts[key]
+
+    def _edge_features(self, name, agent_pos, index, source_pos=None, share_weight=False, out=None):
+        """
+        Features of the edges index (source, target agent) of type name ('a_near_a', 'o_near_a' or 'toward'),
+        written in one tensor with the layout of _edge_layout. agent_pos is angle embedded, source_pos are the
+        obstacle / goal positions of 'o_near_a' / 'toward'. On the device of agent_pos and differentiable.
+        out: zero filled rows to write the features to (e.g. a slice of a packed edge_attr), allocated if None
+        """
+        width, parts = self._edge_layout(agent_pos.shape[1]-self.space_dim, share_weight)[name]
+        target = agent_pos[index[1]]
+        if out is None:
+            out = agent_pos.new_zeros((index.shape[1], width))
         if share_weight:
-            # padding zero
-            for attr_str in ['a2a_attr', 'o2a_attr', 'g2a_attr']:
-                attr = eval(attr_str)
-                if (attr is not None) and (attr.shape[1] < feature_len_max):
-                    out = torch.cat((attr, torch.zeros(len(attr), feature_len_max-attr.shape[1])), dim=-1)
-                    if attr_str=='a2a_attr':
-                        a2a_attr = out
-                    elif attr_str=='o2a_attr':
-                        o2a_attr = out
-                    elif attr_str=='g2a_attr':
-                        g2a_attr = out 
-        
-        if self.hetero:
-            data['agent'].pos, data['goal'].pos = agent_origin_pos, goal_pos
-            data['agent', 'a_near_a', 'agent'].edge_attr = a2a_attr
-            data['goal', 'toward', 'agent'].edge_attr = g2a_attr              
-            if 'edge_index' in data['o_near_a']:
-                data['obstacle'].pos = obstacle_pos
-                data['obstacle', 'o_near_a', 'agent'].edge_attr = o2a_attr          
+            out[:, EDGE_TYPE_COLUMN[name]] = 1
+        out[:, parts['dst']] = target[:, self.space_dim:]
+        if name == 'a_near_a':
+            source = agent_pos[index[0]]
+            out[:, parts['src']] = source[:, self.space_dim:]
+            out[:, parts['rel']] = (source-target)[:, :self.space_dim]
+        elif name == 'o_near_a':
+            out[:, parts['rel']] = source_pos[index[0]][:, :2]-target[:, :2]
         else:
-            assert False
+            out[:, parts['rel']] = source_pos[index[0]][:, :self.space_dim]-target[:, :self.space_dim]
+        return out
+
+    def obs_from_pos(self, data, agent_pos, loop=False, clip=True, has_goal=False, share_weight=False, rgraph_a=False, rgraph_o=False):
+        """
+        Moves the agents of the observation data to agent_pos and recomputes its edge features, the edges
+        are kept. Works on the device of data and keeps the gradient w.r.t. agent_pos (e.g. from dynamic_torch).
+        """
+        assert self.hetero
+        data['agent'].pos = agent_pos
+        agent_pos = self._embed_angles(agent_pos)
         
-        return data.to('cuda:0')
+        a2a_index = data['agent', 'a_near_a', 'agent'].edge_index
+        data['agent', 'a_near_a', 'agent'].edge_attr = self._edge_features('a_near_a', agent_pos, a2a_index, 
+                                                                           share_weight=share_weight)
+        if 'edge_index' in data['o_near_a']:
+            o2a_index = data['obstacle', 'o_near_a', 'agent'].edge_index
+            data['obstacle', 'o_near_a', 'agent'].edge_attr = self._edge_features('o_near_a', agent_pos, o2a_index, 
+                                                                                  data['obstacle'].pos, share_weight)
+        g2a_index = data['goal', 'toward', 'agent'].edge_index
+        data['goal', 'toward', 'agent'].edge_attr = self._edge_features('toward', agent_pos, g2a_index, 
+                                                                        data['goal'].pos, share_weight)
+        return data
     
     def sample_edge(self, edge_index, k, target_node_size):
         adj = SparseTensor.from_edge_index(edge_index)
@@ -568,6 +701,63 @@ class AbstractEnv(ABC):
 
                 if cover_a and cover_o:
                     break
+
+    def _get_obs_random_k_batch(self, loop=False, clip=True, has_goal=False, share_weight=True, rgraph_a=True, rgraph_o=True,
+                                n_sub_o=None, n_sub_a=None, iteration=None, **kwargs):
+        """
+        The subgraphs of _get_obs_random_k as one batched HeteroData, with the layout of
+        Batch.from_data_list (node stores carry a 'batch' vector, data['agent'].n_id is the agent
+        of every agent node). The a_near_a and o_near_a edges of all the subgraphs are sampled at
+        once by sample_edge_subsets, every iteration adds just enough subgraphs to keep every edge once.
+        """
+        if n_sub_o is None:
+            n_sub_o = (2,2)
+        
+        if n_sub_a is None:
+            n_sub_a = (2,2)
+            
+        if iteration is None:
+            iteration = 1
+        
+        data = self._get_obs(loop=loop, clip=clip, share_weight=share_weight, rgraph_a=rgraph_a, rgraph_o=rgraph_o)
+        data['agent'].n_id = torch.arange(self.num_agents)
+        k_ranges = {'a_near_a': n_sub_a, 'o_near_a': n_sub_o}
+        k_ranges = {name: k_range for name, k_range in k_ranges.items() if 'edge_index' in data[name]}
+        targets = {name: data[name].edge_index[1].numpy() for name in k_ranges}
+        
+        sampled = {name: ([], []) for name in k_ranges}
+        n_graphs = 0
+        for _ in range(iteration):
+            n_samples = max([1]+[-(-np.bincount(targets[name]).max(initial=0) // k_ranges[name][0]) for name in k_ranges])
+            draws = {name: sample_edge_subsets(targets[name], self.num_agents, k_ranges[name], n_samples) for name in k_ranges}
+            # the subgraphs of an iteration stop once all the edges of all the types are kept
+            n_cover = max([1]+[draw[2] for draw in draws.values()])
+            for name, (sample_ids, edge_ids, _) in draws.items():
+                kept = sample_ids < n_cover
+                sampled[name][0].append(sample_ids[kept] + n_graphs)
+                sampled[name][1].append(edge_ids[kept])
+            n_graphs += n_cover
+        
+        batch = HeteroData()
+        for store in data.node_stores:
+            for attr, value in store.items():
+                batch[store._key][attr] = value.repeat((n_graphs,)+(1,)*(value.dim()-1))
+            batch[store._key].batch = torch.arange(n_graphs).repeat_interleave(store.num_nodes)
+        for store in data.edge_stores:
+            src, name, dst = store._key
+            if name in sampled:
+                sample_ids, edge_ids = (np.concatenate(ids) for ids in sampled[name])
+            else:
+                sample_ids = np.repeat(np.arange(n_graphs), store.num_edges)
+                edge_ids = np.tile(np.arange(store.num_edges), n_graphs)
+            sample_ids, edge_ids = torch.from_numpy(sample_ids), torch.from_numpy(edge_ids)
+            for attr, value in store.items():
+                if attr == 'edge_index':
+                    increment = torch.stack((sample_ids*data[src].num_nodes, sample_ids*data[dst].num_nodes))
+                    batch[store._key][attr] = value[:, edge_ids] + increment
+                else:
+                    batch[store._key][attr] = value[edge_ids]
+        return batch
     
     
 #     # Returns an observation of an agent
@@ -604,11 +794,13 @@ class AbstractEnv(ABC):
 #         return data, affected_nodes, prefer_nodes, edge_mask
 
     # Resets environment
-    def _reset(self):
+    def _reset(self, scenario=None):
         self.finished = False
+        self._obs_cache = None
+        self._verlet_cache = None
 
         # Initialize data structures
-        self._setWorld()
+        self._setWorld(scenario)
 
     # Executes an action by an agent
     def step(self, action_input, obs_config=None, bound=False):
@@ -618,8 +810,10 @@ class AbstractEnv(ABC):
         if obs_config is None:
             obs_config = {}
         
-        prev_status = self.world.get_status()
-        prev_o = self._get_obs(**obs_config)
+        prev_status = self.world.get_status_masks()
+        prev_o = self._pop_cached_obs(obs_config) if self.incremental_obs else None
+        if prev_o is None:
+            prev_o = self._get_obs(**obs_config)
 
         # Check action input
 
@@ -635,74 +829,75 @@ class AbstractEnv(ABC):
 
         # Perform observation
         next_o = self._get_obs(**obs_config) 
+        if self.incremental_obs:
+            self._obs_cache = {'obs_config': dict(obs_config), 'obstacles': self.world.obstacles, 
+                               'agents': self.world.agents.copy(), 'agent_goals': np.copy(self.world.agent_goals),
+                               'data': copy.copy(next_o)}
 
         # Done?
-        next_status = self.world.get_status()
+        next_status = self.world.get_status_masks()
         done = self.world.done(status=next_status)
         
         self.finished |= done
         
-        rewards = [-10*('danger_agent' in s)-10*('danger_obstacle' in s) for s in next_status]
-        rewards = np.array(rewards) + 10*displacement + 10*done - 0.1
+        rewards = -10*next_status['danger_agent'] - 10*next_status['danger_obstacle']
+        rewards = rewards + 10*displacement + 10*done - 0.1
 
         info = {
                 "action": action_input,
-                "prev_free": ['free' in s for s in prev_status],
-                "prev_safe": ['safe' in s for s in prev_status],
-                "prev_danger": ['free' not in s for s in prev_status],
-                "next_goal": ['done' in s for s in next_status],
-                "next_free": ['free' in s for s in next_status],
-                "next_danger": ['free' not in s for s in next_status],
-                "prev_obstacle": ['obstacle' in s for s in prev_status],
-                "prev_agent": ['agent' in s for s in prev_status],
-                "meet_obstacle": ['obstacle' in s for s in next_status],
-                "meet_agent": ['agent' in s for s in next_status],
+                "prev_free": prev_status['free'],
+                "prev_safe": prev_status['safe'],
+                "prev_danger": ~prev_status['free'],
+                "next_goal": next_status['done'],
+                "next_free": next_status['free'],
+                "next_danger": ~next_status['free'],
+                "prev_obstacle": prev_status['danger_obstacle'],
+                "prev_agent": prev_status['danger_agent'],
+                "meet_obstacle": next_status['danger_obstacle'],
+                "meet_agent": next_status['danger_agent'],
                 "rewards": rewards,
                 }
         for key, value in info.items():
-            prev_o[key] = torch.FloatTensor(value)
+            prev_o[key] = torch.FloatTensor(np.asarray(value, dtype=float))
 
         return next_o, rewards, done, prev_o
         
 
-    def potential_field(self, actions, K1, K2, ignore_agent=False):
+    def potential_field(self, actions, K1, K2, ignore_agent=False, agent_ids=None, others=None):
         
-        # size of actions: (num_agents, n_candidates, action_dim)
+        # size of actions: (num_agents, n_candidates, action_dim), or (len(agent_ids), n_candidates, action_dim)
+        # for the agents agent_ids only. The agent term compares the candidate next positions with those of the
+        # other agents, or with others (num_agents, n_others, space_dim), e.g. fixed positions for the agents not scored
         
-        assert actions.shape[0]==self.num_agents
+        if agent_ids is None:
+            agent_ids = np.arange(self.num_agents)
+        assert actions.shape[0]==len(agent_ids)
         assert actions.shape[-1]==self.action_dim
-        n_candidates = actions.shape[1]
-        
-        origin_pos = np.copy(self.world.agents)
-        next_pos = np.expand_dims(origin_pos, 1)
-        next_pos = np.tile(next_pos, (1, n_candidates, 1)) # num_agents x n_candidates x state_dim
+        assert (others is not None) or (len(agent_ids)==self.num_agents) or ignore_agent or (K1==0)
+        n_agents, n_candidates = actions.shape[:2]
         
-        next_pos = self.dynamic(next_pos.reshape(-1, self.state_dim), actions.reshape(-1, self.action_dim))
-        next_pos = next_pos.reshape((self.num_agents, n_candidates, self.state_dim))
+        next_pos = self.lookahead(actions, agents=np.asarray(self.world.agents)[agent_ids])  # n_agents x n_candidates x state_dim
         
-        goal_dim = len(self.world.agent_goals[0])
-        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(self.world.agent_goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # num_agents x n_candidates
+        goals = np.asarray(self.world.agent_goals)[agent_ids]
+        goal_dim = goals.shape[-1]
+        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # n_agents x n_candidates
         
         if K1==0:
             score = -K2 * goal_force.reshape(-1)
-            score = score.reshape(self.num_agents, n_candidates)
+            score = score.reshape(n_agents, n_candidates)
             return score
         
         if (len(self.world.obstacles)!=0):
-            dist2obs = cdist(self.world.obstacles, next_pos.reshape(-1, self.state_dim)[:, :2]).min(axis=0)  # (num_agents x n_candidates)
+            dist2obs = self.world.obstacle_index.nearest(next_pos.reshape(-1, self.state_dim)[:, :2])  # (n_agents x n_candidates)
         else:
-            dist2obs = 100 * np.ones((self.num_agents * n_candidates))
+            dist2obs = 100 * np.ones((n_agents * n_candidates))
         
         if ignore_agent:
             dist = dist2obs
         else:
-            dist = cdist(next_pos.reshape(-1, self.state_dim)[:, :self.space_dim], next_pos.reshape(-1, self.state_dim)[:, :self.space_dim]) # (num_agents x n_candidates, num_agents x n_candidates)
-            A = np.ones((n_candidates, n_candidates))
-            eye = block_diag(*[A for _ in range(self.num_agents)])
-            dist = dist * (1-eye) + 1000 * eye
-            dist = dist.reshape(n_candidates*self.num_agents, self.num_agents, n_candidates)
-            dist = dist.min(axis=-1)  # (num_agents x n_candidates) x num_agents
-            dist = dist.min(axis=-1)  # (num_agents x n_candidates)
+            # the own candidates of an agent are 1000 away, as with the former block diagonal mask
+            dist = nearest_other_group(next_pos[:, :, :self.space_dim], others, agent_ids)
+            dist = np.minimum(dist.reshape(-1), 1000)  # (n_agents x n_candidates)
             dist = np.minimum(dist2obs, dist)
         dist = dist*(dist>0.1)+0.1*(dist<0.1)  # numerical stability
         D = self.obstacle_threshold + 0.1
@@ -710,7 +905,7 @@ class AbstractEnv(ABC):
         obs_force = (obs_force)*(dist < D)
         
         score = K1 * obs_force - K2 * goal_force.reshape(-1)
-        score = score.reshape(self.num_agents, n_candidates)
+        score = score.reshape(n_agents, n_candidates)
         return score
     
     
@@ -727,5 +922,40 @@ class AbstractEnv(ABC):
         pass
     
     @abstractmethod
-    def dynamic(self, pos, action):
-        pass
\ No newline at end of file
+    def dynamic(self, pos, action, out=None):
+        """
+        Next states of pos (..., state_dim) under action (..., action_dim), the leading dims are
+        broadcast against each other. out is reused for the result if it has the right shape and dtype.
+        """
+        pass
+
+    @staticmethod
+    def _next_state_buffer(pos, action, out=None, dtype=None):
+        """
+        Result array of a dynamic kernel, filled with the states pos broadcast against the leading dims of action.
+        """
+        shape = np.broadcast_shapes(pos.shape[:-1], action.shape[:-1]) + pos.shape[-1:]
+        dtype = pos.dtype if dtype is None else np.dtype(dtype)
+        if (out is None) or (out.shape != shape) or (out.dtype != dtype):
+            out = np.empty(shape, dtype=dtype)
+        out[...] = pos
+        return out
+
+    def lookahead(self, actions, agents=None):
+        """
+        Next states (num_agents, n_candidates, state_dim) of the agents (the current ones by default) under each of
+        their candidate actions (num_agents, n_candidates, action_dim), without tiling the agents.
+        The result lives in a work buffer of the env that the next call overwrites, copy it to keep it.
+        """
+        if agents is None:
+            agents = self.world.agents
+        agents = np.asarray(agents)
+        self._lookahead_out = self.dynamic(agents[:, None, :], actions, out=self._lookahead_out)
+        return self._lookahead_out
+
+    def lookahead_torch(self, pos, actions):
+        """
+        Differentiable lookahead: next states (num_agents, n_candidates, state_dim) of pos (num_agents, state_dim)
+        under actions (num_agents, n_candidates, action_dim), needs a broadcasting dynamic_torch.
+        """
+        return self.dynamic_torch(pos.unsqueeze(-2), actions)
\ No newline at end of file
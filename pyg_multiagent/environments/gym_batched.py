@@ -0,0 +1,225 @@
+import numpy as np
+import torch
+from torch_geometric.data import Batch, HeteroData
+from .gym_abstract import status_from_distances
+
+
+class BatchedEnv:
+    """
+    Steps B worlds of the same environment in lock-step.
+
+    The agents, goals and obstacles of all worlds are kept in padded arrays, the
+    dynamic is called once for all B x num_agents agents, statuses and rewards are
+    computed with array ops and the observation of all worlds is returned as the
+    ``Batch`` that ``Batch.from_data_list`` would collate from the per-world observations
+    (``batch`` and ``ptr`` vectors, ``to_data_list`` / ``get_example`` work).
+
+    Only environments that use the status of ``AbstractState`` are supported
+    (DubinsCarEnv, DroneEnv, MultiDynamicDubinsEnv).
+    """
+
+    def __init__(self, envs=None, env_cls=None, batch_size=None, **env_config):
+        """
+        Args:
+            envs: list of already created environments, or
+            env_cls, batch_size, env_config: create batch_size environments with env_cls(**env_config)
+        """
+        if envs is None:
+            assert (env_cls is not None) and (batch_size is not None)
+            envs = [env_cls(**env_config) for _ in range(batch_size)]
+        assert len(envs) > 0
+        assert all(type(env) is type(envs[0]) for env in envs), 'all worlds should share the same environment class'
+        assert all(env.num_agents == envs[0].num_agents for env in envs), 'all worlds should have the same number of agents'
+        assert envs[0].hetero, 'BatchedEnv only supports hetero observations'
+
+        self.envs = envs
+        self.env = envs[0]  # template providing the dynamic, thresholds and the graph builder
+        self.batch_size = len(envs)
+        self.num_agents = self.env.num_agents
+        self.action_dim = self.env.action_dim
+        self.state_dim = self.env.state_dim
+        self.space_dim = self.env.space_dim
+        self.load_worlds()
+
+    def load_worlds(self):
+        """
+        Copies the worlds of the wrapped environments into the padded arrays.
+        """
+        self.agents = np.stack([env.world.agents for env in self.envs]).astype(float)  # B x num_agents x state_dim
+        self.agent_goals = np.stack([env.world.agent_goals for env in self.envs]).astype(float)  # B x num_agents x goal_dim
+        self.map_sizes = np.array([len(env.world.state) for env in self.envs])
+
+        n_obstacles = np.array([len(env.world.obstacles) for env in self.envs])
+        self.obstacles = np.zeros((self.batch_size, max(n_obstacles.max(), 1), 2))  # B x max_obstacles x 2
+        self.obstacle_mask = np.arange(self.obstacles.shape[1])[None, :] < n_obstacles[:, None]
+        for world_id, env in enumerate(self.envs):
+            if n_obstacles[world_id]:
+                self.obstacles[world_id, :n_obstacles[world_id]] = np.asarray(env.world.obstacles)[:, :2]
+
+        self.agent_batch = torch.arange(self.batch_size).repeat_interleave(self.num_agents)
+        self.obstacle_batch = torch.from_numpy(np.where(self.obstacle_mask)[0]).long()
+        self.finished = np.zeros(self.batch_size, dtype=bool)
+
+    def sync_worlds(self):
+        """
+        Writes the batched agent states back to the wrapped environments (e.g. before rendering).
+        """
+        for world_id, env in enumerate(self.envs):
+            env.world.agents = self.agents[world_id].copy()
+            env.finished = bool(self.finished[world_id])
+
+    def reset(self, world_ids=None):
+        """
+        Regenerates the given worlds (all by default).
+        """
+        if world_ids is None:
+            world_ids = range(self.batch_size)
+        self.sync_worlds()
+        for world_id in world_ids:
+            self.envs[world_id]._reset()
+        self.load_worlds()
+
+    def get_status(self):
+        """
+        Returns the status record (see AbstractState.get_status_masks) of shape (B, num_agents).
+        """
+        env = self.env
+        agents = self.agents
+        if self.num_agents > 1:
+            diff = agents[:, :, None, :env.space_dim] - agents[:, None, :, :env.space_dim]
+            distance = np.linalg.norm(diff, axis=-1)  # B x num_agents x num_agents
+            distance_nearest_agent = np.partition(distance, 1, axis=-1)[:, :, 1]
+        else:
+            distance_nearest_agent = 100*np.ones((self.batch_size, self.num_agents))
+
+        if self.obstacle_mask.any():
+            diff = agents[:, :, None, :2] - self.obstacles[:, None, :, :]
+            distance_obs = np.linalg.norm(diff, axis=-1)  # B x num_agents x max_obstacles
+            distance_obs = np.where(self.obstacle_mask[:, None, :], distance_obs, np.inf)
+            distance_nearest_obs = distance_obs.min(axis=-1)
+            distance_nearest_obs[~self.obstacle_mask.any(axis=-1)] = 100
+        else:
+            distance_nearest_obs = 100*np.ones((self.batch_size, self.num_agents))
+        dist2goal = np.linalg.norm(agents[:, :, :env.space_dim]-self.agent_goals[:, :, :env.space_dim], axis=-1)
+
+        return status_from_distances(distance_nearest_agent, distance_nearest_obs, dist2goal,
+                                     env.obstacle_threshold, env.agent_threshold, env.goal_threshold)
+
+    def done(self, status=None):
+        if status is None:
+            status = self.get_status()
+        return status['done'].all(axis=-1)
+
+    def _get_obs(self, **obs_config):
+        obstacles = self.obstacles[self.obstacle_mask]
+        data = self.env._build_obs(self.agents.reshape(-1, self.state_dim),
+                                   self.agent_goals.reshape(self.batch_size*self.num_agents, -1),
+                                   obstacles,
+                                   agent_batch=self.agent_batch,
+                                   obstacle_batch=self.obstacle_batch if len(obstacles) else None,
+                                   **obs_config)
+        return self._as_batch(data)
+
+    def _as_batch(self, data):
+        """
+        The disjoint union data of the observations of all worlds as a Batch, with the slice and
+        increment dicts of Batch.from_data_list (see GraphReplayBuffer.get_batch).
+        The edges are kept in their order within every world.
+        """
+        node_batch = {'agent': self.agent_batch, 'goal': self.agent_batch, 'obstacle': self.obstacle_batch}
+        out = Batch(_base_cls=HeteroData)
+        slices, increments, ptr = {}, {}, {}
+        for store in data.node_stores:
+            key = store._key
+            counts = torch.bincount(node_batch[key], minlength=self.batch_size)
+            ptr[key] = torch.cat((torch.zeros(1, dtype=torch.long), torch.cumsum(counts, dim=0)))
+            for attr, value in store.items():
+                out[key][attr] = value
+                slices.setdefault(key, {})[attr] = ptr[key]
+                increments.setdefault(key, {})[attr] = torch.zeros(self.batch_size, dtype=torch.long)
+            out[key].batch = node_batch[key]
+            out[key].ptr = ptr[key]
+
+        for store in data.edge_stores:
+            key = store._key
+            src, _, dst = key
+            world = node_batch[dst][store.edge_index[1]]
+            order = torch.argsort(world, stable=True)
+            counts = torch.bincount(world, minlength=self.batch_size)
+            edge_ptr = torch.cat((torch.zeros(1, dtype=torch.long), torch.cumsum(counts, dim=0)))
+            for attr, value in store.items():
+                if attr == 'edge_index':
+                    out[key][attr] = value[:, order]
+                    increments.setdefault(key, {})[attr] = torch.stack((ptr[src][:-1], ptr[dst][:-1]), dim=-1).unsqueeze(-1)
+                else:
+                    out[key][attr] = value[order]
+                    increments.setdefault(key, {})[attr] = torch.zeros(self.batch_size, dtype=torch.long)
+                slices.setdefault(key, {})[attr] = edge_ptr
+
+        out._num_graphs = self.batch_size
+        out._slice_dict = slices
+        out._inc_dict = increments
+        return out
+
+    def step(self, action_input, obs_config=None, bound=False):
+        """
+        Args:
+            action_input: (B, num_agents, action_dim)
+        Returns:
+            next_o, rewards (B, num_agents), done (B,), prev_o with the per-agent labels
+            flattened in the order of the agent nodes
+        """
+        action_input = np.asarray(action_input)
+        assert action_input.shape == (self.batch_size, self.num_agents, self.action_dim), 'Action input should have the form (B, num_agents, action_dim)'
+
+        if obs_config is None:
+            obs_config = {}
+
+        prev_status = self.get_status()
+        prev_o = self._get_obs(**obs_config)
+
+        next_pos = self.env.dynamic(self.agents.reshape(-1, self.state_dim), action_input.reshape(-1, self.action_dim))
+        next_pos = next_pos.reshape(self.agents.shape)
+        dist = np.linalg.norm(self.agents[:, :, :self.space_dim]-self.agent_goals[:, :, :self.space_dim], axis=-1)
+        next_dist = np.linalg.norm(next_pos[:, :, :self.space_dim]-self.agent_goals[:, :, :self.space_dim], axis=-1)
+        displacement = dist - next_dist
+
+        self.agents = next_pos
+
+        if bound:
+            self.agents[:, :, :2] = np.clip(self.agents[:, :, :2], 0, self.map_sizes[:, None, None])
+
+        next_o = self._get_obs(**obs_config)
+
+        next_status = self.get_status()
+        done = self.done(status=next_status)
+
+        self.finished |= done
+
+        rewards = -10*next_status['danger_agent'] - 10*next_status['danger_obstacle']
+        rewards = rewards + 10*displacement + 10*done[:, None] - 0.1
+
+        info = {
+                "action": action_input.reshape(-1, self.action_dim),
+                "prev_free": prev_status['free'],
+                "prev_safe": prev_status['safe'],
+                "prev_danger": ~prev_status['free'],
+                "next_goal": next_status['done'],
+                "next_free": next_status['free'],
+                "next_danger": ~next_status['free'],
+                "prev_obstacle": prev_status['danger_obstacle'],
+                "prev_agent": prev_status['danger_agent'],
+                "meet_obstacle": next_status['danger_obstacle'],
+                "meet_agent": next_status['danger_agent'],
+                "rewards": rewards,
+                }
+        for key, value in info.items():
+            value = np.asarray(value, dtype=float)
+            if key != 'action':
+                value = value.reshape(-1)
+            prev_o[key] = torch.FloatTensor(value)
+            # per-agent labels, collated like those of the per-world observations
+            prev_o._slice_dict[key] = torch.arange(self.batch_size+1)*self.num_agents
+            prev_o._inc_dict[key] = torch.zeros(self.batch_size, dtype=torch.long)
+
+        return next_o, rewards, done, prev_o
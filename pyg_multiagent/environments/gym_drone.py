@@ -8,6 +8,8 @@ from .quad3d import Quad3D
 import torch
 import math
 from .gym_abstract import AbstractState, AbstractEnv
+from .neighbors import nearest_other_group
+from .sampling import sample_obstacles
 import mpl_toolkits.mplot3d.art3d as art3d
 import matplotlib.patches as patches
 from matplotlib.animation import FuncAnimation
@@ -15,7 +17,6 @@ from matplotlib.animation import FFMpegWriter, PillowWriter
 from matplotlib.collections import PatchCollection, EllipseCollection
 from matplotlib.patches import Circle
 from scipy.spatial.distance import cdist
-from scipy.linalg import block_diag
 
 quad3d = Quad3D()
 
@@ -33,7 +34,6 @@ n_candidates = 2000
 class DroneState(AbstractState):
 
     def scanForAgents(self):
-        obstacles = []
         agents = [(-1,-1,0) for i in range(self.num_agents)]     
         agent_goals = [(-1,-1) for i in range(self.num_agents)]        
         for i in range(self.state.shape[0]):
@@ -44,19 +44,7 @@ class DroneState(AbstractState):
                     agent_goals[self.goals[i,j]-1] = [i+0.5,j+0.5, np.random.uniform(0,HEIGHT)]+[0.]*6
         # add random obstacles 
         map_size = len(self.state)
-        new_obstacles = np.random.uniform(0, map_size, size=(int(self.prob*(map_size**2)), 2))
-        distance_agent = cdist(new_obstacles, np.array(agents)[:,:2]).min(axis=-1)
-        distance_goal = cdist(new_obstacles, np.array(agent_goals)[:,:2]).min(axis=-1)        
-        valid = ((distance_goal > GOAL_THRESHOLD) & (distance_agent > (0.1+OBSTACLE_DISTANCE_THRESHOLD)))
-        new_obstacles = new_obstacles[valid]
-        for new_obstacle in new_obstacles:
-            if len(obstacles):
-                distance_obs = cdist([new_obstacle], obstacles).min(axis=-1)
-            else:
-                distance_obs = np.array([float('inf')])
-            valid = (distance_obs > (0.2+2*OBSTACLE_DISTANCE_THRESHOLD))
-            if valid.all():
-                obstacles.append(new_obstacle)
+        obstacles = sample_obstacles(map_size, agents, agent_goals, self.prob, GOAL_THRESHOLD, OBSTACLE_DISTANCE_THRESHOLD)
         
         # NEW CHANGE: the velocities and angles in the states of agents are randomized
         agents = np.array(agents)
@@ -299,57 +287,80 @@ class DroneEnv(AbstractEnv):
     def _render_with_contour(self, xys, values, **kwargs):
         pass
     
-    def dynamic(self, pos, action):
+    def dynamic(self, pos, action, out=None):
+        # 10 euler substeps of quadrotor_dynamics_np, written out per state so that the candidates
+        # of an agent can be broadcast against it and the temporaries are allocated once
+        next_pos = self._next_state_buffer(pos, action, out, dtype=np.result_type(pos, float))
         action = action * 4
-        pos = pos.copy()
+        f, phi_dot, theta_dot, psi_dot = (action[..., i] for i in range(4))
+        work = np.empty((4,)+next_pos.shape[:-1])
+        s_theta, c_theta, s_phi, c_phi = work
         for _ in range(10):
-            pos = pos + 0.01 * quadrotor_dynamics_np(pos, action)
-        pos[:, 3:6] = np.clip(pos[:, 3:6], -1, 1)
-        pos[:, 6:] = np.clip(pos[:, 6:], -math.pi/2, math.pi/2)
-        return pos
+            np.sin(next_pos[..., THETA], out=s_theta)
+            np.cos(next_pos[..., THETA], out=c_theta)
+            np.sin(next_pos[..., PHI], out=s_phi)
+            np.cos(next_pos[..., PHI], out=c_phi)
+            # positions use the velocities and the velocities use the orientations of the previous substep
+            next_pos[..., PX:PZ+1] += 0.01 * next_pos[..., VX:VZ+1]
+            next_pos[..., VX] += 0.01 * (-s_theta * f)
+            next_pos[..., VY] += 0.01 * (c_theta * s_phi * f)
+            next_pos[..., VZ] += 0.01 * (grav + -c_theta * c_phi * f)
+            next_pos[..., PHI] += 0.01 * phi_dot
+            next_pos[..., THETA] += 0.01 * theta_dot
+            next_pos[..., PSI] += 0.01 * psi_dot
+        np.clip(next_pos[..., 3:6], -1, 1, out=next_pos[..., 3:6])
+        np.clip(next_pos[..., 6:], -math.pi/2, math.pi/2, out=next_pos[..., 6:])
+        return next_pos
     
     @staticmethod
     def dynamic_torch(pos, action):
+        # closed form of quad3d.closed_loop_dynamics, broadcasting like dynamic
         action = action * 4
+        m = quad3d.nominal_params['m']
+        shape = torch.broadcast_shapes(pos.shape[:-1], action.shape[:-1])
+        pos, action = pos.expand(shape+pos.shape[-1:]), action.expand(shape+action.shape[-1:])
+        f, phi_dot, theta_dot, psi_dot = action.unbind(-1)
         for _ in range(10):
-            pos = (pos + 0.01 * quad3d.closed_loop_dynamics(pos, action)).clone()
-        new_pos = pos.clone()
-        new_pos[:, 3:6] = torch.clip(pos[:, 3:6], -1, 1)
-        new_pos[:, 6:] = torch.clip(pos[:, 6:], -math.pi/2, math.pi/2)
-        return new_pos
+            px, py, pz, vx, vy, vz, phi, theta, psi = pos.unbind(-1)
+            s_theta, c_theta = torch.sin(theta), torch.cos(theta)
+            s_phi, c_phi = torch.sin(phi), torch.cos(phi)
+            pos = torch.stack((px + 0.01 * vx, py + 0.01 * vy, pz + 0.01 * vz,
+                               vx + 0.01 * (-s_theta / m * f),
+                               vy + 0.01 * (c_theta * s_phi / m * f),
+                               vz + 0.01 * (grav + -c_theta * c_phi / m * f),
+                               phi + 0.01 * phi_dot, theta + 0.01 * theta_dot, psi + 0.01 * psi_dot), dim=-1)
+        return torch.cat((pos[..., :3],
+                          torch.clip(pos[..., 3:6], -1, 1),
+                          torch.clip(pos[..., 6:], -math.pi/2, math.pi/2)), dim=-1)
     
-    def potential_field(self, actions, K1, K2, ignore_agent=False):
+    def potential_field(self, actions, K1, K2, ignore_agent=False, agent_ids=None, others=None):
         
-        # size of actions: (num_agents, n_candidates, action_dim)
+        # size of actions: (num_agents, n_candidates, action_dim), or (len(agent_ids), n_candidates, action_dim),
+        # see AbstractEnv.potential_field
         
-        assert actions.shape[0]==self.num_agents
+        if agent_ids is None:
+            agent_ids = np.arange(self.num_agents)
+        assert actions.shape[0]==len(agent_ids)
         assert actions.shape[-1]==self.action_dim
-        n_candidates = actions.shape[1]
-        origin_pos = np.copy(self.world.agents)
+        assert (others is not None) or (len(agent_ids)==self.num_agents) or ignore_agent or (K1==0)
+        n_agents, n_candidates = actions.shape[:2]
+        origin_pos = np.copy(self.world.agents)[agent_ids]
 
         if K1!=0:
         
-            next_pos = np.expand_dims(origin_pos, 1)
-            next_pos = np.tile(next_pos, (1, n_candidates, 1)) # num_agents x n_candidates x state_dim
-
-            next_pos = self.dynamic(next_pos.reshape(-1, self.state_dim), actions.reshape(-1, self.action_dim))
-            next_pos = next_pos.reshape((self.num_agents, n_candidates, self.state_dim))
+            next_pos = self.lookahead(actions, agents=origin_pos)  # n_agents x n_candidates x state_dim
 
             if len(self.world.obstacles)!=0:
-                dist2obs = cdist(self.world.obstacles, next_pos.reshape(-1, self.state_dim)[:, :2]).min(axis=0)  # (num_agents x n_candidates)
+                dist2obs = self.world.obstacle_index.nearest(next_pos.reshape(-1, self.state_dim)[:, :2])  # (n_agents x n_candidates)
             else:
-                dist2obs = 100 * np.ones((self.num_agents * n_candidates))
+                dist2obs = 100 * np.ones((n_agents * n_candidates))
 
             if ignore_agent:
                 dist = dist2obs
             else:
-                dist = cdist(next_pos.reshape(-1, self.state_dim)[:, :self.space_dim], next_pos.reshape(-1, self.state_dim)[:, :self.space_dim]) # (num_agents x n_candidates, num_agents x n_candidates)
-                A = np.ones((n_candidates, n_candidates))
-                eye = block_diag(*[A for _ in range(self.num_agents)])
-                dist = dist * (1-eye) + 1000 * eye
-                dist = dist.reshape(n_candidates*self.num_agents, self.num_agents, n_candidates)
-                dist = dist.min(axis=-1)  # (num_agents x n_candidates) x num_agents
-                dist = dist.min(axis=-1)  # (num_agents x n_candidates)
+                # the own candidates of an agent are 1000 away, as with the former block diagonal mask
+                dist = nearest_other_group(next_pos[:, :, :self.space_dim], others, agent_ids)
+                dist = np.minimum(dist.reshape(-1), 1000)  # (n_agents x n_candidates)
                 dist = np.minimum(dist2obs, dist)
             dist = dist*(dist>0.1)+0.1*(dist<0.1)  # numerical stability
             D = self.obstacle_threshold + 0.2
@@ -357,12 +368,12 @@ class DroneEnv(AbstractEnv):
             obs_force = (obs_force)*(dist < D)
             
         else:
-            obs_force = np.zeros((self.num_agents, n_candidates)).reshape(-1)
+            obs_force = np.zeros((n_agents, n_candidates)).reshape(-1)
         
-        nominal_control = get_simple_direction(origin_pos, self.world.agent_goals)
-        goal_force = ((actions - nominal_control.reshape(self.num_agents, 1, self.action_dim))**2).sum(axis=-1)  # num_agents x n_candidates
+        nominal_control = get_simple_direction(origin_pos, np.asarray(self.world.agent_goals)[agent_ids])
+        goal_force = ((actions - nominal_control.reshape(n_agents, 1, self.action_dim))**2).sum(axis=-1)  # n_agents x n_candidates
         score = K1 * obs_force - K2 * goal_force.reshape(-1)
-        score = score.reshape(self.num_agents, n_candidates)
+        score = score.reshape(n_agents, n_candidates)
         return score    
 
 
@@ -7,6 +7,7 @@ from matplotlib.animation import FuncAnimation
 from matplotlib.animation import FFMpegWriter, PillowWriter
 from matplotlib.collections import PatchCollection, EllipseCollection
 from .gym_abstract import AbstractState, AbstractEnv
+from .sampling import sample_obstacles
 from scipy.spatial.distance import cdist
 import torch
 
@@ -24,7 +25,6 @@ n_candidates = 2000
 class DubinsCarState(AbstractState):
 
     def scanForAgents(self):
-        obstacles = []
         agents = [(-1,-1,0) for i in range(self.num_agents)]     
         agent_goals = [(-1,-1) for i in range(self.num_agents)]        
         for i in range(self.state.shape[0]):
@@ -35,30 +35,8 @@ class DubinsCarState(AbstractState):
                     agent_goals[self.goals[i,j]-1] = (i+0.5,j+0.5)
         # add random obstacles    
         map_size = len(self.state)
-        if self.keep_sample_obs:
-            num_candid = 1
-        else:
-            num_candid = int(self.prob*(map_size**2))        
-        while True:
-            if (self.keep_sample_obs) and ((len(obstacles) >= int(self.prob)) or (num_candid > 1000000)):
-                break
-            new_obstacles = np.random.uniform(0, map_size, size=(num_candid, 2))
-            distance_agent = cdist(new_obstacles, np.array(agents)[:,:2]).min(axis=-1)
-            distance_goal = cdist(new_obstacles, np.array(agent_goals)[:,:2]).min(axis=-1)        
-            valid = ((distance_goal > GOAL_THRESHOLD) & (distance_agent > (0.1+OBSTACLE_DISTANCE_THRESHOLD)))
-            new_obstacles = new_obstacles[valid]
-            for new_obstacle in new_obstacles:
-                if len(obstacles):
-                    distance_obs = cdist([new_obstacle], obstacles).min(axis=-1)
-                else:
-                    distance_obs = np.array([float('inf')])
-                valid = (distance_obs > (0.2+2*OBSTACLE_DISTANCE_THRESHOLD))
-                if valid.all():
-                    obstacles.append(new_obstacle)
-            if (not self.keep_sample_obs):
-                break
-            else:
-                num_candid = num_candid * 2
+        obstacles = sample_obstacles(map_size, agents, agent_goals, self.prob, GOAL_THRESHOLD, OBSTACLE_DISTANCE_THRESHOLD,
+                                     keep_sample_obs=self.keep_sample_obs)
         return obstacles, agents, agent_goals
     
     def sample_agents(self, n_agents, prob=0.1):
@@ -200,22 +178,20 @@ class DubinsCarEnv(AbstractEnv):
         return img
     
     
-    def dynamic(self, pos, action):
-        next_pos = pos.copy()
-        next_pos[:, 2] = next_pos[:, 2] + self.steer * action.copy().squeeze(-1)
-        next_pos[:, 0] = next_pos[:, 0] + 0.05 * np.cos(next_pos[:, 2])
-        next_pos[:, 1] = next_pos[:, 1] + 0.05 * np.sin(next_pos[:, 2])
-        next_pos[:, 2] = next_pos[:, 2]%(2*math.pi)
+    def dynamic(self, pos, action, out=None):
+        next_pos = self._next_state_buffer(pos, action, out)
+        next_pos[..., 2] = pos[..., 2] + self.steer * action[..., 0]
+        next_pos[..., 0] = pos[..., 0] + 0.05 * np.cos(next_pos[..., 2])
+        next_pos[..., 1] = pos[..., 1] + 0.05 * np.sin(next_pos[..., 2])
+        next_pos[..., 2] = next_pos[..., 2]%(2*math.pi)
         return next_pos
     
 
     def dynamic_torch(self, pos, action):
-        next_pos = pos.clone()
-        next_theta = pos[:, 2] + self.steer * action.reshape(-1)
-        next_pos[:, 0] = pos[:, 0] + 0.05 * torch.cos(next_theta)
-        next_pos[:, 1] = pos[:, 1] + 0.05 * torch.sin(next_theta)
-        next_pos[:, 2] = next_theta
-        return next_pos
+        next_theta = pos[..., 2] + self.steer * action[..., 0]
+        return torch.stack((pos[..., 0] + 0.05 * torch.cos(next_theta),
+                            pos[..., 1] + 0.05 * torch.sin(next_theta),
+                            next_theta), dim=-1)
 
     
     def save_fig(self, agents, goals, obstacles, filename):
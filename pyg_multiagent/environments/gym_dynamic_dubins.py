@@ -166,24 +166,23 @@ class DynamicDubinsEnv(AbstractEnv):
 
         return next_o, rewards, done, prev_o
 
-    def potential_field(self, actions, K1, K2, ignore_agent=False):
-        # size of actions: (num_agents, n_candidates, action_dim)
+    def potential_field(self, actions, K1, K2, ignore_agent=False, agent_ids=None, others=None):
+        # size of actions: (num_agents, n_candidates, action_dim), or (len(agent_ids), n_candidates, action_dim),
+        # see AbstractEnv.potential_field, others is not used: there is no agent term
         
-        assert actions.shape[0]==self.num_agents
+        if agent_ids is None:
+            agent_ids = np.arange(self.num_agents)
+        assert actions.shape[0]==len(agent_ids)
         assert actions.shape[-1]==self.action_dim
-        n_candidates = actions.shape[1]
+        n_agents, n_candidates = actions.shape[:2]
+        goals = np.asarray(self.world.agent_goals)[agent_ids]
         
-        origin_pos = np.copy(self.world.agents)
-        next_pos = np.expand_dims(origin_pos, 1)
-        next_pos = np.tile(next_pos, (1, n_candidates, 1)) # num_agents x n_candidates x state_dim
+        next_pos = self.lookahead(actions, agents=np.asarray(self.world.agents)[agent_ids])  # n_agents x n_candidates x state_dim
         
-        next_pos = self.dynamic(next_pos.reshape(-1, self.state_dim), actions.reshape(-1, self.action_dim))
-        next_pos = next_pos.reshape((self.num_agents, n_candidates, self.state_dim))
-        
-        goal_dim = len(self.world.agent_goals[0])
-        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(self.world.agent_goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # num_agents x n_candidates
+        goal_dim = goals.shape[-1]
+        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # n_agents x n_candidates
         score = -K2 * goal_force.reshape(-1)
-        score = score.reshape(self.num_agents, n_candidates)
+        score = score.reshape(n_agents, n_candidates)
         return score        
     
     def _render(self):
@@ -222,16 +221,16 @@ class DynamicDubinsEnv(AbstractEnv):
         img = img.reshape(fig.canvas.get_width_height()[::-1] + (3,))
         return img
 
-    def dynamic(self, pos, action):
+    def dynamic(self, pos, action, out=None):
         # pos: x, y, vel, theta
         # action: acc, angular velocity
-        next_pos = pos.copy()
-        next_pos[:, 3] = next_pos[:, 3] + self.steer * action.reshape(-1, self.action_dim)[:, 1].copy()
-        next_pos[:, 2] = next_pos[:, 2] + 0.05 * action.reshape(-1, self.action_dim)[:, 0].copy()
-        next_pos[:, 2] = np.clip(next_pos[:, 2], 0, 1)
-        next_pos[:, 0] = next_pos[:, 0] + 0.05 * next_pos[:, 2] * np.cos(next_pos[:, 3])
-        next_pos[:, 1] = next_pos[:, 1] + 0.05 * next_pos[:, 2] * np.sin(next_pos[:, 3])
-        next_pos[:, 3] = next_pos[:, 3]%(2*math.pi)
+        next_pos = self._next_state_buffer(pos, action, out)
+        next_pos[..., 3] = pos[..., 3] + self.steer * action[..., 1]
+        next_pos[..., 2] = pos[..., 2] + 0.05 * action[..., 0]
+        np.clip(next_pos[..., 2], 0, 1, out=next_pos[..., 2])
+        next_pos[..., 0] = pos[..., 0] + 0.05 * next_pos[..., 2] * np.cos(next_pos[..., 3])
+        next_pos[..., 1] = pos[..., 1] + 0.05 * next_pos[..., 2] * np.sin(next_pos[..., 3])
+        next_pos[..., 3] = next_pos[..., 3]%(2*math.pi)
         return next_pos
 
     def save_fig(self, agents, goals, obstacles, filename, title=''):
@@ -7,6 +7,7 @@ from matplotlib.animation import FuncAnimation
 from matplotlib.animation import FFMpegWriter, PillowWriter
 from matplotlib.collections import PatchCollection, EllipseCollection
 from .gym_abstract import AbstractState, AbstractEnv
+from .sampling import sample_obstacles
 from scipy.spatial.distance import cdist
 import torch
 
@@ -24,7 +25,6 @@ n_candidates = 2000
 class DoubleDubinsCarState(AbstractState):
 
     def scanForAgents(self):
-        obstacles = []
         agents = [(-1,-1,0,0) for i in range(self.num_agents)]     
         agent_goals = [(-1,-1) for i in range(self.num_agents)]        
         for i in range(self.state.shape[0]):
@@ -38,30 +38,8 @@ class DoubleDubinsCarState(AbstractState):
                     agents[self.state[i,j]-1] = (i+0.5,j+0.5,0.,angle)
         # add random obstacles    
         map_size = len(self.state)
-        if self.keep_sample_obs:
-            num_candid = 1
-        else:
-            num_candid = int(self.prob*(map_size**2))        
-        while True:
-            if (self.keep_sample_obs) and ((len(obstacles) >= int(self.prob)) or (num_candid > 1000000)):
-                break
-            new_obstacles = np.random.uniform(0, map_size, size=(num_candid, 2))
-            distance_agent = cdist(new_obstacles, np.array(agents)[:,:2]).min(axis=-1)
-            distance_goal = cdist(new_obstacles, np.array(agent_goals)[:,:2]).min(axis=-1)        
-            valid = ((distance_goal > GOAL_THRESHOLD) & (distance_agent > (0.1+OBSTACLE_DISTANCE_THRESHOLD)))
-            new_obstacles = new_obstacles[valid]
-            for new_obstacle in new_obstacles:
-                if len(obstacles):
-                    distance_obs = cdist([new_obstacle], obstacles).min(axis=-1)
-                else:
-                    distance_obs = np.array([float('inf')])
-                valid = (distance_obs > (0.2+2*OBSTACLE_DISTANCE_THRESHOLD))
-                if valid.all():
-                    obstacles.append(new_obstacle)
-            if (not self.keep_sample_obs):
-                break
-            else:
-                num_candid = num_candid * 2
+        obstacles = sample_obstacles(map_size, agents, agent_goals, self.prob, GOAL_THRESHOLD, OBSTACLE_DISTANCE_THRESHOLD,
+                                     keep_sample_obs=self.keep_sample_obs)
         return obstacles, agents, agent_goals
     
     def sample_agents(self, n_agents, prob=0.1):
@@ -204,56 +182,53 @@ class MultiDynamicDubinsEnv(AbstractEnv):
         return img
     
     
-    def dynamic(self, pos, action):
-        next_pos = pos.copy()
+    def dynamic(self, pos, action, out=None):
+        next_pos = self._next_state_buffer(pos, action, out)
         dt = 0.05
         # pos: x, y, vel, theta
         # action: acc, angular velocity
-        next_pos[:, 3] = next_pos[:, 3] + 0.2 * action.reshape(-1, self.action_dim)[:, 1].copy()
-        next_pos[:, 2] = next_pos[:, 2] + dt * action.reshape(-1, self.action_dim)[:, 0].copy()
-        next_pos[:, 2] = np.clip(next_pos[:, 2], 0, 1)
-        next_pos[:, 0] = next_pos[:, 0] + dt * next_pos[:, 2] * np.cos(next_pos[:, 3])
-        next_pos[:, 1] = next_pos[:, 1] + dt * next_pos[:, 2] * np.sin(next_pos[:, 3])
-        next_pos[:, 3] = next_pos[:, 3]%(2*math.pi)
+        next_pos[..., 3] = pos[..., 3] + 0.2 * action[..., 1]
+        next_pos[..., 2] = pos[..., 2] + dt * action[..., 0]
+        np.clip(next_pos[..., 2], 0, 1, out=next_pos[..., 2])
+        next_pos[..., 0] = pos[..., 0] + dt * next_pos[..., 2] * np.cos(next_pos[..., 3])
+        next_pos[..., 1] = pos[..., 1] + dt * next_pos[..., 2] * np.sin(next_pos[..., 3])
+        next_pos[..., 3] = next_pos[..., 3]%(2*math.pi)
         return next_pos
     
 
     def dynamic_torch(self, pos, action):
-        next_pos = pos.clone()
-        next_theta = pos[:, 3] + self.steer * action.reshape(-1, self.action_dim)[:, 1]
-        next_vel = pos[:, 2] + 0.05 * action.reshape(-1, self.action_dim)[:, 0]
-        next_pos[:, 0] = pos[:, 0] + 0.05 * next_vel * torch.cos(next_theta)
-        next_pos[:, 1] = pos[:, 1] + 0.05 * next_vel * torch.sin(next_theta)
-        next_pos[:, 2] = next_vel
-        next_pos[:, 3] = next_theta
-        return next_pos
+        next_theta = pos[..., 3] + self.steer * action[..., 1]
+        next_vel = pos[..., 2] + 0.05 * action[..., 0]
+        return torch.stack((pos[..., 0] + 0.05 * next_vel * torch.cos(next_theta),
+                            pos[..., 1] + 0.05 * next_vel * torch.sin(next_theta),
+                            next_vel,
+                            next_theta), dim=-1)
     
-    def potential_field(self, actions, K1, K2, ignore_agent=False):
+    def potential_field(self, actions, K1, K2, ignore_agent=False, agent_ids=None, others=None):
         
-        # size of actions: (num_agents, n_candidates, action_dim)
+        # size of actions: (num_agents, n_candidates, action_dim), or (len(agent_ids), n_candidates, action_dim),
+        # see AbstractEnv.potential_field, others is not used: there is no agent term
         
-        assert actions.shape[0]==self.num_agents
+        if agent_ids is None:
+            agent_ids = np.arange(self.num_agents)
+        assert actions.shape[0]==len(agent_ids)
         assert actions.shape[-1]==self.action_dim
-        n_candidates = actions.shape[1]
-        
-        origin_pos = np.copy(self.world.agents)
-        next_pos = np.expand_dims(origin_pos, 1)
-        next_pos = np.tile(next_pos, (1, n_candidates, 1)) # num_agents x n_candidates x state_dim
+        n_agents, n_candidates = actions.shape[:2]
+        goals = np.asarray(self.world.agent_goals)[agent_ids]
         
-        next_pos = self.dynamic(next_pos.reshape(-1, self.state_dim), actions.reshape(-1, self.action_dim))
-        next_pos = next_pos.reshape((self.num_agents, n_candidates, self.state_dim))
+        next_pos = self.lookahead(actions, agents=np.asarray(self.world.agents)[agent_ids])  # n_agents x n_candidates x state_dim
         
-        goal_dim = len(self.world.agent_goals[0])
-        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(self.world.agent_goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # num_agents x n_candidates
+        goal_dim = goals.shape[-1]
+        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # n_agents x n_candidates
         
-        diff = np.expand_dims(self.world.agent_goals, axis=1)[:,:,:2]-next_pos[:, :, :2]
+        diff = np.expand_dims(goals, axis=1)[:,:,:2]-next_pos[:, :, :2]
         angle = np.arctan2(diff[:,:,1]+1e-5, diff[:,:,0]+1e-5)
         diff_angle = next_pos[:, :, 3] - angle
         diff_angle = (diff_angle + math.pi) % (2*math.pi) - math.pi
         direction_force = np.abs(diff_angle)
         
         score = -K2 * (goal_force.reshape(-1) + 0.1 * direction_force.reshape(-1))
-        score = score.reshape(self.num_agents, n_candidates)
+        score = score.reshape(n_agents, n_candidates)
         return score
 
     
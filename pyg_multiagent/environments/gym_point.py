@@ -159,25 +159,24 @@ class PointEnv(AbstractEnv):
         return next_o, rewards, done, prev_o
         
 
-    def potential_field(self, actions, K1, K2, ignore_agent=False):
+    def potential_field(self, actions, K1, K2, ignore_agent=False, agent_ids=None, others=None):
         
-        # size of actions: (num_agents, n_candidates, action_dim)
+        # size of actions: (num_agents, n_candidates, action_dim), or (len(agent_ids), n_candidates, action_dim),
+        # see AbstractEnv.potential_field, others is not used: there is no agent term
         
-        assert actions.shape[0]==self.num_agents
+        if agent_ids is None:
+            agent_ids = np.arange(self.num_agents)
+        assert actions.shape[0]==len(agent_ids)
         assert actions.shape[-1]==self.action_dim
-        n_candidates = actions.shape[1]
+        n_agents, n_candidates = actions.shape[:2]
+        goals = np.asarray(self.world.agent_goals)[agent_ids]
         
-        origin_pos = np.copy(self.world.agents)
-        next_pos = np.expand_dims(origin_pos, 1)
-        next_pos = np.tile(next_pos, (1, n_candidates, 1)) # num_agents x n_candidates x state_dim
+        next_pos = self.lookahead(actions, agents=np.asarray(self.world.agents)[agent_ids])  # n_agents x n_candidates x state_dim
         
-        next_pos = self.dynamic(next_pos.reshape(-1, self.state_dim), actions.reshape(-1, self.action_dim))
-        next_pos = next_pos.reshape((self.num_agents, n_candidates, self.state_dim))
-        
-        goal_dim = len(self.world.agent_goals[0])
-        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(self.world.agent_goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # num_agents x n_candidates
+        goal_dim = goals.shape[-1]
+        goal_force = ((next_pos[:, :, :goal_dim] - np.expand_dims(goals, axis=1)[:, :, :goal_dim])**2).sum(axis=-1)  # n_agents x n_candidates
         score = -K2 * goal_force.reshape(-1)
-        score = score.reshape(self.num_agents, n_candidates)
+        score = score.reshape(n_agents, n_candidates)
         return score        
     
     def _render(self):
@@ -265,10 +264,10 @@ class PointEnv(AbstractEnv):
         return img
     
     
-    def dynamic(self, pos, action):
-        next_pos = pos.copy()
-        next_pos[:, 0] = next_pos[:, 0] + 0.05 * action[:, 0]
-        next_pos[:, 1] = next_pos[:, 1] + 0.05 * action[:, 1]
+    def dynamic(self, pos, action, out=None):
+        next_pos = self._next_state_buffer(pos, action, out)
+        next_pos[..., 0] = pos[..., 0] + 0.05 * action[..., 0]
+        next_pos[..., 1] = pos[..., 1] + 0.05 * action[..., 1]
         return next_pos
 
     
@@ -169,10 +169,10 @@ class SingleIntegratorEnv(AbstractEnv):
         return img
     
     
-    def dynamic(self, pos, action):
-        next_pos = pos.copy()
-        next_pos[:, 0] = next_pos[:, 0] + 0.05 * action[:, 0]
-        next_pos[:, 1] = next_pos[:, 1] + 0.05 * action[:, 1]
+    def dynamic(self, pos, action, out=None):
+        next_pos = self._next_state_buffer(pos, action, out)
+        next_pos[..., 0] = pos[..., 0] + 0.05 * action[..., 0]
+        next_pos[..., 1] = pos[..., 1] + 0.05 * action[..., 1]
         return next_pos
 
     
@@ -0,0 +1,243 @@
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
+
+
+# 'auto' switches from the dense distance matrix to the kd-tree above this number of points
+KDTREE_MIN_POINTS = 64
+# the dense backend never builds more than this many distances at once
+DENSE_CHUNK_SIZE = 2**22
+
+
+def as_points(points):
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 1:
+        points = points[:, None]
+    return points
+
+
+class NeighborIndex:
+    """
+    Nearest-neighbour queries against a fixed set of points.
+
+    Backends:
+        'dense': chunked cdist against all points, exact, quadratic time
+        'kdtree': scipy cKDTree, exact, O(log n) per query
+        'auto': 'kdtree' when there are at least KDTREE_MIN_POINTS points, else 'dense'
+
+    Both backends return the same distances, so the choice only affects speed and memory.
+    """
+
+    def __init__(self, points, backend='auto'):
+        self.points = as_points(points)
+        if backend is None or backend == 'auto':
+            backend = 'kdtree' if len(self.points) >= KDTREE_MIN_POINTS else 'dense'
+        assert backend in ('dense', 'kdtree'), 'unknown neighbor backend: {}'.format(backend)
+        self.backend = backend
+        self.tree = cKDTree(self.points) if (backend == 'kdtree' and len(self.points)) else None
+
+    def __len__(self):
+        return len(self.points)
+
+    def nearest(self, queries, k=1):
+        """
+        Distance from every query to its k-th nearest point (inf if there are less than k points).
+        Use k=2 when the queries are the points themselves to skip the query point.
+        """
+        queries = as_points(queries)
+        if (len(self.points) < k) or (len(queries) == 0):
+            return np.full(len(queries), np.inf)
+
+        if self.tree is not None:
+            distance, _ = self.tree.query(queries, k=[k])
+            return distance[:, 0]
+
+        distance = np.empty(len(queries))
+        chunk = max(1, DENSE_CHUNK_SIZE // len(self.points))
+        for start in range(0, len(queries), chunk):
+            block = cdist(queries[start:start+chunk], self.points)
+            if k == 1:
+                distance[start:start+chunk] = block.min(axis=-1)
+            else:
+                distance[start:start+chunk] = np.partition(block, k-1, axis=-1)[:, k-1]
+        return distance
+
+    def query_knn(self, queries, k, r=np.inf):
+        """
+        The k nearest points within distance r of every query, and the other points exactly as near
+        as the k-th one, so that query_nearest can break the ties by point id instead of arbitrarily.
+        Returns (query_ids, point_ids, distance) of the found pairs.
+        """
+        queries = as_points(queries)
+        k = min(k, len(self.points))
+        if (k == 0) or (len(queries) == 0):
+            return self._empty_pairs()
+
+        if self.tree is not None:
+            # one more neighbour than asked tells which queries have ties at the k-th distance
+            m = min(k+1, len(self.points))
+            distance, point_ids = self.tree.query(queries, k=list(range(1, m+1)), distance_upper_bound=np.nextafter(r, np.inf))
+            kth = distance[:, k-1]
+            tied = np.isfinite(kth) & (distance[:, m-1] <= kth) if m > k else np.zeros(len(queries), dtype=bool)
+            untied = np.where(~tied)[0]
+            query_ids = np.repeat(untied, k)
+            point_ids = point_ids[untied, :k].reshape(-1)
+            found = self.tree.query_ball_point(queries[tied], np.nextafter(kth[tied], np.inf)) if tied.any() else []
+            query_ids = np.concatenate([query_ids, np.repeat(np.where(tied)[0], [len(ids) for ids in found])])
+            point_ids = np.concatenate([point_ids, np.fromiter((i for ids in found for i in ids), dtype=int)])
+            found = point_ids < len(self.points)  # missing neighbours beyond r
+            query_ids, point_ids = query_ids[found], point_ids[found]
+            distance = np.linalg.norm(queries[query_ids]-self.points[point_ids], axis=-1)
+        else:
+            query_ids, point_ids, distance = [], [], []
+            chunk = max(1, DENSE_CHUNK_SIZE // len(self.points))
+            for start in range(0, len(queries), chunk):
+                block = cdist(queries[start:start+chunk], self.points)
+                if k < len(self.points):
+                    rows, cols = np.nonzero(block <= np.partition(block, k-1, axis=-1)[:, k-1:k])
+                else:
+                    rows, cols = np.nonzero(np.ones(block.shape, dtype=bool))
+                query_ids.append(rows+start)
+                point_ids.append(cols)
+                distance.append(block[rows, cols])
+            query_ids, point_ids, distance = np.concatenate(query_ids), np.concatenate(point_ids), np.concatenate(distance)
+
+        within = distance <= r
+        return query_ids[within], point_ids[within], distance[within]
+
+    def query_radius(self, queries, r):
+        """
+        All points within distance r of every query.
+        Returns (query_ids, point_ids, distance) of the found pairs.
+        """
+        queries = as_points(queries)
+        if (len(self.points) == 0) or (len(queries) == 0):
+            return self._empty_pairs()
+
+        if self.tree is not None:
+            found = self.tree.query_ball_point(queries, np.nextafter(r, np.inf))
+            query_ids = np.repeat(np.arange(len(queries)), [len(point_ids) for point_ids in found])
+            point_ids = np.fromiter((i for point_ids in found for i in point_ids), dtype=int, count=len(query_ids))
+            distance = np.linalg.norm(queries[query_ids]-self.points[point_ids], axis=-1)
+        else:
+            query_ids, point_ids, distance = [], [], []
+            chunk = max(1, DENSE_CHUNK_SIZE // len(self.points))
+            for start in range(0, len(queries), chunk):
+                block = cdist(queries[start:start+chunk], self.points)
+                rows, cols = np.nonzero(block <= np.nextafter(r, np.inf))
+                query_ids.append(rows+start)
+                point_ids.append(cols)
+                distance.append(block[rows, cols])
+            query_ids, point_ids, distance = np.concatenate(query_ids), np.concatenate(point_ids), np.concatenate(distance)
+
+        within = distance <= r
+        return query_ids[within], point_ids[within], distance[within]
+
+    def query_nearest(self, queries, r, k=None, skip_self=False):
+        """
+        The (at most) k nearest points within distance r of every query, in one query
+        (all the points within r if k is None). With skip_self the queries are the points
+        and a query is not a neighbour of itself.
+        Returns (query_ids, point_ids, distance) of the found pairs, grouped by query,
+        nearest first (equally near points in point order). Of the points equally near as
+        the k-th, those with the lowest ids are kept, whatever the backend.
+        """
+        queries = as_points(queries)
+        if (k is None) or (k+skip_self >= len(self.points)):
+            query_ids, point_ids, distance = self.query_radius(queries, r)
+        else:
+            query_ids, point_ids, distance = self.query_knn(queries, k+skip_self, r)
+        if skip_self:
+            other = query_ids != point_ids
+            query_ids, point_ids, distance = query_ids[other], point_ids[other], distance[other]
+
+        order = np.lexsort((point_ids, distance, query_ids))
+        query_ids, point_ids, distance = query_ids[order], point_ids[order], distance[order]
+        if k is not None:
+            first = np.searchsorted(query_ids, np.arange(len(queries)))
+            keep = np.arange(len(query_ids)) - first[query_ids] < k
+            query_ids, point_ids, distance = query_ids[keep], point_ids[keep], distance[keep]
+        return query_ids, point_ids, distance
+
+    @staticmethod
+    def _empty_pairs():
+        return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+
+
+def nearest_per_target(edge_index, distance, num_targets, k):
+    """
+    Keeps the k shortest edges arriving at every target node (edge_index[1]),
+    the kept edges stay in their original order.
+
+    Args:
+        edge_index: (2, num_edges) LongTensor
+        distance: (num_edges,) length of every edge
+    """
+    target = edge_index[1].numpy()
+    order = np.lexsort((np.asarray(distance), target))
+    first = np.searchsorted(target[order], np.arange(num_targets))
+    rank = np.arange(len(order)) - first[target[order]]
+    keep = np.sort(order[rank < k])
+    return edge_index[:, torch.from_numpy(keep)]
+
+
+def nearest_other_group(points, others=None, groups=None):
+    """
+    Distance from every point to the nearest point of another group (inf if there is only one group),
+    e.g. from every candidate next position of an agent to the candidates of the other agents.
+
+    Args:
+        points: (n_groups, n_points, dim) array, the points of every group
+        others: optional (n_other_groups, n_others, dim) array, the points are compared with these instead
+        groups: optional (n_groups,) array, the group of others every group of points belongs to (default arange)
+    Returns:
+        (n_groups, n_points) array
+    """
+    if others is None:
+        others = points
+    if groups is None:
+        groups = np.arange(len(points))
+    n_groups, n_points = points.shape[:2]
+    n_other_groups, n_others = others.shape[:2]
+    flat, flat_others = points.reshape(n_groups*n_points, -1), others.reshape(n_other_groups*n_others, -1)
+    distance = np.full(n_groups*n_points, np.inf)
+    if (n_other_groups < 2) or (n_points == 0) or (n_others == 0):
+        return distance.reshape(n_groups, n_points)
+
+    chunk = max(1, DENSE_CHUNK_SIZE // len(flat_others))
+    group = np.repeat(groups, n_points)
+    for start in range(0, len(flat), chunk):
+        # nearest point of every group, then the group of the query is left out
+        block = cdist(flat[start:start+chunk], flat_others).reshape(-1, n_other_groups, n_others).min(axis=-1)
+        block[np.arange(len(block)), group[start:start+chunk]] = np.inf
+        distance[start:start+chunk] = block.min(axis=-1)
+    return distance.reshape(n_groups, n_points)
+
+
+def radius_knn_graph(sources, targets, r, k=None, source_batch=None, target_batch=None, loop=True, backend='auto'):
+    """
+    Edges from every target to its (at most) k nearest sources within distance r, nearest first
+    (see NeighborIndex.query_nearest), the degree of every target is at most k.
+    Sources and targets of different batches (e.g. the worlds of BatchedEnv) are never connected.
+    With loop=False the sources are the targets and the edge from a point to itself is skipped.
+
+    Returns:
+        (2, num_edges) LongTensor of (source, target) edges, grouped by target
+    """
+    sources, targets = as_points(sources), as_points(targets)
+    assert loop or len(sources) == len(targets)
+    if source_batch is not None:
+        # an extra coordinate puts the points of different batches farther apart than any two
+        # points of the same batch, so the nearest sources of a target are those of its batch
+        source_batch, target_batch = np.asarray(source_batch), np.asarray(target_batch)
+        both = np.concatenate((sources, targets))
+        spread = np.linalg.norm(both.max(axis=0) - both.min(axis=0)) + 1 if len(both) else 1
+        sources = np.concatenate((sources, spread*source_batch[:, None]), axis=1)
+        targets = np.concatenate((targets, spread*target_batch[:, None]), axis=1)
+
+    target_ids, source_ids, _ = NeighborIndex(sources, backend).query_nearest(targets, r, k, skip_self=not loop)
+    if source_batch is not None:
+        same = source_batch[source_ids] == target_batch[target_ids]
+        target_ids, source_ids = target_ids[same], source_ids[same]
+    return torch.from_numpy(np.stack([source_ids, target_ids])).long()
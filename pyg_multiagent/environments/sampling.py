@@ -0,0 +1,174 @@
+import numpy as np
+from scipy.spatial import cKDTree
+
+from .neighbors import NeighborIndex
+
+
+# keep_sample_obs stops doubling the number of candidates above this
+MAX_CANDIDATES = 1000000
+
+
+def greedy_independent_set(n, pairs):
+    """
+    Accepts the points 0..n-1 one after another in index order, skipping every point
+    that conflicts with an already accepted one, but decides them in vectorized rounds.
+
+    Args:
+        n: number of points
+        pairs: (n_pairs, 2) conflicting point indices
+    Returns:
+        boolean mask of the accepted points
+    """
+    pairs = np.sort(np.asarray(pairs, dtype=int).reshape(-1, 2), axis=-1)
+    lower, upper = pairs[:, 0], pairs[:, 1]
+    state = np.zeros(n, dtype=np.int8)  # 0: undecided, 1: accepted, -1: rejected
+    while (state == 0).any():
+        # rejected as soon as a lower conflicting point is accepted
+        rejected = np.bincount(upper[state[lower] == 1], minlength=n) > 0
+        state[(state == 0) & rejected] = -1
+        # accepted once all lower conflicting points are rejected
+        blocked = np.bincount(upper[state[lower] == 0], minlength=n) > 0
+        state[(state == 0) & ~blocked] = 1
+        keep = (state[lower] >= 0) & (state[upper] == 0)
+        lower, upper = lower[keep], upper[keep]
+    return state == 1
+
+
+def sample_obstacles(map_size, agents, agent_goals, prob, goal_threshold, obstacle_threshold, keep_sample_obs=False):
+    """
+    Dart-throwing obstacle sampler shared by the scanForAgents implementations.
+
+    Candidates are drawn uniformly in the map, dropped if they are within goal_threshold of
+    a goal or within 0.1+obstacle_threshold of an agent, and accepted in order unless they
+    are within 0.2+2*obstacle_threshold of an accepted obstacle. Without keep_sample_obs a
+    single batch of int(prob*map_size**2) candidates is drawn, otherwise batches of 1, 2, 4, ...
+    candidates are drawn until there are int(prob) obstacles.
+
+    Gives the same obstacles as the sequential rejection loop for the same random state.
+
+    Returns:
+        (n_obstacles, 2) array
+    """
+    agent_index = NeighborIndex(np.asarray(agents, dtype=float)[:, :2])
+    goal_index = NeighborIndex(np.asarray(agent_goals, dtype=float)[:, :2])
+    min_separation = 0.2+2*obstacle_threshold
+
+    obstacles = np.zeros((0, 2))
+    if keep_sample_obs:
+        num_candid = 1
+    else:
+        num_candid = int(prob*(map_size**2))
+    while True:
+        if (keep_sample_obs) and ((len(obstacles) >= int(prob)) or (num_candid > MAX_CANDIDATES)):
+            break
+        new_obstacles = np.random.uniform(0, map_size, size=(num_candid, 2))
+        valid = ((goal_index.nearest(new_obstacles) > goal_threshold) &
+                 (agent_index.nearest(new_obstacles) > (0.1+obstacle_threshold)))
+        new_obstacles = new_obstacles[valid]
+        if len(obstacles):
+            valid = NeighborIndex(obstacles).nearest(new_obstacles) > min_separation
+            new_obstacles = new_obstacles[valid]
+        pairs = cKDTree(new_obstacles).query_pairs(min_separation, output_type='ndarray')
+        new_obstacles = new_obstacles[greedy_independent_set(len(new_obstacles), pairs)]
+        obstacles = np.concatenate((obstacles, new_obstacles), axis=0)
+        if (not keep_sample_obs):
+            break
+        else:
+            num_candid = num_candid * 2
+    return obstacles
+
+
+def sample_grids(n_worlds, size, num_agents, prob=0., simple=False, min_dist=float('-inf'), max_dist=float('inf')):
+    """
+    Samples the grids of n_worlds worlds of the same size at once, with the layout of
+    AbstractEnv._setWorld: agent i+1 and its goal are written as i+1 in the world and
+    goal grids, obstacle cells are -1 in the world grid.
+
+    Agents are placed on distinct cells. Every goal is drawn uniformly among the free cells
+    whose distance to the start of the agent is in [min_dist, max_dist] (the nearest free
+    cell if there is none), the goals of the agents are placed one after another.
+
+    Args:
+        prob: probability that a cell is an obstacle, scalar or (n_worlds,)
+    Returns:
+        worlds, goals: (n_worlds, size, size) int arrays
+    """
+    n_cells = size*size
+    world_ids = np.arange(n_worlds)
+    cells = np.stack(np.divmod(np.arange(n_cells), size), axis=-1)  # n_cells x 2
+
+    # the num_agents cells with the smallest random keys, in the order of the keys
+    keys = np.random.rand(n_worlds, n_cells)
+    agent_cells = np.argpartition(keys, num_agents-1, axis=-1)[:, :num_agents] if num_agents < n_cells else \
+                  np.broadcast_to(np.arange(n_cells), (n_worlds, n_cells))
+    agent_cells = np.take_along_axis(agent_cells, np.argsort(np.take_along_axis(keys, agent_cells, axis=-1), axis=-1), axis=-1)
+
+    taken = np.zeros((n_worlds, n_cells), dtype=bool)
+    goal_cells = np.zeros((n_worlds, num_agents), dtype=int)
+    for agent_id in range(num_agents):
+        dist2s = np.linalg.norm(cells[None, :, :] - cells[agent_cells[:, agent_id]][:, None, :], axis=-1)  # n_worlds x n_cells
+        good_tiles = (dist2s <= max_dist) & (dist2s >= min_dist) & (~taken)
+        random_good = np.where(good_tiles, np.random.rand(n_worlds, n_cells), np.inf).argmin(axis=-1)
+        nearest = np.where(taken, np.inf, dist2s).argmin(axis=-1)
+        goal_cells[:, agent_id] = np.where(good_tiles.any(axis=-1), random_good, nearest)
+        taken[world_ids, goal_cells[:, agent_id]] = True
+
+    worlds = np.zeros((n_worlds, n_cells), dtype=int)
+    goals = np.zeros((n_worlds, n_cells), dtype=int)
+    worlds[world_ids[:, None], agent_cells] = np.arange(1, 1+num_agents)
+    goals[world_ids[:, None], goal_cells] = np.arange(1, 1+num_agents)
+    worlds, goals = worlds.reshape(n_worlds, size, size), goals.reshape(n_worlds, size, size)
+    return add_obstacle_cells(worlds, goals, prob, simple), goals
+
+
+def add_obstacle_cells(worlds, goals, prob, simple=False):
+    """
+    Marks random cells of the (n_worlds, size, size) world grids as obstacles (-1),
+    keeping the cells of the agents and of the goals free.
+    """
+    size = worlds.shape[-1]
+    prob = np.reshape(prob, (-1, 1, 1))
+    obs_world = -(np.random.rand(*worlds.shape)<prob).astype(int)
+    if simple:
+        obs_world[(slice(None),)+tuple(np.meshgrid(np.arange(start=0,stop=size,step=2),np.arange(start=1,stop=size,step=2)))] = 0
+        obs_world[(slice(None),)+tuple(np.meshgrid(np.arange(start=1,stop=size,step=2),np.arange(start=0,stop=size,step=2)))] = 0
+    obs_world[worlds!=0] = 0
+    obs_world[goals!=0] = 0
+    return worlds + obs_world
+
+
+def sample_edge_subsets(target, num_targets, k_range, n_samples):
+    """
+    n_samples random subsets of the edges arriving at every target node, as drawn by
+    AbstractEnv._get_obs_random_k: sample s keeps min(degree, k) edges of every target,
+    k uniform in [k_range[0], k_range[1]]. The edges of a target are taken one after another
+    along a random permutation of them (wrapping around), so every edge is kept once the
+    samples kept k_range[0]*ceil(degree/k_range[0]) edges of the target.
+
+    Args:
+        target: (num_edges,) target node of every edge
+    Returns:
+        sample_ids, edge_ids of the kept edges, grouped by sample then target,
+        and n_cover, the number of first samples that keep every edge at least once
+    """
+    k_low, k_high = k_range
+    assert k_low >= 1
+    target = np.asarray(target, dtype=int)
+    degree = np.bincount(target, minlength=num_targets)
+    first = np.concatenate(([0], np.cumsum(degree)))
+    # the edges grouped by target, in random order within every target
+    order = np.lexsort((np.random.rand(len(target)), target))
+
+    k = np.random.randint(k_low, k_high+1, size=(n_samples, num_targets))
+    end = np.cumsum(k, axis=0)
+    start = end - k
+    covered = end >= degree
+    assert covered[-1].all(), 'not enough samples to cover the edges'
+    n_cover = int(covered.argmax(axis=0)[degree > 0].max(initial=-1)) + 1
+
+    count = np.minimum(k, degree).reshape(-1)
+    pair = np.repeat(np.arange(len(count)), count)
+    within = np.arange(len(pair)) - np.repeat(np.cumsum(count) - count, count)
+    sample_ids, targets = np.divmod(pair, num_targets)
+    local = (start.reshape(-1)[pair] + within) % degree[targets]
+    return sample_ids, order[first[targets] + local], n_cover
@@ -0,0 +1,158 @@
+import os
+from collections import namedtuple
+import numpy as np
+from .sampling import sample_grids
+
+
+# a world as AbstractEnv._setWorld leaves it: the grids plus the continuous obstacles, agents and goals
+Scenario = namedtuple('Scenario', ['world', 'goals', 'prob', 'obstacles', 'agents', 'agent_goals'])
+
+
+class ScenarioPool:
+    """
+    K pre-generated worlds of an environment, kept in flat arrays:
+        sizes (K,), probs (K,), grid_offsets (K+1,) into the flattened world / goal grids,
+        agents (K, num_agents, state_dim), agent_goals (K, num_agents, goal_dim),
+        obstacle_offsets (K+1,) into obstacles (n_obstacles, 2), as float64 like ScenarioStore,
+        so a pooled world is exactly the sampled one.
+
+    env = Env(**env_config, scenario=pool.sample()) starts from one of them without sampling.
+    """
+
+    def __init__(self, sizes, probs, grid_offsets, worlds, goals, agents, agent_goals, obstacle_offsets, obstacles):
+        self.sizes = sizes
+        self.probs = probs
+        self.grid_offsets = grid_offsets
+        self.worlds = worlds
+        self.goals = goals
+        self.agents = agents
+        self.agent_goals = agent_goals
+        self.obstacle_offsets = obstacle_offsets
+        self.obstacles = obstacles
+
+    @classmethod
+    def generate(cls, env, n_worlds):
+        """
+        Samples n_worlds worlds with the configuration (SIZE, PROB, num_agents, ...) of env.
+        The grids of all worlds of the same size are sampled at once.
+        """
+        assert not env.connected, 'connected worlds are not supported'
+        sizes = np.random.choice(np.arange(env.SIZE[0], env.SIZE[1]+1), size=n_worlds)
+        try:
+            probs = np.random.uniform(env.PROB[0], env.PROB[1], size=n_worlds)
+        except:
+            probs = np.full(n_worlds, env.PROB[0], dtype=float)
+
+        worlds, goals = [None]*n_worlds, [None]*n_worlds
+        for size in np.unique(sizes):
+            world_ids = np.where(sizes==size)[0]
+            size_worlds, size_goals = sample_grids(len(world_ids), int(size), env.num_agents, prob=probs[world_ids],
+                                                   simple=env.simple, min_dist=env.min_dist, max_dist=env.max_dist)
+            for world_id, world, goal in zip(world_ids, size_worlds, size_goals):
+                worlds[world_id], goals[world_id] = world, goal
+
+        agents, agent_goals, obstacles = [], [], []
+        for world, goal, prob in zip(worlds, goals, probs):
+            state = env.absState(world, goal, env.space_dim, env.state_dim,
+                                 env.obstacle_threshold, env.agent_threshold, env.goal_threshold,
+                                 prob=prob, num_agents=env.num_agents, keep_sample_obs=env.keep_sample_obs)
+            agents.append(state.agents)
+            agent_goals.append(state.agent_goals)
+            obstacles.append(np.asarray(state.obstacles, dtype=float).reshape(-1, 2))
+
+        grid_offsets = np.concatenate(([0], np.cumsum(sizes**2)))
+        obstacle_offsets = np.concatenate(([0], np.cumsum([len(o) for o in obstacles])))
+        return cls(sizes, probs, grid_offsets,
+                   np.concatenate([w.reshape(-1) for w in worlds]).astype(np.int16),
+                   np.concatenate([g.reshape(-1) for g in goals]).astype(np.int16),
+                   np.stack(agents).astype(np.float64), np.stack(agent_goals).astype(np.float64),
+                   obstacle_offsets, np.concatenate(obstacles).astype(np.float64))
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def __getitem__(self, idx):
+        size = int(self.sizes[idx])
+        grid = slice(self.grid_offsets[idx], self.grid_offsets[idx+1])
+        return Scenario(world=self.worlds[grid].reshape(size, size).astype(int),
+                        goals=self.goals[grid].reshape(size, size).astype(int),
+                        prob=float(self.probs[idx]),
+                        obstacles=self.obstacles[self.obstacle_offsets[idx]:self.obstacle_offsets[idx+1]],
+                        agents=self.agents[idx],
+                        agent_goals=self.agent_goals[idx])
+
+    def sample(self):
+        return self[np.random.randint(len(self))]
+
+    def save(self, path):
+        np.savez(path, **self.__dict__)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{key: arrays[key] for key in arrays.files})
+
+
+class ScenarioStore:
+    """
+    Read-only columnar store of (obstacles, agent_goals, agents) scenarios, the tuples of the
+    validation datasets. A store is a directory of .npy files:
+        obstacles (n_obstacles, 2), agents (n_agents, state_dim), agent_goals (n_agents, goal_dim)
+        as float64 (the scenarios read back are bit-identical to the written ones),
+        and obstacle_offsets / agent_offsets (K+1,) giving the rows of every scenario.
+
+    The arrays are memory-mapped, so opening a store is instant, scenarios are only read when
+    they are accessed and processes reading the same store share the pages.
+    """
+
+    COLUMNS = ['obstacles', 'obstacle_offsets', 'agents', 'agent_goals', 'agent_offsets']
+
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        for column in self.COLUMNS:
+            setattr(self, column, np.load(os.path.join(path, column+'.npy'), mmap_mode=mmap_mode))
+
+    @classmethod
+    def write(cls, path, scenarios):
+        """
+        Writes an iterable of (obstacles, agent_goals, agents) tuples to the directory path.
+        """
+        obstacles, agent_goals, agents = [], [], []
+        for scenario_obstacles, scenario_goals, scenario_agents in scenarios:
+            obstacles.append(np.asarray(scenario_obstacles, dtype=np.float64).reshape(-1, 2))
+            agent_goals.append(np.asarray(scenario_goals, dtype=np.float64))
+            agents.append(np.asarray(scenario_agents, dtype=np.float64))
+        assert len(agents) > 0
+
+        os.makedirs(path, exist_ok=True)
+        columns = {
+            'obstacles': np.concatenate(obstacles),
+            'obstacle_offsets': np.concatenate(([0], np.cumsum([len(o) for o in obstacles]))),
+            'agents': np.concatenate(agents),
+            'agent_goals': np.concatenate(agent_goals),
+            'agent_offsets': np.concatenate(([0], np.cumsum([len(a) for a in agents]))),
+        }
+        for column, value in columns.items():
+            np.save(os.path.join(path, column+'.npy'), value)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.agent_offsets)-1
+
+    def __getitem__(self, idx):
+        """
+        Returns the idx-th scenario as float arrays (obstacles, agent_goals, agents), copied out of the store.
+        """
+        if idx < 0:
+            idx += len(self)
+        if not (0 <= idx < len(self)):
+            raise IndexError(idx)
+        obstacle_rows = slice(self.obstacle_offsets[idx], self.obstacle_offsets[idx+1])
+        agent_rows = slice(self.agent_offsets[idx], self.agent_offsets[idx+1])
+        return (self.obstacles[obstacle_rows].astype(float),
+                self.agent_goals[agent_rows].astype(float),
+                self.agents[agent_rows].astype(float))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
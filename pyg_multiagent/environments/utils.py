@@ -117,4 +117,8 @@ def save_gif(gifs, name="play.gif"):
 
 
 def less_or_equal(a, b):
-    return (np.allclose(a, b) or (a < b))
\ No newline at end of file
+    return (np.allclose(a, b) or (a < b))
+
+def less_or_equal_mask(a, b):
+    # elementwise version of less_or_equal
+    return np.isclose(a, b) | (np.asarray(a) < np.asarray(b))